@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import asyncio
+
+from .tls import TlsContext
+
+from .tcp import Tcp, ConnectRace
+from .http import Http
+
+class StreamSocket(object):
+    ''' A socket along with its asyncio streams, as kept by the ConnectionPool. '''
+    def __init__(self, tcp, reader, writer):
+        self.tcp = tcp
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.tcp.close()
+
+class AsyncHttp(Http):
+    '''
+    Http connection driven by asyncio streams, used by AsyncProcess.
+    The blocking methods inherited from Http still work, e.g. for the probe
+    request sent before the event loop runs.
+    '''
+    def __init__(self, *args, **kwargs):
+        super(AsyncHttp, self).__init__(*args, **kwargs)
+        self.reader = None
+        self.writer = None
+
+    def is_connected(self):
+        return self.writer is not None or super(AsyncHttp, self).is_connected()
+
+    def get_socket_fd(self):
+        if self.writer is not None:
+            return self.writer.get_extra_info('socket')
+        return super(AsyncHttp, self).get_socket_fd()
+
+    async def async_connect(self):
+        '''
+        Resolve the host and connect without blocking the event loop, racing
+        the addresses as Tcp.connect() does, see ConnectRace.
+        '''
+        host = self.host
+        port = self.port
+        user = self.user
+        password = self.password
+        self.check_if_no_proxy()
+        if self.use_http_proxy and self.http_proxy:
+            _, port, user, password, \
+            host, _, _, _ \
+                = self.analyse_url(self.http_proxy)
+        loop = asyncio.get_running_loop()
+        race = ConnectRace(
+            host, port, self.ai_family, self.io_timeout, self.local_addresses, self.resolver, self.socket_options
+        )
+        if not await loop.run_in_executor(None, race.resolve):
+            return False
+        try:
+            timeout = race.next_timeout()
+            while timeout is not None:
+                for sock in await self.async_wait_writeable(list(race.attempts), timeout):
+                    race.attempt_done(sock)
+                timeout = race.next_timeout()
+        except asyncio.CancelledError:
+            race.close()
+            raise
+        sock = race.take_winner()
+        if sock is None:
+            return False
+        if not await self.async_open_streams(host, port, sock, race.deadline - time.time()):
+            return False
+        self.tcp.rtt = race.rtt
+        self.http_basic_auth = None
+        if user and password:
+            self.basic_auth_token(user, password)
+        return True
+
+    async def async_wait_writeable(self, socks, timeout):
+        ''' The asyncio side of select() in Tcp.connect(). '''
+        loop = asyncio.get_running_loop()
+        writeable = []
+        ready = loop.create_future()
+        def on_writeable(sock):
+            loop.remove_writer(sock)
+            writeable.append(sock)
+            if not ready.done():
+                ready.set_result(None)
+        for sock in socks:
+            loop.add_writer(sock, on_writeable, sock)
+        try:
+            await asyncio.wait([ready], timeout=timeout)
+        finally:
+            for sock in socks:
+                loop.remove_writer(sock)
+        return writeable
+
+    async def async_open_streams(self, host, port, sock, timeout):
+        ''' Open the streams on the connected socket, the Tls handshake takes place here. '''
+        tls = None
+        if self.is_secure_scheme():
+            tls = self.tls or TlsContext()
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    sock=sock,
+                    ssl=tls,
+                    server_hostname=host if tls is not None else None
+                ),
+                max(timeout, 0)
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            sock.close()
+            Tcp.print_error(host, port, e.args[-1] if e.args else 'timed out')
+            return False
+        except asyncio.CancelledError:
+            sock.close()
+            raise
+        if tls is not None:
+            # The session was resumed by TlsContext.wrap_bio() if possible.
+            tls.handshake_done(host, self.writer.get_extra_info('ssl_object'))
+        return True
+
+    async def async_execute_req_resp(self):
+        self.writer.write(''.join([self.request, '\r\n']).encode('utf-8'))
+        await self.writer.drain()
+        try:
+            header = await self.reader.readuntil(self.HEADER_END)
+        except asyncio.IncompleteReadError:
+            sys.stderr.write('Connection closed before the response header was complete.\n')
+            return False
+        except asyncio.LimitOverrunError as e:
+            sys.stderr.write(f'{e.args[0]}\n')
+            return False
+        self.response = header.decode('iso-8859-1')
+        try:
+            self.status_code, self.response_headers = self.parse_response_header(header)
+        except ValueError:
+            sys.stderr.write(f'Invalid response header.\n{self.response}')
+            return False
+        self.multipart_boundary = self.get_multipart_boundary()
+        self.response_end = self.get_response_end()
+        if not self.is_response_usable():
+            return False
+        return not self.is_multipart() or await self.async_recv_part_header()
+
+    async def async_recv_part_header(self):
+        ''' Same as Http.recv_part_header() on the stream. '''
+        try:
+            header = await self.reader.readuntil(self.HEADER_END)
+        except asyncio.IncompleteReadError:
+            sys.stderr.write('Connection closed before the part header was complete.\n')
+            return False
+        except asyncio.LimitOverrunError as e:
+            sys.stderr.write(f'{e.args[0]}\n')
+            return False
+        return self.check_part_header(header)
+
+    async def async_setup(self):
+        '''
+        Connect, send the range request and read the response header.
+        A socket connected beforehand, e.g. a warm one, is used if it still works.
+        '''
+        reuse = self.is_connected()
+        # asyncio can't take over a Tls socket.
+        if reuse and self.writer is None and (self.tcp.is_tls() or not await self.async_adopt_socket()):
+            self.disconnect()
+            reuse = False
+        if not reuse and not await self.async_connect():
+            return False
+        if not self.request_setup():
+            return False
+        try:
+            if await self.async_execute_req_resp():
+                return True
+        except OSError:
+            if not reuse:
+                raise
+        if not reuse or self.remote_changed:
+            return False
+        # The server closed the socket meanwhile, try a new one.
+        self.disconnect()
+        return await self.async_setup()
+
+    async def async_adopt_socket(self):
+        ''' Go on with the response on the blocking socket, e.g. the probe's. '''
+        try:
+            self.reader, self.writer = await asyncio.open_connection(sock=self.tcp.socket_fd)
+        except OSError as e:
+            sys.stderr.write(f'Exception in {__name__}: {e.args[-1]}\n')
+            return False
+        return True
+
+    async def async_recv(self, msg_size):
+        if self.tcp.has_buffered_data():
+            # Body bytes read along with the response header.
+            return self.tcp.recv(msg_size)
+        return await self.reader.read(msg_size)
+
+    def detach_socket(self):
+        stream_socket = StreamSocket(self.tcp, self.reader, self.writer)
+        self.tcp = Tcp()
+        self.reader = None
+        self.writer = None
+        return stream_socket
+
+    def attach_socket(self, stream_socket):
+        self.disconnect()
+        self.tcp = stream_socket.tcp
+        self.reader = stream_socket.reader
+        self.writer = stream_socket.writer
+
+    def disconnect(self):
+        if self.writer is not None:
+            ssl_object = self.writer.get_extra_info('ssl_object')
+            if ssl_object is not None and self.tls is not None:
+                # The session ticket may have come in with the data.
+                self.tls.save_session(self.host, ssl_object)
+            self.writer.close()
+            self.reader = None
+            self.writer = None
+        super(AsyncHttp, self).disconnect()
@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import time
+import asyncio
+
+from .process import Process
+from .connection import Connection
+from .async_http import AsyncHttp
+
+class AsyncProcess(Process):
+    '''
+    A Process whose connections run as asyncio tasks on one event loop,
+    instead of a setup thread per connection plus the selector loop.
+    Segment bookkeeping, reactivation and the state file are the ones in Process.
+    '''
+    def __init__(self, config, session=None):
+        super(AsyncProcess, self).__init__(config, session)
+        self.loop = asyncio.new_event_loop()
+        # Connection index -> task downloading its segment
+        self.tasks = {}
+        # Set by the tasks when there is something for do_downloading() to look at
+        self.wake = asyncio.Event()
+        # Set from the writer thread when it has written something, the tasks
+        # wait for it while the writer is full
+        self.writer_room = asyncio.Event()
+
+    def create_connection(self, local_if=None):
+        if Connection.get_scheme_from_url(self.url) not in (Connection.HTTP, Connection.HTTPS):
+            raise Exception(f'Exception in {__name__}: the asyncio engine only supports Http.')
+        return AsyncHttp(
+            self.config.ai_family,
+            self.config.io_timeout,
+            self.config.max_redirect,
+            self.config.headers,
+            self.config.http_proxy,
+            self.config.no_proxies,
+            local_if,
+            self.config.keep_alive
+        )
+
+    def start_downloading(self):
+        for conn in self.conns:
+            self.init_connection(conn)
+
+        if self.config.verbose:
+            print('Starting download...')
+
+        self.start_time = time.time()
+        self.ready = False
+
+        for i, conn in enumerate(self.conns):
+            if self.can_use_probe_response(i):
+                if self.config.verbose:
+                    self.add_message(f'Connection {i} goes on with the probe response')
+                self.start_setup_thread(i, use_probe=True)
+            elif conn.current_byte > conn.last_byte:
+                self.reactivate_connection(i)
+            elif conn.current_byte < conn.last_byte:
+                self.start_setup_thread(i)
+
+    def can_use_probe_response(self, i):
+        ''' asyncio can't take over a Tls socket, the probe's is closed then. '''
+        if self.conns[i].tcp.is_tls():
+            self.conns[i].disconnect()
+            return False
+        return super(AsyncProcess, self).can_use_probe_response(i)
+
+    def start_setup_thread(self, i, use_probe=False):
+        '''
+        Same role as in Process, but the setup runs as a task.
+        With use_probe the task reads the probe response already on the socket.
+        '''
+        conn = self.conns[i]
+        self.assign_mirror(conn)
+        if not use_probe:
+            self.queue_extra_ranges(i)
+        if self.config.verbose:
+            self.add_message(
+                f'Connection {i} downloading from '
+                f'{conn.host}:{conn.port} '
+                f'using interface {conn.local_ifs}'
+            )
+        conn.in_progress = True
+        conn.last_transfer = time.time()
+        self.tasks[i] = self.loop.create_task(self.download_segment(i, use_probe))
+
+    async def download_segment(self, i, use_probe=False):
+        conn = self.conns[i]
+        try:
+            if use_probe:
+                conn.setup_failed = not await conn.async_adopt_socket()
+            else:
+                if not conn.is_connected() and self.pool is not None:
+                    self.pool.take(conn)
+                conn.setup_failed = not await conn.async_setup()
+            self.score_mirror(conn, not conn.setup_failed)
+            self.check_extra_ranges(i)
+            while not conn.setup_failed:
+                position = await self.download_range(i)
+                if position is None:
+                    return
+                if self.config.verbose:
+                    self.add_message(f'Connection {i} finished')
+                if conn.is_multipart():
+                    # The next part of the response is the next queued range.
+                    if position != conn.part_end or not self.segments.next_queued(i, conn):
+                        return
+                    conn.enabled = False
+                    if self.writer is not None:
+                        self.writer.flush(i)
+                    conn.in_progress = True
+                    conn.last_transfer = time.time()
+                    conn.setup_failed = not await conn.async_recv_part_header()
+                    continue
+                # With keep-alive, the next range is asked for on the same socket.
+                if self.pool is None or not conn.is_reusable(position):
+                    return
+                conn.enabled = False
+                if self.writer is not None:
+                    self.writer.flush(i)
+                self.reactivate_connection(i)
+                if conn.current_byte >= conn.last_byte:
+                    self.pool.put(conn)
+                    return
+                conn.in_progress = True
+                conn.last_transfer = time.time()
+                self.assign_mirror(conn)
+                self.queue_extra_ranges(i)
+                conn.setup_failed = not await conn.async_setup()
+                self.score_mirror(conn, not conn.setup_failed)
+                self.check_extra_ranges(i)
+        except OSError as e:
+            if self.config.verbose:
+                self.add_message(f'Error on connection {i}, connection closed. {e.args[-1]}')
+            self.score_mirror(conn, False)
+        except Exception as e:
+            # E.g. a broken response, the range goes back to the segment map.
+            self.add_message(f'Error on connection {i}, connection closed. {e}')
+            self.score_mirror(conn, False)
+            self.segments.release(i)
+            conn.current_byte = conn.last_byte
+        finally:
+            conn.disconnect()
+            conn.enabled = False
+            if self.writer is not None:
+                self.writer.flush(i)
+            self.check_extra_ranges(i)
+            conn.in_progress = False
+            self.reactivate_connection(i)
+            self.wake.set()
+
+    async def download_range(self, i):
+        '''
+        Receive the range of connection i. Return how far the response was read,
+        or None if the connection broke off.
+        '''
+        conn = self.conns[i]
+        conn.in_progress = False
+        conn.enabled = True
+        conn.last_transfer = time.time()
+        position = conn.current_byte
+        while conn.current_byte < conn.last_byte:
+            # Every read goes through the rate limiters.
+            delay = self.read_delay(conn)
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self.read_delay(conn)
+            while self.writer is not None and self.writer.is_full():
+                self.writer_room.clear()
+                if self.writer.is_full():
+                    await self.writer_room.wait()
+            max_bytes = min(self.config.buffer_size, self.allowed_bytes(conn))
+            if conn.is_multipart():
+                # The next part header follows the range.
+                max_bytes = min(max_bytes, conn.last_byte - conn.current_byte)
+            data_buffer = await conn.async_recv(max(1, max_bytes))
+            self.consume_tokens(conn, len(data_buffer))
+            conn.last_transfer = time.time()
+            if not data_buffer:
+                if self.file_size != Connection.MAX_FILESIZE:
+                    self.add_message(f'Connection {i} unexpectedly closed')
+                    self.score_mirror(conn, False)
+                if not conn.resuming_supported:
+                    self.ready = True
+                return None
+            position = conn.current_byte + len(data_buffer)
+            remaining = conn.last_byte - conn.current_byte
+            data_buffer_size = min(len(data_buffer), remaining)
+            covered, losers = self.segments.advance(i, conn.current_byte, data_buffer_size)
+            data_view = memoryview(data_buffer)[:data_buffer_size]
+            if self.checksum is not None:
+                self.checksum.update(i, conn.current_byte, data_view)
+            if not self.write_data(i, conn, data_view, covered, pooled=False):
+                return None
+            self.refetch_failed_pieces(i)
+            conn.current_byte += data_buffer_size
+            conn.speed_bytes += data_buffer_size
+            for loser in losers:
+                if self.config.verbose:
+                    self.add_message(f'Connection {i} won the race against connection {loser}')
+                self.cancel_connection(loser)
+        return position
+
+    def writer_wakeup(self):
+        ''' Called by the writer thread. '''
+        self.loop.call_soon_threadsafe(self.writer_room.set)
+
+    def cancel_connection(self, i):
+        ''' Stop a connection that lost an end-game race, its task finds it other work. '''
+        conn = self.conns[i]
+        conn.current_byte = conn.last_byte
+        task = self.tasks.get(i)
+        if task is not None and not task.done():
+            task.cancel()
+
+    async def wait_for_tasks(self, timeout):
+        try:
+            await asyncio.wait_for(self.wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.wake.clear()
+
+    def do_downloading(self):
+        ''' Let the tasks run for a while, then do the housekeeping. '''
+        self.collect_written()
+        self.create_state_file_periodically()
+        self.loop.run_until_complete(self.wait_for_tasks(self.MAINTENANCE_INTERVAL))
+        self.check_if_bytes_done()
+        if not self.ready:
+            self.downloading_maintance()
+
+    def connections_check(self):
+        ''' Restart connections with work left, cancel the stuck ones. '''
+        now = time.time()
+        for i, conn in enumerate(self.conns):
+            if conn.retired:
+                continue
+            task = self.tasks.get(i)
+            if task is not None and not task.done():
+                if conn.enabled and conn.mirror is not None and conn.mirror.dropped:
+                    # It goes on with its range from another mirror.
+                    task.cancel()
+                    continue
+                if conn.in_progress:
+                    timeout = conn.last_transfer + self.config.reconnect_delay
+                else:
+                    timeout = conn.last_transfer + self.config.connection_timeout
+                if now > timeout:
+                    if self.config.verbose:
+                        self.add_message(f'Connection {i} timed out')
+                    self.score_mirror(conn, False)
+                    task.cancel()
+                continue
+            # Idle connections look for work again, there may be some to steal now.
+            self.reactivate_connection(i)
+            self.release_idle_connection(i)
+            if not conn.retired and conn.current_byte < conn.last_byte:
+                self.start_setup_thread(i)
+
+    def retire_connection(self):
+        ''' Same as in Process, the connection's task is cancelled and waited for. '''
+        i = len(self.conns) - 1
+        conn = self.conns[i]
+        if i == 0:
+            return False
+        conn.retired = True
+        self.segments.release(i)
+        task = self.tasks.pop(i, None)
+        if task is not None and not task.done():
+            task.cancel()
+            self.loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+        conn.disconnect()
+        del self.conns[i]
+        self.config.num_of_connections -= 1
+        if conn not in self.released_conns:
+            self.release_connections(1)
+        if self.config.verbose:
+            self.add_message(f'Retired connection {i}')
+        return True
+
+    def terminate(self):
+        tasks = [task for task in self.tasks.values() if not task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        super(AsyncProcess, self).terminate()
+        self.loop.close()
+
+    def abandon(self):
+        super(AsyncProcess, self).abandon()
+        self.loop.close()
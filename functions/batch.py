@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import copy
+import json
+import signal
+import threading
+from collections import deque
+
+from .tasker import Tasker
+from .budget import ConnectionBudget
+from .session import Session
+from .connection import Connection
+
+class BatchQueue(object):
+    '''
+    The URLs of a batch: the ones from the command line, then the lines of
+    the input file, read as they are needed, so a long list isn't held in
+    memory. Empty lines and lines starting with # are skipped, a line may
+    list mirrors of its file after the URL, separated by white space.
+    With a state file, the downloaded entries are recorded: all of them
+    before done_before, and the ones in done after it, which are few as the
+    entries start in order. An interrupted batch goes on from there, the
+    files it was downloading resume from their own state files. A failed
+    entry isn't recorded, the next run of the batch tries it again.
+    '''
+    FILE_VERSION = 1
+
+    def __init__(self, urls=None, input_file=None, state_file=None):
+        self.urls = urls or []
+        self.input_file = input_file
+        self.state_file = state_file
+        self.done_before = 0
+        self.done = set()
+        if state_file is not None:
+            self.load()
+
+    def entries(self):
+        ''' Yield (index, url) of the unfinished entries. '''
+        for index, url in enumerate(self.read_urls()):
+            if index >= self.done_before and index not in self.done:
+                yield index, url
+
+    def read_urls(self):
+        yield from self.urls
+        if self.input_file is None:
+            return
+        if self.input_file == '-':
+            file_obj = sys.stdin
+        else:
+            file_obj = open(self.input_file, 'r')
+        try:
+            for line in file_obj:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield line
+        finally:
+            if file_obj is not sys.stdin:
+                file_obj.close()
+
+    def mark_done(self, index):
+        self.done.add(index)
+        while self.done_before in self.done:
+            self.done.remove(self.done_before)
+            self.done_before += 1
+        self.save()
+
+    def load(self):
+        ''' A missing or broken state file means nothing is finished. '''
+        try:
+            with open(self.state_file, 'r') as file_obj:
+                data = json.load(file_obj)
+            if data['version'] != self.FILE_VERSION:
+                return
+            self.done_before = int(data['done_before'])
+            self.done = set(int(index) for index in data['done'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def save(self):
+        if self.state_file is None:
+            return
+        temp_filename = ''.join([self.state_file, '.tmp'])
+        try:
+            with open(temp_filename, 'w') as file_obj:
+                json.dump({
+                    'version': self.FILE_VERSION,
+                    'done_before': self.done_before,
+                    'done': sorted(self.done),
+                }, file_obj)
+            os.replace(temp_filename, self.state_file)
+        except OSError as e:
+            sys.stderr.write(f'Unable to save the batch state {self.state_file}: {e.args[-1]}\n')
+
+class Batch(object):
+    '''
+    Download a list of URLs, each one by a Tasker in a thread of its own.
+    The downloads share a Session, and a ConnectionBudget caps the connections
+    of all of them, and of each host. A download starts once its host has a
+    free slot for the probe, so the next file starts as soon as one in its
+    end-game lets an idle connection go, see Process.release_idle_connection().
+    Downloads start one at a time, each once the previous one has taken the
+    slots for its connections, so they don't all start with one connection.
+    '''
+    # Waiting entries looked at for a free slot, so one busy host doesn't
+    # hold up the others
+    LOOKAHEAD = 16
+    # Seconds between checks of the running downloads, and while one sets up
+    POLL_INTERVAL = 0.5
+    SETUP_POLL_INTERVAL = 0.05
+
+    def __init__(self, config, urls=None, input_file=None, state_file=None):
+        self.config = config
+        self.queue = BatchQueue(urls, input_file, state_file)
+        self.budget = ConnectionBudget(config.max_connections, config.max_connections_per_host)
+        self.session = Session(config, self.budget)
+        # (entry index, host, Tasker, thread) of the downloads in flight
+        self.running = []
+        # Tasker -> what its start_task() returned
+        self.results = {}
+        self.failed = 0
+        self.finished = 0
+        self.run = True
+        # Output files of the downloads started so far, two URLs ending in the
+        # same name must not write into one file
+        self.output_paths = set()
+        self.output_lock = threading.Lock()
+
+    def start(self):
+        self.setup_signal_hook()
+        entries = self.queue.entries()
+        waiting = deque()
+        exhausted = False
+        while self.run:
+            while not exhausted and len(waiting) < self.LOOKAHEAD:
+                entry = next(entries, None)
+                if entry is None:
+                    exhausted = True
+                else:
+                    waiting.append(entry)
+            self.collect_finished()
+            if not waiting and not self.running:
+                break
+            setting_up = not all(self.is_set_up(tasker) for _, _, tasker, _ in self.running)
+            if not setting_up:
+                setting_up = self.start_next(waiting)
+            self.budget.wait(self.SETUP_POLL_INTERVAL if setting_up else self.POLL_INTERVAL)
+        for _, _, tasker, _ in self.running:
+            tasker.run = False
+        for _, _, _, thread in self.running:
+            thread.join()
+        self.collect_finished()
+        self.session.close()
+        sys.stdout.write(f'Batch: {self.finished} downloaded, {self.failed} failed.\n')
+        return self.failed == 0
+
+    def start_next(self, waiting):
+        ''' Start the first waiting entry whose host has a free slot, return True if there was one. '''
+        for index, line in list(waiting):
+            urls = line.split()
+            try:
+                host = Connection.analyse_url(urls[0])[4]
+            except Exception as e:
+                # A bad line fails on its own, the rest of the batch goes on.
+                waiting.remove((index, line))
+                self.failed += 1
+                sys.stderr.write(f'Download failed: {line} {e.args[-1]}\n')
+                continue
+            if self.budget.acquire(host, 1):
+                waiting.remove((index, line))
+                self.start_download(index, urls, host)
+                return True
+        return False
+
+    @staticmethod
+    def is_set_up(tasker):
+        ''' True once the download has divided the file among its connections, or is over. '''
+        return tasker.process.segments is not None or tasker.process.ready or not tasker.run
+
+    def start_download(self, index, urls, host):
+        ''' urls are the URL of the entry and its mirrors. '''
+        # Each Process changes its config, e.g. the number of connections.
+        config = copy.copy(self.config)
+        config.mirrors = urls[1:]
+        tasker = Tasker(config, urls[0], self.session, handle_signals=False, claim_output=self.claim_output)
+        thread = threading.Thread(target=self.download, args=(tasker, host), daemon=True)
+        self.running.append((index, host, tasker, thread))
+        thread.start()
+
+    def claim_output(self, filename):
+        '''
+        Reserve filename for one download, return False if another one of
+        the batch has it. A finished download keeps its name.
+        '''
+        path = os.path.abspath(filename)
+        with self.output_lock:
+            if path in self.output_paths:
+                return False
+            self.output_paths.add(path)
+            return True
+
+    def download(self, tasker, host):
+        try:
+            self.results[tasker] = tasker.start_task()
+        except Exception as e:
+            sys.stderr.write(f'Exception in {__name__}: {tasker.url} {e.args[-1]}\n')
+        finally:
+            tasker.process.release_connections(tasker.process.extra_slots)
+            self.budget.release(host, 1)
+
+    def collect_finished(self):
+        ''' Record the downloads which are over, the failed and interrupted ones aren't done. '''
+        running = []
+        for index, host, tasker, thread in self.running:
+            if thread.is_alive():
+                running.append((index, host, tasker, thread))
+                continue
+            if not tasker.run and not tasker.process.ready:
+                continue
+            if self.results.pop(tasker, False) and tasker.process.ready:
+                self.finished += 1
+                self.queue.mark_done(index)
+            else:
+                # It may be a passing failure, so it stays pending.
+                self.failed += 1
+                sys.stderr.write(f'Download failed: {tasker.url}\n')
+        self.running = running
+
+    def setup_signal_hook(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+    def stop(self, signum, frame):
+        sys.stdout.write(f'{signum} signal recevied, stopping the batch.\n')
+        self.run = False
+        for _, _, tasker, _ in self.running:
+            tasker.run = False
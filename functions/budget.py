@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import threading
+
+class ConnectionBudget(object):
+    '''
+    Connection slots shared by the downloads of a batch: at most max_total
+    connections in all, and at most max_per_host to one host.
+    A download holds a slot for each connection it runs, the first one is
+    taken by the Batch before the download starts, the others by its Process.
+    '''
+    def __init__(self, max_total, max_per_host):
+        self.max_total = max_total
+        self.max_per_host = max_per_host
+        self.cond = threading.Condition()
+        self.used = 0
+        # Host -> slots in use
+        self.per_host = {}
+
+    def acquire(self, host, num_of_slots):
+        ''' Take up to num_of_slots slots for host, return how many were free. '''
+        with self.cond:
+            granted = min(
+                num_of_slots,
+                self.max_total - self.used,
+                self.max_per_host - self.per_host.get(host, 0)
+            )
+            if granted <= 0:
+                return 0
+            self.used += granted
+            self.per_host[host] = self.per_host.get(host, 0) + granted
+            return granted
+
+    def release(self, host, num_of_slots):
+        if num_of_slots <= 0:
+            return
+        with self.cond:
+            self.used -= num_of_slots
+            self.per_host[host] -= num_of_slots
+            if self.per_host[host] == 0:
+                del self.per_host[host]
+            self.cond.notify_all()
+
+    def wait(self, timeout):
+        ''' Wait until some slots are released, or for timeout seconds. '''
+        with self.cond:
+            self.cond.wait(timeout)
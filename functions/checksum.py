@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import threading
+
+class Checksum(object):
+    '''
+    Verify the downloaded file against an expected digest while it downloads,
+    instead of reading it once more afterwards.
+    The file digest needs the data in order, so the contiguous prefix is hashed
+    as it grows: straight from the received data when it arrives in order,
+    otherwise read back from the file when the prefix catches up, which mostly
+    hits the page cache since the data was just written. catch_up() runs in a
+    thread of its own, so the prefix is guarded by a lock.
+    With expected_blocks, e.g. Metalink pieces, each block is also hashed as
+    it's received and checked at once, see take_failed_ranges(), so a mismatch
+    can be narrowed down to the blocks which differ from them. Without them a
+    mismatch can't be blamed on any block.
+    expected may be None when only the blocks have digests.
+    '''
+    # Bytes read back from the file per call
+    READ_SIZE = 1024 * 1024
+    # Times a block failing its expected digest is reported by take_failed_ranges()
+    MAX_BLOCK_RETRIES = 2
+
+    def __init__(self, algorithm, expected, file_size, block_size, expected_blocks=None, block_algorithm=None):
+        self.algorithm = algorithm
+        self.expected = expected
+        self.file_size = file_size
+        self.block_size = block_size
+        self.expected_blocks = expected_blocks
+        self.block_algorithm = block_algorithm or algorithm
+        # Block index -> digest of the data received for it
+        self.received_hashes = {}
+        # Connection index -> [block index, hasher, next offset] of the block
+        # it is receiving, a block is only hashed when it's received in one go
+        self.partial = {}
+        # Received blocks which don't match expected_blocks, and block index ->
+        # times it was reported
+        self.failed_blocks = []
+        self.block_failures = {}
+        # Block index -> digest of the data read back from the file
+        self.file_hashes = {}
+        self.lock = threading.Lock()
+        # Bumped by restart(), a catch_up() running for an older one stops
+        self.generation = 0
+        self.restart()
+
+    def restart(self):
+        ''' Hash the file from the start again, e.g. after fetching bad blocks again. '''
+        with self.lock:
+            self.file_hash = hashlib.new(self.algorithm)
+            self.hashed_to = 0
+            self.file_hashes = {}
+            self.generation += 1
+            self.checked = False
+
+    def block_range(self, block):
+        start = block * self.block_size
+        return start, min(start + self.block_size, self.file_size)
+
+    def update(self, i, offset, data):
+        ''' Connection i received data for offset. '''
+        if self.expected_blocks is not None:
+            self.update_block(i, offset, data)
+        self.update_prefix(offset, data)
+
+    def update_prefix(self, offset, data, generation=None):
+        '''
+        Hash data at offset if the prefix reaches it. Return False if it doesn't,
+        or if the data was read before a restart().
+        '''
+        end = offset + len(data)
+        with self.lock:
+            if generation not in (None, self.generation) or offset > self.hashed_to:
+                return False
+            if self.hashed_to < end:
+                self.file_hash.update(data[self.hashed_to - offset:])
+                self.hashed_to = end
+            return True
+
+    def update_block(self, i, offset, data):
+        position = offset
+        view = memoryview(data)
+        while view:
+            partial = self.partial.get(i)
+            if partial is None or partial[2] != position:
+                block, in_block = divmod(position, self.block_size)
+                if in_block:
+                    # The connection started inside this block, skip to the next one.
+                    skip = self.block_size - in_block
+                    view = view[skip:]
+                    position += skip
+                    self.partial.pop(i, None)
+                    continue
+                partial = [block, hashlib.new(self.block_algorithm), position]
+                self.partial[i] = partial
+            block_end = self.block_range(partial[0])[1]
+            size = min(len(view), block_end - position)
+            partial[1].update(view[:size])
+            view = view[size:]
+            position += size
+            partial[2] = position
+            if position == block_end:
+                self.received_hashes[partial[0]] = partial[1].digest()
+                self.check_block(partial[0])
+                del self.partial[i]
+
+    def check_block(self, block):
+        if self.expected_blocks is None or block >= len(self.expected_blocks):
+            return
+        if self.received_hashes[block] == self.expected_blocks[block]:
+            return
+        if self.block_failures.get(block, 0) < self.MAX_BLOCK_RETRIES:
+            self.block_failures[block] = self.block_failures.get(block, 0) + 1
+            self.failed_blocks.append(block)
+
+    def take_failed_ranges(self):
+        ''' Byte ranges of the blocks received since the last call which don't match expected_blocks. '''
+        ranges = [self.block_range(block) for block in sorted(self.failed_blocks)]
+        self.failed_blocks = []
+        return ranges
+
+    def catch_up(self, read, end):
+        '''
+        Hash the file up to end, reading what the prefix hasn't seen with
+        read(offset, size), which returns bytes from the file. The data received
+        meanwhile may move the prefix on, it stops after a restart().
+        '''
+        with self.lock:
+            generation = self.generation
+            offset = self.hashed_to
+        while offset < end:
+            data = read(offset, min(self.READ_SIZE, end - offset))
+            if not data or not self.update_prefix(offset, data, generation):
+                break
+            with self.lock:
+                offset = self.hashed_to
+
+    def hash_missing_blocks(self, read):
+        '''
+        Read back the blocks of expected_blocks which have no hash yet, e.g.
+        ones received in parts by two connections, so they aren't taken as bad.
+        '''
+        if self.expected_blocks is None:
+            return
+        for block in range(len(self.expected_blocks)):
+            if block in self.received_hashes or block in self.file_hashes:
+                continue
+            start, end = self.block_range(block)
+            if start >= end:
+                break
+            block_hash = hashlib.new(self.block_algorithm)
+            while start < end:
+                data = read(start, min(self.READ_SIZE, end - start))
+                if not data:
+                    break
+                block_hash.update(data)
+                start += len(data)
+            with self.lock:
+                self.file_hashes[block] = block_hash.digest()
+
+    def matches(self):
+        self.checked = True
+        if self.expected is None:
+            return not self.bad_ranges()
+        with self.lock:
+            return self.file_hash.digest() == self.expected
+
+    def hexdigest(self):
+        with self.lock:
+            return self.file_hash.hexdigest()
+
+    def bad_ranges(self):
+        '''
+        Byte ranges of the blocks which don't match expected_blocks, as received
+        or read back. Neighbouring blocks are merged. Without expected_blocks
+        there is nothing to blame a mismatch on.
+        '''
+        ranges = []
+        if self.expected_blocks is None:
+            return ranges
+        for block, expected in enumerate(self.expected_blocks):
+            if self.received_hashes.get(block, self.file_hashes.get(block)) == expected:
+                continue
+            start, end = self.block_range(block)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def forget(self, start, end):
+        ''' The range is fetched again, drop what was recorded for its blocks. '''
+        for block in range(start // self.block_size, (end + self.block_size - 1) // self.block_size):
+            self.received_hashes.pop(block, None)
+            with self.lock:
+                self.file_hashes.pop(block, None)
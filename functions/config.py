@@ -2,6 +2,8 @@
 
 import re
 import socket
+import ssl
+import hashlib
 
 PYXEL_DEBUG = False
 
@@ -13,11 +15,15 @@ def is_filename_valid(file_name):
 class Config(object):
     # Max Http redirect
     __MAX_REDIRECT = 20
+    # Connections to start with when the number is found at runtime
+    __AUTO_START_CONNECTIONS = 2
     # Time out for select(), in seconds
     __DEFAULT_IO_TIMEOUT = 120
     # __DEFAULT_USER_AGENT = 'Mozilla/5.0 3578.98 Safari/537.36'
     __DEFAULT_USER_AGENT = 'Pyxel Linux (1.0)'
     AF_UNSPEC = socket.AF_UNSPEC
+    # ALPN protocols --tls-alpn may offer, the ones Http speaks
+    ALPN_PROTOCOLS = ('http/1.1', 'http/1.0')
 
     def __init__(self):
         self.default_filename = 'pyxel_gathering.bin'
@@ -28,24 +34,91 @@ class Config(object):
         # A list of domains that don't use proxies
         self.no_proxies = []
         self.strip_cgi_parameters = True
-        # Interval to save state file for downloading, in seconds
+        # Interval to save state file for downloading, in seconds, it's also
+        # saved whenever save_state_bytes more bytes are written
         self.save_state_interval = 10
+        self.save_state_bytes = 64 * 1024 * 1024
+        # Granularity of the completed-block bitmap in the state file
+        self.state_block_size = 64 * 1024
         self.connection_timeout = 45
         self.reconnect_delay = 20
         self.num_of_connections = 4
+        # With -n auto, connections are added while they raise the throughput
+        # by at least auto_connections_margin, up to max_auto_connections,
+        # see --auto-max
+        self.auto_connections = False
+        self.auto_connections_margin = 0.1
+        self.max_auto_connections = 16
         self.max_redirect = Config.__MAX_REDIRECT
         self.io_timeout = Config.__DEFAULT_IO_TIMEOUT
         self.buffer_size = 5120
+        # Move plain Http data from socket to file with splice(), Linux only
+        self.splice_transfer = False
+        # Expected (hashlib algorithm, digest) of the file, from --checksum or
+        # the response headers, verified in blocks of checksum_block_size
+        self.checksum = None
+        self.checksum_block_size = 1024 * 1024
+        # Reserve the whole output file before downloading
+        self.preallocate = True
+        # Receive straight into a memory mapping of the output file
+        self.mmap_output = False
+        # A writer thread writes the received data behind the download loop,
+        # collecting up to write_flush_size contiguous bytes of a connection
+        # per write and holding at most write_memory_limit bytes
+        self.write_behind = True
+        self.write_flush_size = 1024 * 1024
+        self.write_memory_limit = 64 * 1024 * 1024
+        # Host lookups are cached for dns_ttl seconds, and kept in
+        # dns_cache_file between runs if it's given
+        self.dns_ttl = 60
+        self.dns_cache_file = None
+        # Socket options, see SocketOptions. tcp_rcvbuf is SO_RCVBUF in bytes,
+        # 0 leaves it to the kernel, with tcp_rcvbuf_auto it's sized from the
+        # bandwidth-delay product, and so is buffer_size
+        self.tcp_rcvbuf = 0
+        self.tcp_rcvbuf_auto = False
+        self.tcp_nodelay = False
+        self.tcp_quickack = False
+        self.tcp_fastopen = False
+        # Keep Http sockets open between ranges, see ConnectionPool
+        self.keep_alive = True
+        # Ask for several small ranges in one request, the server sends them
+        # as a multipart/byteranges response
+        self.multi_range = True
+        # Batch mode: URLs are also read from input_file, the finished ones
+        # are recorded in batch_state_file, and the downloads in flight have
+        # at most max_connections connections, max_connections_per_host to a host
+        self.input_file = None
+        self.batch_state_file = None
+        # Metalink document whose files are downloaded, see Metalink
+        self.metalink = None
+        self.max_connections = 16
+        self.max_connections_per_host = 8
+        # Race the last ranges on two connections, the first one to finish wins
+        self.end_game = False
+        # Download engine, 'thread' or 'asyncio'
+        self.engine = 'thread'
         self.max_speed = 0
+        # Optional limit for each connection, and the bytes a token bucket may
+        # save up (0 means a quarter second worth of its rate)
+        self.max_speed_per_connection = 0
+        self.max_speed_burst = 0
         self.verbose = False
         self.alternate_output = False
         self.insecure = False
+        # OpenSSL cipher list and ALPN protocols offered by Tls connections
+        self.tls_ciphers = None
+        self.tls_alpn = None
         self.no_clobber = False
         self.ai_family = Config.AF_UNSPEC
         self.headers = {}
         self.set_header('User-Agent', self.__DEFAULT_USER_AGENT)
-        # A list of local interfaces, currently only use 1, i.e. the wireless card
-        self.interfaces = ['wlo1']
+        # Local interfaces to spread the connections over, none leaves the
+        # choice to the routing table
+        self.interfaces = []
+        # Other URLs of the same file, the connections are spread over all of
+        # them, see MirrorSet
+        self.mirrors = []
         self.standard_output = None
 
     def set_header(self, key, value):
@@ -55,9 +128,77 @@ class Config(object):
         if protocol.lower() == 'ipv4':
             self.ai_family = socket.AF_INET
         elif protocol.lower() == 'ipv6':
-            self.ai_family == socket.AF_INET6
+            self.ai_family = socket.AF_INET6
         else:
             raise Exception(f'Exception in {__name__}: unsupported protocol.')
 
-    def parse_interfaces(self):
-        pass
+    def set_num_of_connections(self, value):
+        if value.lower() == 'auto':
+            self.auto_connections = True
+            self.num_of_connections = Config.__AUTO_START_CONNECTIONS
+        else:
+            self.auto_connections = False
+            self.num_of_connections = int(value)
+
+    def set_engine(self, engine):
+        if engine.lower() in ('thread', 'asyncio'):
+            self.engine = engine.lower()
+        else:
+            raise Exception(f'Exception in {__name__}: unsupported engine, {engine}.')
+
+    def set_checksum(self, value):
+        ''' value looks like sha256:<hex digest> '''
+        algorithm, _, hex_digest = value.partition(':')
+        algorithm = algorithm.lower().replace('-', '')
+        if algorithm not in hashlib.algorithms_available:
+            raise Exception(f'Exception in {__name__}: unsupported checksum algorithm, {algorithm}.')
+        try:
+            digest = bytes.fromhex(hex_digest)
+        except ValueError:
+            raise Exception(f'Exception in {__name__}: invalid checksum, {hex_digest}.')
+        if len(digest) != hashlib.new(algorithm).digest_size:
+            raise Exception(f'Exception in {__name__}: wrong checksum length for {algorithm}.')
+        self.checksum = (algorithm, digest)
+
+    def set_tcp_rcvbuf(self, value):
+        ''' value is a size in bytes or auto '''
+        if value.lower() == 'auto':
+            self.tcp_rcvbuf_auto = True
+            self.tcp_rcvbuf = 0
+            return
+        try:
+            self.tcp_rcvbuf = int(value)
+        except ValueError:
+            raise Exception(f'Exception in {__name__}: invalid receive buffer size, {value}.')
+        if self.tcp_rcvbuf < 0:
+            raise Exception(f'Exception in {__name__}: invalid receive buffer size, {value}.')
+        self.tcp_rcvbuf_auto = False
+
+    def set_tls_ciphers(self, value):
+        try:
+            ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT).set_ciphers(value)
+        except ssl.SSLError:
+            raise Exception(f'Exception in {__name__}: no cipher matches {value}.')
+        self.tls_ciphers = value
+
+    def set_tls_alpn(self, value):
+        '''
+        value is a comma separated list, e.g. http/1.1. Only the protocols
+        the connections speak may be offered, a server could pick h2 otherwise.
+        '''
+        protocols = [protocol.strip() for protocol in value.split(',') if protocol.strip()]
+        for protocol in protocols:
+            if protocol not in Config.ALPN_PROTOCOLS:
+                raise Exception(f'Exception in {__name__}: unsupported ALPN protocol, {protocol}.')
+        self.tls_alpn = protocols or None
+
+    def parse_interfaces(self, value):
+        ''' value is an interface name or a comma separated list of them '''
+        for name in value.split(','):
+            name = name.strip()
+            if name and name not in self.interfaces:
+                self.interfaces.append(name)
+
+    def add_mirror(self, url):
+        if url not in self.mirrors:
+            self.mirrors.append(url)
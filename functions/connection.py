@@ -1,9 +1,12 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import os
 import sys
 import re
+import ssl
 import threading
+import fcntl
 from urllib.parse import urlparse
 
 from .tcp import Tcp
@@ -28,13 +31,24 @@ class Connection(object):
 
     MAX_FILESIZE = sys.maxsize
 
-    def __init__(self, ai_family, io_timeout, max_redirect, local_ifs=[]):
+    # Pipe capacity asked for when splicing, the kernel may give less
+    SPLICE_PIPE_SIZE = 1024 * 1024
+    DEFAULT_PIPE_SIZE = 65536
+
+    # Weight of the newest sample in the smoothed speed
+    SPEED_SMOOTHING = 0.3
+
+    def __init__(self, ai_family, io_timeout, max_redirect, local_ifs=None):
         self.ai_family = ai_family
         self.io_timeout = io_timeout
         self.max_redirect = max_redirect
 
-        # A list of local interface names
+        # Name of the local interface the connection is bound to, if any
         self.local_ifs = local_ifs
+        # Address family -> local address of that interface, see InterfaceSet
+        self.local_addresses = {}
+        # Mirror of the file the connection downloads from, see MirrorSet
+        self.mirror = None
         # Store the generated request message as a string
         self.request = None
         # Http status code
@@ -43,23 +57,64 @@ class Connection(object):
         self.output_filename = None
         # The tcp tunnel used by application layer
         self.tcp = Tcp()
+        # Resolver, TlsContext and SocketOptions shared by the connections of
+        # a Process, if any
+        self.resolver = None
+        self.tls = None
+        self.socket_options = None
 
         # Define and initialize all parts that constitute an URL 
         self.init_url_params()
 
         # Store the file size derived from response message
         self.file_size = None
+        # Expected (hashlib algorithm, digest) of the file, if the server tells
+        self.digest = None
+        # Validators of the file from the probe response
+        self.etag = None
+        self.last_modified = None
+        # Validator sent with If-Range, so a changed file isn't mixed with the old one
+        self.if_range = None
+        # Set when a response shows the file has changed on the server
+        self.remote_changed = False
         self.first_byte = None
         self.current_byte = None
         self.last_byte = None
+        # Offset in the file where the response body ends, if the socket can
+        # take the next request after it, see is_reusable()
+        self.response_end = None
+        # More ranges asked for in the same request, and set when the server
+        # answered them with something else than a multipart response
+        self.extra_ranges = []
+        self.extra_ranges_refused = False
         self.last_transfer = None
         self.lock = threading.Lock()
 
+        # Smoothed download speed in bytes per second, and the bytes written
+        # since speed_time, see update_speed()
+        self.speed = 0
+        self.speed_bytes = 0
+        self.speed_time = None
+        # Per connection token bucket, see Process.get_rate_limiters()
+        self.rate_limiter = None
+
         # When a connection is enabled, it means all data read from socket shall be written
         # into the file
         self.enabled = False
         # When a connection thread is about to run till it finishes its job, in_progress is True
         self.in_progress = False
+        # Set when the last setup didn't end with the connection enabled
+        self.setup_failed = False
+        # A retired connection is being removed and takes no more work
+        self.retired = False
+
+        # Reusable receive buffer, recv_data() fills it in place
+        self.data_buffer = None
+        self.data_view = None
+
+        # Pipe used to splice data from socket to file, (read end, write end)
+        self.splice_pipe = None
+        self.splice_pipe_size = 0
 
         # Store the thread reference when multi-threading
         self.setup_thread = None
@@ -96,16 +151,112 @@ class Connection(object):
     def get_socket_fd(self):
         return self.tcp.socket_fd
 
+    def is_reusable(self, position):
+        '''
+        True if everything up to position was read from the response and the
+        response ends there, so the next request can go on the same socket.
+        '''
+        return self.response_end is not None and position == self.response_end and self.is_connected()
+
+    def detach_socket(self):
+        ''' Give the connected socket away, e.g. to the ConnectionPool. '''
+        tcp = self.tcp
+        self.tcp = Tcp()
+        return tcp
+
+    def attach_socket(self, tcp):
+        self.tcp.close()
+        self.tcp = tcp
+
+    def set_blocking(self, blocking):
+        self.tcp.set_blocking(blocking)
+
+    def has_buffered_data(self):
+        '''
+        True if some data has been read from socket already, e.g. the body bytes
+        that came in with the response header. select() won't report them.
+        '''
+        return self.tcp.has_buffered_data()
+
     def recv_data(self, msg_size):
         '''
         Receive binary data from Tcp connection
         In Http, it's the binary data attached after Http response header
+        The data is received into the connection's own buffer and returned as a
+        memoryview, which is only valid until the next call.
         '''
+        if self.data_buffer is None or len(self.data_buffer) < msg_size:
+            self.data_buffer = bytearray(msg_size)
+            self.data_view = memoryview(self.data_buffer)
         try:
-            return self.tcp.recv(msg_size)
+            nbytes = self.tcp.recv_into(self.data_buffer, msg_size)
+        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            # Nothing to read yet, e.g. only a part of a Tls record is in.
+            raise
         except Exception as e:
             sys.stderr.write(f'Exception in {__name__}: {e.args[-1]}\n')
-            return b''
+            nbytes = 0
+        return self.data_view[:nbytes]
+
+    def recv_data_into(self, buffer):
+        '''
+        Same as recv_data(), but receive into the given buffer, e.g. a part of
+        the memory-mapped output file. Return the number of bytes received.
+        '''
+        try:
+            return self.tcp.recv_into(buffer, len(buffer))
+        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            raise
+        except Exception as e:
+            sys.stderr.write(f'Exception in {__name__}: {e.args[-1]}\n')
+            return 0
+
+    def swap_data_buffer(self, data_buffer):
+        '''
+        Hand the receive buffer over, e.g. to the writer, and receive into
+        data_buffer from now on. Return the old buffer.
+        '''
+        old_buffer = self.data_buffer
+        self.data_buffer = data_buffer
+        self.data_view = memoryview(data_buffer)
+        return old_buffer
+
+    def get_splice_pipe(self):
+        ''' The pipe is kept across reconnects, close_splice_pipe() releases it. '''
+        if self.splice_pipe is None:
+            self.splice_pipe = os.pipe()
+            try:
+                self.splice_pipe_size = fcntl.fcntl(
+                    self.splice_pipe[1], fcntl.F_SETPIPE_SZ, self.SPLICE_PIPE_SIZE
+                )
+            except (OSError, AttributeError):
+                self.splice_pipe_size = self.DEFAULT_PIPE_SIZE
+        return self.splice_pipe
+
+    def close_splice_pipe(self):
+        if self.splice_pipe is not None:
+            os.close(self.splice_pipe[0])
+            os.close(self.splice_pipe[1])
+            self.splice_pipe = None
+
+    def update_speed(self, now):
+        ''' Fold the bytes written since the last call into the smoothed speed. '''
+        if self.enabled and self.speed_time is not None and now > self.speed_time:
+            sample = self.speed_bytes / (now - self.speed_time)
+            if self.speed == 0:
+                self.speed = sample
+            else:
+                self.speed += self.SPEED_SMOOTHING * (sample - self.speed)
+        self.speed_bytes = 0
+        self.speed_time = now
+
+    def is_metalink(self):
+        ''' True if the response is a Metalink document rather than the file, see Http. '''
+        return False
+
+    def is_multipart(self):
+        ''' True if the ranges come as the parts of one response, see Http. '''
+        return False
 
     def is_secure_scheme(self):
         return (self.scheme == self.HTTPS) or (self.scheme == self.FTPS)
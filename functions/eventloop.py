@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import heapq
+import select
+import selectors
+from collections import deque
+
+class EventLoop(object):
+    '''
+    Wait on the sockets of enabled connections with selectors.DefaultSelector,
+    which is epoll on Linux.
+    A connection is registered once when its setup is finished and unregistered
+    when it's disconnected, so each poll() only costs the ready connections.
+    Connections are known by their index in Process.conns.
+    '''
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        # Connection index -> socket registered for it
+        self.registered = {}
+        # Bumped on every registration, heap entries from an older one are ignored
+        self.generations = {}
+        # Heap of (deadline, index, generation) for connection timeouts
+        self.deadlines = []
+        # Connections holding buffered data, select() can't see those bytes
+        self.pending = set()
+        # Connections taken off the selector by the rate limiter:
+        # index -> (resume time, buffered data), and a heap of (resume time, index)
+        self.paused = {}
+        self.resumes = []
+
+        # Setup threads hand finished connections over through this queue, and
+        # wake poll() up by writing to the pipe.
+        self.setup_done = deque()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+
+    def close(self):
+        self.selector.close()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+    def notify(self, i):
+        ''' Called by a setup thread when connection i is ready for data. '''
+        self.setup_done.append(i)
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_w, b'\0')
+        except BlockingIOError:
+            # The pipe is full, poll() will wake up anyway.
+            pass
+
+    def take_setup_done(self):
+        done = []
+        while self.setup_done:
+            done.append(self.setup_done.popleft())
+        return done
+
+    def is_registered(self, i):
+        return i in self.registered
+
+    def register(self, i, sock, deadline):
+        self.unregister(i)
+        self.selector.register(sock, selectors.EVENT_READ, i)
+        self.registered[i] = sock
+        self.generations[i] = self.generations.get(i, 0) + 1
+        self.add_deadline(i, deadline)
+
+    def unregister(self, i):
+        sock = self.registered.pop(i, None)
+        if self.paused.pop(i, None) is not None:
+            # Not on the selector while paused.
+            sock = None
+        if sock is not None:
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                # The socket might be closed already.
+                pass
+        self.pending.discard(i)
+
+    def mark_pending(self, i):
+        self.pending.add(i)
+
+    def pause(self, i, until, has_buffered_data):
+        ''' Stop watching connection i until the given time. '''
+        sock = self.registered.get(i)
+        if sock is None or i in self.paused:
+            return
+        self.selector.unregister(sock)
+        self.pending.discard(i)
+        self.paused[i] = (until, has_buffered_data)
+        heapq.heappush(self.resumes, (until, i))
+
+    def resume_due(self, now):
+        while self.resumes and self.resumes[0][0] <= now:
+            until, i = heapq.heappop(self.resumes)
+            if i not in self.paused or self.paused[i][0] != until:
+                continue
+            _, has_buffered_data = self.paused.pop(i)
+            self.selector.register(self.registered[i], selectors.EVENT_READ, i)
+            if has_buffered_data:
+                self.pending.add(i)
+
+    def add_deadline(self, i, deadline):
+        heapq.heappush(self.deadlines, (deadline, i, self.generations[i]))
+
+    def next_deadline(self):
+        ''' The earliest connection timeout or resume time. '''
+        deadlines = [heap[0][0] for heap in (self.deadlines, self.resumes) if heap]
+        if deadlines:
+            return min(deadlines)
+        return None
+
+    def pop_expired(self, now):
+        ''' Return connections whose deadline has passed, stale entries are dropped. '''
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, i, generation = heapq.heappop(self.deadlines)
+            if i in self.registered and self.generations[i] == generation:
+                expired.append(i)
+        return expired
+
+    def poll(self, timeout, now):
+        ''' Wait up to timeout seconds, return the indexes of connections ready to read. '''
+        self.resume_due(now)
+        if self.pending:
+            timeout = 0
+        ready = self.pending
+        self.pending = set()
+        for key, _ in self.selector.select(max(timeout, 0)):
+            if key.data is None:
+                self.drain_wakeup()
+            else:
+                ready.add(key.data)
+        return ready
+
+    def wait_wakeup(self, timeout):
+        '''
+        Wait up to timeout seconds without looking at the connections, e.g. when the
+        rate limiter has no tokens left. Finished setups still wake it up.
+        '''
+        readables, _, _ = select.select([self.wakeup_r], [], [], max(timeout, 0))
+        if readables:
+            self.drain_wakeup()
+
+    def drain_wakeup(self):
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
@@ -42,7 +42,10 @@ class Ftp(Connection):
             self.is_secure_scheme(),
             self.ai_family,
             self.io_timeout,
-            self.local_ifs):
+            self.local_addresses,
+            self.resolver,
+            self.tls,
+            self.socket_options):
             return False
         if self.is_wait_nok(2):
             return False
@@ -86,7 +89,8 @@ class Ftp(Connection):
             self.is_secure_scheme(),
             self.ai_family,
             self.io_timeout,
-            self.local_ifs)
+            self.local_addresses,
+            socket_options=self.socket_options)
 
     def disconnect(self):
         self.tcp.close()
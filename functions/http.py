@@ -6,24 +6,53 @@ import base64
 import re
 
 from .connection import Connection
+from .metalink import Metalink
 
 from .config import PYXEL_DEBUG
 from .config import is_filename_valid
 
+class HttpHeaders(dict):
+    '''
+    Response headers keyed by lower-cased field names, so lookups don't
+    depend on how the server spells them.
+    '''
+    def __setitem__(self, key, value):
+        super(HttpHeaders, self).__setitem__(key.lower(), value)
+
+    def __getitem__(self, key):
+        return super(HttpHeaders, self).__getitem__(key.lower())
+
+    def __contains__(self, key):
+        return super(HttpHeaders, self).__contains__(key.lower())
+
+    def get(self, key, default=None):
+        return super(HttpHeaders, self).get(key.lower(), default)
+
 class Http(Connection):
+    HEADER_END = b'\r\n\r\n'
+    # Digest header algorithm names (RFC 3230) -> hashlib names
+    DIGEST_ALGORITHMS = {'md5': 'md5', 'sha': 'sha1', 'sha-256': 'sha256', 'sha-512': 'sha512'}
+
     def __init__(
         self,
         ai_family, io_timeout, max_redirect, request_headers={},
-        http_proxy=None, no_proxies=None, local_ifs=None):
+        http_proxy=None, no_proxies=None, local_ifs=None, keep_alive=False):
         super(Http, self).__init__(ai_family, io_timeout, max_redirect, local_ifs)
+        # Send HTTP/1.1 requests and keep the socket for the next range
+        self.keep_alive = keep_alive
         self.http_proxy = http_proxy
         self.no_proxies = no_proxies
         self.http_basic_auth = None
         self.use_http_proxy = True
         self.response = None
         self.request_headers = request_headers
-        self.response_headers = {}
+        self.response_headers = HttpHeaders()
         self.resuming_supported = False
+        # Delimiter of the parts of a multipart/byteranges response, the
+        # ranges its parts have to be, and where the current part ends
+        self.multipart_boundary = None
+        self.parts = []
+        self.part_end = None
 
     def check_if_no_proxy(self):
         '''
@@ -51,7 +80,10 @@ class Http(Connection):
             self.is_secure_scheme(),
             self.ai_family,
             self.io_timeout,
-            self.local_ifs):
+            self.local_addresses,
+            self.resolver,
+            self.tls,
+            self.socket_options):
             return False
         self.http_basic_auth = None
         if user and password:
@@ -59,6 +91,7 @@ class Http(Connection):
         return True
 
     def disconnect(self):
+        self.multipart_boundary = None
         self.tcp.close()
 
     def connection_init(self):
@@ -73,6 +106,8 @@ class Http(Connection):
         self.first_byte = -1
         if self.resuming_supported:
             self.first_byte = self.current_byte
+        self.status_code = None
+        self.extra_ranges_refused = False
         self.build_basic_get()
         self.http_additional_headers()
         return True
@@ -83,13 +118,22 @@ class Http(Connection):
         while True:
             self.resuming_supported = True
             self.current_byte = 0
-            if not self.request_setup() or not self.execute_req_resp():
-                return False
-            self.disconnect()
+            self.last_byte = 0
+            keep_alive = self.keep_alive
+            # A redirect isn't a usable response, it's followed below.
+            if (not self.request_setup() or not self.execute_req_resp()) and not self.is_redirect():
+                if not keep_alive or self.keep_alive:
+                    return False
+                # The response was chunked, ask again with HTTP/1.0.
+                self.disconnect()
+                if not self.connection_init():
+                    return False
+                continue
             self.set_filename_from_response()
             # Code 3xx == redirect.
             if self.status_code // 100 != 3:
                 break
+            self.disconnect()
             # Following code needs to be tested thoroughly.
             redirect_count += 1
             if redirect_count > self.max_redirect:
@@ -103,11 +147,20 @@ class Http(Connection):
             if self.get_scheme_from_url(redirect_url) in (self.FTP, self.FTPS):
                 self.redirect_to_ftp = True
                 return True
+            if not self.connection_init():
+                return False
         # Check for non-recoverable errors.
         if self.status_code != 416 and self.status_code // 100 != 2:
+            self.disconnect()
             return False
-        if self.set_filesize():
+        self.digest = self.get_digest_from_response()
+        self.etag = self.response_headers.get('ETag')
+        self.last_modified = self.response_headers.get('Last-Modified')
+        if self.status_code // 100 == 2 and self.set_filesize():
+            # The body from byte 0 follows, so the connection is left open,
+            # see Process.can_use_probe_response().
             return True
+        self.disconnect()
         return False
 
     def execute_req_resp(self):
@@ -129,37 +182,150 @@ class Http(Connection):
         return True
 
     def recv_get_response(self):
-        # Read the headers byte by byte.
-        first_newline = True
-        self.response = ''
-        while True:
-            try:
-                recv_char = self.tcp.recv(1).decode('utf-8')
-            except Exception as e:
-                sys.stderr.write(f'{e.args[-1]}\n')
-                return False
-            if recv_char == '\r':
-                continue
-            elif recv_char == '\n':
-                if not first_newline:
-                    break
-                else:
-                    first_newline = False
-            else:
-                first_newline = True
-            self.response += recv_char
+        # Read the whole header in big blocks, body bytes that come along are
+        # kept by Tcp and delivered first by recv_data().
+        try:
+            header = self.tcp.recv_until(self.HEADER_END)
+        except Exception as e:
+            sys.stderr.write(f'{e.args[-1]}\n')
+            return False
+        if header is None:
+            sys.stderr.write('Connection closed before the response header was complete.\n')
+            return False
+        self.response = header.decode('iso-8859-1')
         if PYXEL_DEBUG:
             sys.stderr.write('--- Reply headers ---\n')
             sys.stderr.write(self.response)
             sys.stderr.write('--- End of headers ---\n')
-        response_lines = self.response.split('\n')
-        self.status_code = int(response_lines[0].split(' ')[1])
-        for line in response_lines[1:]:
-            if line == '':
+        try:
+            self.status_code, self.response_headers = self.parse_response_header(header)
+        except ValueError:
+            sys.stderr.write(f'Invalid response header.\n{self.response}')
+            return False
+        self.multipart_boundary = self.get_multipart_boundary()
+        self.response_end = self.get_response_end()
+        if not self.is_response_usable():
+            return False
+        return not self.is_multipart() or self.recv_part_header()
+
+    def recv_part_header(self):
+        ''' Read the header of the next part of a multipart/byteranges response. '''
+        try:
+            header = self.tcp.recv_until(self.HEADER_END)
+        except Exception as e:
+            sys.stderr.write(f'{e.args[-1]}\n')
+            return False
+        if header is None:
+            sys.stderr.write('Connection closed before the part header was complete.\n')
+            return False
+        return self.check_part_header(header)
+
+    def is_multipart(self):
+        return self.multipart_boundary is not None and self.is_connected()
+
+    def get_multipart_boundary(self):
+        '''
+        Example: Content-Type: multipart/byteranges; boundary=THIS_STRING_SEPARATES
+        A server may answer a request for several ranges with one.
+        '''
+        media_type, _, params = self.response_headers.get('Content-Type', '').partition(';')
+        if self.status_code != 206 or media_type.strip().lower() != 'multipart/byteranges':
+            return None
+        for param in params.split(';'):
+            key, sep, value = param.partition('=')
+            if sep and key.strip().lower() == 'boundary':
+                return value.strip().strip('"').encode('iso-8859-1')
+        return None
+
+    def check_part_header(self, header):
+        '''
+        The part has to be the next range asked for, the data goes where the
+        connection's range is. A server may merge or reorder ranges, that's
+        not followed, the remaining ranges are asked for one by one then.
+        '''
+        part_range = self.parse_part_header(header, self.multipart_boundary)
+        if part_range is None:
+            sys.stderr.write('Invalid part header in the multipart response.\n')
+            return False
+        expected = self.parts.pop(0) if self.parts else None
+        if part_range != expected:
+            sys.stderr.write(f'The server sent the part {part_range[0]}-{part_range[1]} out of order.\n')
+            self.extra_ranges_refused = True
+            return False
+        self.part_end = part_range[1]
+        return True
+
+    @staticmethod
+    def parse_part_header(header, boundary):
+        '''
+        A part header is the delimiter line, --boundary, and its header fields,
+        after the CRLF ending the previous part.
+        Return the part's (start, end) with end exclusive, or None.
+        '''
+        lines = header.split(b'\r\n')
+        delimiter = b''.join([b'--', boundary])
+        if delimiter not in lines:
+            return None
+        for line in lines[lines.index(delimiter) + 1:]:
+            key, sep, value = line.partition(b':')
+            if not sep or key.strip().lower() != b'content-range':
                 continue
-            [key, value] = line.split(': ')
-            self.response_headers[key] = value
-        return self.status_code // 100 == 2
+            match = re.match(rb'^bytes ([0-9]+)-([0-9]+)/', value.strip())
+            if match is None:
+                return None
+            return int(match.group(1)), int(match.group(2)) + 1
+        return None
+
+    def get_response_end(self):
+        '''
+        The socket can take another request after this response if the server
+        keeps it open: HTTP/1.1 without Connection: close, or HTTP/1.0 with
+        Connection: keep-alive, and the body length is known.
+        '''
+        if not self.keep_alive:
+            return None
+        connection = self.response_headers.get('Connection', '').lower()
+        if self.response.startswith('HTTP/1.0'):
+            if 'keep-alive' not in connection:
+                return None
+        elif 'close' in connection:
+            return None
+        if 'Transfer-Encoding' in self.response_headers or self.multipart_boundary is not None:
+            return None
+        content_length = self.get_size_from_length()
+        if content_length < 0:
+            return None
+        return max(self.first_byte, 0) + content_length
+
+    def is_redirect(self):
+        return self.status_code is not None and self.status_code // 100 == 3
+
+    def is_chunked(self):
+        return 'chunked' in self.response_headers.get('Transfer-Encoding', '').lower()
+
+    @staticmethod
+    def parse_response_header(header):
+        '''
+        Parse the status line and header fields, header is the raw bytes ending with an empty line.
+        Status-Line = HTTP-Version SP Status-Code SP Reason-Phrase CRLF
+        Repeated fields are combined into one, separated by comma.
+        '''
+        lines = header.split(b'\r\n')
+        status_line = lines[0].split(b' ', 2)
+        if len(status_line) < 2 or not status_line[0].startswith(b'HTTP/'):
+            raise ValueError('Invalid status line.')
+        status_code = int(status_line[1])
+        response_headers = HttpHeaders()
+        for line in lines[1:]:
+            key, sep, value = line.partition(b':')
+            if not sep:
+                continue
+            key = key.strip().decode('iso-8859-1')
+            value = value.strip().decode('iso-8859-1')
+            if key in response_headers:
+                value = ', '.join([response_headers[key], value])
+            response_headers[key] = value
+        return status_code, response_headers
 
     def basic_auth_token(self, user, password):
         self.http_basic_auth = base64.b64encode(f'{user}:{password}').strip()
@@ -171,13 +337,23 @@ class Http(Connection):
             self.add_header(f'Authorization: Basic {self.http_basic_auth}')
         self.add_header('Accept: */*')
         self.add_range_header()
+        if self.if_range is not None:
+            self.add_header(f'If-Range: {self.if_range}')
 
     def add_range_header(self):
+        '''
+        last_byte is exclusive, the Range header is inclusive. Asking for exactly
+        the range lets the response end where the range does, so a keep-alive
+        socket is ready for the next request then.
+        '''
         if self.first_byte < 0 or self.last_byte < 0:
             raise Exception(f'first_byte and last_byte must be >= 0, actual value is {self.first_byte}-{self.last_byte}')
         if self.last_byte > 0:
-            self.add_header('Range: bytes={}-{}'.format(self.first_byte, self.last_byte))
+            # Extra ranges come as later parts of a multipart response.
+            self.parts = [(self.first_byte, self.last_byte)] + list(self.extra_ranges)
+            self.add_header('Range: bytes={}'.format(','.join(f'{start}-{end - 1}' for start, end in self.parts)))
         else:
+            self.parts = []
             self.add_header('Range: bytes={}-'.format(self.first_byte))
 
     def add_request_line(self):
@@ -186,20 +362,25 @@ class Http(Connection):
         protocol version, and ending with CRLF. The elements are separated by space SP
         characters.
         Request-Line = Method SP Request-URI SP HTTP-Version CRLF.
+        HTTP/1.1 connections are persistent unless a side says otherwise.
         '''
+        version = 'HTTP/1.1' if self.keep_alive else 'HTTP/1.0'
         if self.http_proxy:
             proto_str = self.get_scheme_str(self.scheme)
             if Http.is_default_port(self.scheme, self.port):
                 get_str = ''.join([proto_str, self.host, self.filedir, self.filename])
             else:
-                get_str = ''.join([proto_str, self.host, ':', self.port, self.filedir, self.filename])
-            self.add_header(f'GET {get_str} HTTP/1.0')
+                get_str = ''.join([proto_str, self.host, ':', str(self.port), self.filedir, self.filename])
+            self.add_header(f'GET {get_str} {version}')
         else:
-            self.add_header(f'GET {self.filedir}{self.filename} HTTP/1.0')
-            if Http.is_default_port(self.scheme, self.port):
-                self.add_header(f'Host: {self.host}')
-            else:
-                self.add_header(f'Host: {self.host}:{self.port}')
+            self.add_header(f'GET {self.filedir}{self.filename} {version}')
+        if self.http_proxy and not self.keep_alive:
+            return
+        # HTTP/1.1 needs Host, also through a proxy.
+        if Http.is_default_port(self.scheme, self.port):
+            self.add_header(f'Host: {self.host}')
+        else:
+            self.add_header(f'Host: {self.host}:{self.port}')
 
     def http_additional_headers(self):
         for key, value in self.request_headers.items():
@@ -228,44 +409,106 @@ class Http(Connection):
         '''
         Example: Content-Disposition: attachment; filename="filename.jpg"
         '''
-        if not 'Content-Disposition' in self.response_headers:
-            content_disposition = 'Content-Disposition'
-        elif not 'content-disposition' in self.response_headers:
-            content_disposition = 'content-disposition'
-        else:
+        content_disposition = self.response_headers.get('Content-Disposition')
+        if content_disposition is None:
             return
 
-        filename = re.compile(
+        filenames = re.compile(
             '^.*filename=[\'\"](.*)[\'\"]$'
-        ).findall(self.response_headers[content_disposition])[0]
+        ).findall(content_disposition)
+        if not filenames:
+            return
+        filename = filenames[0]
         # Replace common invalid characters in filename
         # https://en.wikipedia.org/wiki/Filename#Reserved_characters_and_words
         for char in '/\\?%*:|<>':
-            filename = filename.replace('_', char)
-            if not is_filename_valid(filename):
-                raise Exception(f'The filename is still not valid. {filename}')
+            filename = filename.replace(char, '_')
+        if not is_filename_valid(filename):
+            raise Exception(f'The filename is still not valid. {filename}')
         if filename:
             self.output_filename = filename
 
+    def is_metalink(self):
+        content_type = self.response_headers.get('Content-Type', '')
+        return content_type.split(';')[0].strip().lower() == Metalink.CONTENT_TYPE
+
     def get_size_from_length(self):
-        if 'Content-Length' in self.response_headers:
-            content_length = 'Content-Length'
-        elif 'content-length' in self.response_headers:
-            content_length = 'content-length'
-        else:
+        content_length = self.response_headers.get('Content-Length')
+        if content_length is None:
             return -1
-        return int(self.response_headers[content_length])
+        return int(content_length)
 
     def get_size_from_range(self):
-        if 'Content-Range' in self.response_headers:
-            content_range = 'Content-Range'
-        elif 'content-range' in self.response_headers:
-            content_range = 'content-range'
-        else:
+        content_range = self.response_headers.get('Content-Range')
+        if content_range is None:
             return -1
-        filesize = re.compile('^.*/([0-9]*)$').findall(self.response_headers[content_range])[0]
+        filesize = re.compile('^.*/([0-9]*)$').findall(content_range)[0]
         return int(filesize)
 
+    def get_start_from_range(self):
+        ''' Example: Content-Range: bytes 21010-47021/47022 '''
+        content_range = self.response_headers.get('Content-Range')
+        if content_range is None:
+            return -1
+        starts = re.compile('^bytes ([0-9]+)-').findall(content_range.strip())
+        return int(starts[0]) if starts else -1
+
+    def is_response_usable(self):
+        '''
+        A 200 answer to a range request carries the file from its start.
+        With If-Range, it means the file has changed on the server.
+        '''
+        if self.status_code // 100 != 2:
+            return False
+        if self.is_chunked():
+            # Only a plain body can be written out as it comes, HTTP/1.0 gets one.
+            sys.stderr.write('The server sent a chunked response, asking with HTTP/1.0 next time.\n')
+            self.keep_alive = False
+            return False
+        if self.status_code == 200 and self.if_range is not None:
+            sys.stderr.write('The file has changed on the server.\n')
+            self.remote_changed = True
+            return False
+        if self.extra_ranges and self.multipart_boundary is None:
+            # One range or the whole file, the others are asked for one by one.
+            self.extra_ranges_refused = True
+        if self.status_code == 200 and self.first_byte > 0:
+            sys.stderr.write('The server ignored the range request.\n')
+            return False
+        if self.status_code == 206 and self.multipart_boundary is None and self.first_byte >= 0 \
+            and self.get_start_from_range() not in (-1, self.first_byte):
+            sys.stderr.write('The server sent another range than the one asked for.\n')
+            return False
+        return True
+
+    def get_digest_from_response(self):
+        '''
+        Example: Digest: SHA-256=X48E9qOokqqrvdts8nOJRJN3OWDUoyWxBf7kbu9DBPE=
+        Digest is about the whole file, the strongest known algorithm is taken.
+        Content-MD5 is about the body at hand, so it only counts for a 200 response.
+        Return (hashlib algorithm, digest) or None.
+        '''
+        digests = {}
+        for instance in self.response_headers.get('Digest', '').split(','):
+            name, _, value = instance.strip().partition('=')
+            algorithm = self.DIGEST_ALGORITHMS.get(name.lower())
+            if algorithm is None:
+                continue
+            try:
+                digests[algorithm] = base64.b64decode(value, validate=True)
+            except ValueError:
+                continue
+        for algorithm in ('sha512', 'sha256', 'sha1', 'md5'):
+            if algorithm in digests:
+                return algorithm, digests[algorithm]
+        content_md5 = self.response_headers.get('Content-MD5')
+        if content_md5 is not None and self.status_code == 200:
+            try:
+                return 'md5', base64.b64decode(content_md5, validate=True)
+            except ValueError:
+                pass
+        return None
+
     def get_redirect_url_from_response(self):
         '''
         For example,
@@ -295,9 +538,4 @@ class Http(Connection):
             return redirect_url
 
     def get_location_from_response(self):
-        if 'location' in self.response_headers:
-            return self.response_headers['location']
-        elif 'Location' in self.response_headers['Location']:
-            return self.response_headers['Location']
-        else:
-            return None
+        return self.response_headers.get('Location')
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import socket
+import psutil
+
+class InterfaceSet(object):
+    '''
+    The local interfaces given with --interface, the connections of a Process
+    are bound to them. Their addresses are looked up once, names without an
+    address are left out.
+    New connections go to the interfaces in proportion to the throughput
+    measured on each, evenly until there is one. When a range is split, an
+    interface's throughput per connection stands for the speed of its
+    connections, see get_connection_speed().
+    '''
+    def __init__(self, names):
+        # Name -> {address family: address}
+        self.addresses = self.lookup_addresses(names) if names else {}
+        self.missing = [name for name in names if not self.addresses.get(name)]
+        self.names = [name for name in names if self.addresses.get(name)]
+        # Name -> bytes per second of its enabled connections at the last update
+        self.throughput = {name: 0 for name in self.names}
+        # Name -> number of its enabled connections at the last update
+        self.active = {name: 0 for name in self.names}
+
+    @staticmethod
+    def lookup_addresses(names):
+        ''' The first address of each family, link-local IPv6 ones only if there is nothing else. '''
+        if_addrs = psutil.net_if_addrs()
+        addresses = {}
+        for name in names:
+            by_family = {}
+            for item in if_addrs.get(name, []):
+                if item.family not in (socket.AF_INET, socket.AF_INET6):
+                    continue
+                is_link_local = item.address.lower().startswith('fe80')
+                if item.family not in by_family or (by_family[item.family][1] and not is_link_local):
+                    by_family[item.family] = item.address, is_link_local
+            addresses[name] = {family: address for family, (address, _) in by_family.items()}
+        return addresses
+
+    def get_addresses(self, name):
+        return self.addresses.get(name, {})
+
+    def pick(self, conns):
+        ''' The interface for a new connection, given the existing ones, None if there is no choice. '''
+        if not self.names:
+            return None
+        counts = {name: 0 for name in self.names}
+        for conn in conns:
+            if conn.local_ifs in counts:
+                counts[conn.local_ifs] += 1
+        total = sum(self.throughput.values())
+
+        def get_load(name):
+            if total == 0:
+                return counts[name]
+            if self.throughput[name] == 0:
+                return float('inf')
+            return (counts[name] + 1) * total / self.throughput[name]
+
+        return min(self.names, key=lambda name: (get_load(name), self.names.index(name)))
+
+    def update(self, conns):
+        ''' Sum the speeds of the enabled connections of each interface. '''
+        throughput = {name: 0 for name in self.names}
+        active = {name: 0 for name in self.names}
+        for conn in conns:
+            if conn.enabled and conn.local_ifs in throughput:
+                throughput[conn.local_ifs] += conn.speed
+                active[conn.local_ifs] += 1
+        for name in self.names:
+            # An interface with no connection at the moment keeps its last figures.
+            if active[name] > 0:
+                self.throughput[name] = throughput[name]
+                self.active[name] = active[name]
+
+    def get_connection_speed(self, conn):
+        '''
+        The expected speed of conn: its interface's throughput per connection,
+        which is known even for a connection that just started.
+        '''
+        if len(self.names) < 2 or not self.active.get(conn.local_ifs):
+            return conn.speed
+        return self.throughput[conn.local_ifs] / self.active[conn.local_ifs]
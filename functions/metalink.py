@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import xml.etree.ElementTree as ElementTree
+
+class MetalinkFile(object):
+    '''
+    One file of a Metalink document. urls are sorted by priority, the best
+    one first. hash is (hashlib algorithm, digest) of the whole file, and
+    pieces are the digests of its piece_length byte pieces.
+    '''
+    def __init__(self, name, size=None, urls=None, hash=None, piece_length=None, piece_algorithm=None, pieces=None):
+        self.name = name
+        self.size = size
+        self.urls = urls or []
+        self.hash = hash
+        self.piece_length = piece_length
+        self.piece_algorithm = piece_algorithm
+        self.pieces = pieces
+
+class Metalink(object):
+    '''
+    A Metalink version 4 document, RFC 5854: the files it lists, their size,
+    mirrors and hashes. Only the Http URLs are kept, the mirrors of a file
+    have to be of one kind, and metaurls point at other kinds of downloads,
+    e.g. torrents.
+    '''
+    CONTENT_TYPE = 'application/metalink4+xml'
+    NAMESPACE = '{urn:ietf:params:xml:ns:metalink}'
+    # IANA hash names -> hashlib algorithms, strongest first
+    HASH_TYPES = {'sha-512': 'sha512', 'sha-384': 'sha384', 'sha-256': 'sha256', 'sha-1': 'sha1', 'md5': 'md5'}
+    # A url without a priority comes after the ones with one
+    LOWEST_PRIORITY = 999999
+    # Largest document read from a Http response
+    MAX_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, files):
+        self.files = files
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as file_obj:
+            return cls.parse(file_obj.read())
+
+    @classmethod
+    def parse(cls, data):
+        try:
+            root = ElementTree.fromstring(data)
+        except ElementTree.ParseError as e:
+            raise Exception(f'Exception in {__name__}: invalid Metalink document, {e.args[-1]}.')
+        if root.tag != cls.NAMESPACE + 'metalink':
+            raise Exception(f'Exception in {__name__}: not a Metalink 4 document.')
+        files = []
+        for element in root.findall(cls.NAMESPACE + 'file'):
+            metalink_file = cls.parse_file(element)
+            if metalink_file.urls:
+                files.append(metalink_file)
+        if not files:
+            raise Exception(f'Exception in {__name__}: the Metalink document has no file to download.')
+        return cls(files)
+
+    @classmethod
+    def parse_file(cls, element):
+        # The name may have directories in it, only the last part is used.
+        name = os.path.basename(element.get('name', '').replace('\\', '/'))
+        if name in ('', '.', '..'):
+            raise Exception(f'Exception in {__name__}: invalid file name in the Metalink document.')
+        metalink_file = MetalinkFile(name)
+        size = element.findtext(cls.NAMESPACE + 'size')
+        if size is not None:
+            metalink_file.size = cls.parse_int(size)
+        metalink_file.hash = cls.pick_hash(element.findall(cls.NAMESPACE + 'hash'))
+        cls.parse_pieces(element.findall(cls.NAMESPACE + 'pieces'), metalink_file)
+        urls = []
+        for url_element in element.findall(cls.NAMESPACE + 'url'):
+            url = (url_element.text or '').strip()
+            if not url.lower().startswith(('http://', 'https://')):
+                continue
+            priority = url_element.get('priority')
+            priority = cls.parse_int(priority) if priority is not None else cls.LOWEST_PRIORITY
+            urls.append((priority, len(urls), url))
+        metalink_file.urls = [url for _, _, url in sorted(urls)]
+        return metalink_file
+
+    @classmethod
+    def pick_hash(cls, elements):
+        ''' The (algorithm, digest) of the strongest known hash type, or None. '''
+        hashes = {}
+        for element in elements:
+            algorithm = cls.HASH_TYPES.get(element.get('type', '').lower())
+            if algorithm is not None:
+                hashes[algorithm] = cls.parse_hex(element.text)
+        for algorithm in cls.HASH_TYPES.values():
+            if algorithm in hashes:
+                return algorithm, hashes[algorithm]
+        return None
+
+    @classmethod
+    def parse_pieces(cls, elements, metalink_file):
+        ''' Take the piece hashes of the strongest known hash type. '''
+        by_algorithm = {}
+        for element in elements:
+            algorithm = cls.HASH_TYPES.get(element.get('type', '').lower())
+            if algorithm is None:
+                continue
+            length = cls.parse_int(element.get('length', ''))
+            if length <= 0:
+                raise Exception(f'Exception in {__name__}: invalid piece length in the Metalink document.')
+            digests = [cls.parse_hex(hash_element.text) for hash_element in element.findall(cls.NAMESPACE + 'hash')]
+            by_algorithm[algorithm] = length, digests
+        for algorithm in cls.HASH_TYPES.values():
+            if algorithm in by_algorithm:
+                metalink_file.piece_algorithm = algorithm
+                metalink_file.piece_length, metalink_file.pieces = by_algorithm[algorithm]
+                return
+
+    @staticmethod
+    def parse_int(text):
+        try:
+            return int(text.strip())
+        except ValueError:
+            raise Exception(f'Exception in {__name__}: invalid number in the Metalink document, {text}.')
+
+    @staticmethod
+    def parse_hex(text):
+        try:
+            return bytes.fromhex((text or '').strip())
+        except ValueError:
+            raise Exception(f'Exception in {__name__}: invalid hash in the Metalink document, {text}.')
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import threading
+
+class Mirror(object):
+    '''
+    One URL of the file. if_range is the mirror's own validator, mirrors
+    seldom agree on ETags, so each one is only checked against itself.
+    '''
+    def __init__(self, url, primary=False):
+        self.url = url
+        self.primary = primary
+        self.if_range = None
+        self.dropped = False
+        # Bytes per second of its enabled connections at the last update, and
+        # how many there were
+        self.throughput = 0
+        self.active = 0
+        # Smoothed share of failed connections, and the failures in a row
+        self.error_rate = 0
+        self.failures = 0
+
+    def is_measured(self):
+        return self.active > 0
+
+class MirrorSet(object):
+    '''
+    The URL a download started with, the primary, and the other URLs of the
+    same file given with --mirror. Process.check_mirrors() leaves out the
+    ones which don't have the file the primary has.
+    A connection about to connect goes to the mirror picked for it: the
+    mirrors take connections in proportion to their score, their throughput
+    less their error rate, a mirror not measured yet gets the average score.
+    A mirror which fails MAX_FAILURES times in a row is dropped, unless it's
+    the last one.
+    '''
+    MAX_FAILURES = 3
+    # Weight of the newest outcome in the error rate
+    ERROR_SMOOTHING = 0.3
+
+    def __init__(self, url, mirror_urls):
+        self.primary = Mirror(url, primary=True)
+        self.mirrors = [self.primary] + [Mirror(mirror_url) for mirror_url in mirror_urls if mirror_url != url]
+        # Outcomes are recorded by the setup threads
+        self.lock = threading.Lock()
+
+    def get_usable(self):
+        return [mirror for mirror in self.mirrors if not mirror.dropped]
+
+    def get_others(self):
+        return [mirror for mirror in self.mirrors if not mirror.primary]
+
+    def get_score(self, mirror):
+        return mirror.throughput * (1 - mirror.error_rate)
+
+    def pick(self, conns, conn):
+        ''' The mirror for conn, given where the other connections are. '''
+        usable = self.get_usable()
+        if len(usable) == 1:
+            return usable[0]
+        counts = {mirror: 0 for mirror in usable}
+        for other in conns:
+            if other is not conn and not other.retired and other.mirror in counts:
+                counts[other.mirror] += 1
+        measured = [self.get_score(mirror) for mirror in usable if mirror.is_measured()]
+        average = sum(measured) / len(measured) if measured else 0
+
+        def get_load(mirror):
+            score = self.get_score(mirror) if mirror.is_measured() else average
+            if not measured:
+                return counts[mirror]
+            if score <= 0:
+                return float('inf')
+            return (counts[mirror] + 1) / score
+
+        return min(usable, key=lambda mirror: (get_load(mirror), self.mirrors.index(mirror)))
+
+    def update(self, conns):
+        ''' Sum the speeds of the enabled connections of each mirror. '''
+        throughput = {mirror: 0 for mirror in self.mirrors}
+        active = {mirror: 0 for mirror in self.mirrors}
+        for conn in conns:
+            if conn.enabled and conn.mirror in throughput:
+                throughput[conn.mirror] += conn.speed
+                active[conn.mirror] += 1
+        for mirror in self.mirrors:
+            # A mirror with no connection at the moment keeps its last figures.
+            if active[mirror] > 0:
+                mirror.throughput = throughput[mirror]
+                mirror.active = active[mirror]
+
+    def get_connection_speed(self, conn):
+        ''' The throughput per connection of conn's mirror, None with one mirror or none measured. '''
+        mirror = conn.mirror
+        if mirror is None or len(self.get_usable()) < 2 or not mirror.is_measured():
+            return None
+        return mirror.throughput / mirror.active
+
+    def record(self, mirror, ok):
+        ''' Count the outcome of a connection to mirror, return True if that dropped it. '''
+        with self.lock:
+            mirror.error_rate += self.ERROR_SMOOTHING * ((0 if ok else 1) - mirror.error_rate)
+            mirror.failures = 0 if ok else mirror.failures + 1
+            if mirror.failures < self.MAX_FAILURES:
+                return False
+            return self.drop_locked(mirror)
+
+    def drop(self, mirror):
+        ''' Stop using mirror, return False if it's dropped already or the last one. '''
+        with self.lock:
+            return self.drop_locked(mirror)
+
+    def drop_locked(self, mirror):
+        if mirror.dropped or len(self.get_usable()) < 2:
+            return False
+        mirror.dropped = True
+        return True
+
+    @staticmethod
+    def compare(probe, conn):
+        '''
+        Why the file conn found on a mirror isn't the one the probe found,
+        None if it is: it needs the same size, and the same digest if both
+        servers send one of the same algorithm. It has to be fetched by
+        ranges as well.
+        '''
+        if not conn.resuming_supported:
+            return 'it can\'t send ranges'
+        if conn.file_size != probe.file_size:
+            return f'its size is {conn.file_size} bytes'
+        if conn.digest is not None and probe.digest is not None \
+            and conn.digest[0] == probe.digest[0] and conn.digest[1] != probe.digest[1]:
+            return f'its {conn.digest[0]} digest is different'
+        return None
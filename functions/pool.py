@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+class ConnectionPool(object):
+    '''
+    Idle keep-alive sockets by (scheme, host, port, local interface), owned
+    by Process.
+    A connection which finished its range and found no more work leaves its
+    socket here, a connection about to set up takes one instead of connecting.
+    '''
+    # Sockets idle for longer are closed, servers usually drop them about then
+    MAX_IDLE_TIME = 5
+
+    def __init__(self, max_idle_time=MAX_IDLE_TIME):
+        self.max_idle_time = max_idle_time
+        self.lock = threading.Lock()
+        # (scheme, host, port, local interface) -> [(idle since, socket)]
+        self.idle = {}
+
+    @staticmethod
+    def get_key(conn):
+        return conn.scheme, conn.host, conn.port, conn.local_ifs
+
+    def put(self, conn):
+        ''' Keep the socket of conn, which gets a new unconnected one. '''
+        with self.lock:
+            self.idle.setdefault(self.get_key(conn), []).append((time.time(), conn.detach_socket()))
+
+    def take(self, conn):
+        ''' Hand an idle socket to the host of conn over to it, return True if there was one. '''
+        now = time.time()
+        expired = []
+        taken = None
+        with self.lock:
+            sockets = self.idle.get(self.get_key(conn), [])
+            while sockets and taken is None:
+                idle_since, idle_socket = sockets.pop()
+                if now - idle_since > self.max_idle_time:
+                    expired.append(idle_socket)
+                else:
+                    taken = idle_socket
+        for idle_socket in expired:
+            idle_socket.close()
+        if taken is None:
+            return False
+        conn.attach_socket(taken)
+        return True
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for sockets in idle.values():
+            for _, idle_socket in sockets:
+                idle_socket.close()
@@ -3,17 +3,31 @@
 
 import os
 import sys
+import ssl
+import errno
 import threading
-import json
 import time
+import mmap
 import ctypes
-import select
 from urllib.parse import unquote
 
 # Read this..
 # https://my.oschina.net/u/211101?tab=newest&catalogId=135429
 
 from .connection import Connection
+from .eventloop import EventLoop
+from .segments import SegmentMap
+from .statefile import StateFile
+from .tuner import ConnectionTuner
+from .ratelimit import TokenBucket
+from .writer import Writer
+from .checksum import Checksum
+from .pool import ConnectionPool
+from .session import Session
+from .sockopts import SocketOptions
+from .interfaces import InterfaceSet
+from .mirrors import MirrorSet
+from .metalink import Metalink
 from .http import Http
 from .ftp import Ftp
 from .config import PYXEL_DEBUG
@@ -22,21 +36,53 @@ class Process(object):
     # 100 KB
     MIN_CHUNK_WORTH = 100 * 1024
 
-    # 1 sec == 1000000000 nsec
-    SMALLEST_DELAY_IN_SEC = 0.0001
-    NSECs_IN_1_SEC = 1000000000
-    NSECs_variation = 10000000
-    DELAY_ADJUST_PERCENT = 0.05
+    # Maximum time to wait for data, in seconds
+    MAX_POLL_TIMEOUT = 0.5
+    # Interval of the housekeeping in downloading_maintance(), in seconds
+    MAINTENANCE_INTERVAL = 0.5
 
-    def __init__(self, config):
+    # Largest read --rcvbuf=auto makes the reads grow to
+    MAX_AUTO_READ_SIZE = 1024 * 1024
+
+    # Times bad blocks are fetched again before a checksum mismatch is final
+    MAX_CHECKSUM_RETRIES = 2
+
+    # Ranges asked for in one request at most, and the largest range worth
+    # adding to another one, see queue_extra_ranges()
+    MAX_RANGES_PER_REQUEST = 16
+    MAX_MULTI_RANGE_SIZE = 4 * MIN_CHUNK_WORTH
+
+    # errno values meaning splice() can't be used on the socket or the file
+    SPLICE_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EXDEV)
+
+    def __init__(self, config, session=None):
         self.config = config
         self.url = None
 
         # File related info
         self.output_fd = None
+        # Writes the received data behind the download loop, see Writer
+        self.writer = None
+        # Verifies the file while it downloads, see Checksum
+        self.checksum = None
+        self.checksum_retries = 0
+        # Reads back what the checksum's prefix hasn't seen, off the download loop
+        self.checksum_reader = None
+        # Set once the reader has hashed the whole file for verify_checksum()
+        self.checksum_read_back = False
+        # With --mmap the output file is mapped and received straight into
+        self.output_map = None
+        self.output_view = None
         self.output_filename = None
         self.state_filename = None
         self.file_size = 0
+        # Validators from the probe response, recorded in the state file
+        self.etag = None
+        self.last_modified = None
+        # Sent with every range request, see get_if_range()
+        self.if_range = None
+        # Set when the file changed on the server during the download
+        self.restart_needed = False
         self.bytes_done = 0
         self.bytes_per_second = 0
         self.start_byte = 0
@@ -44,23 +90,84 @@ class Process(object):
         self.start_time = None
         self.finish_time = None
 
-        self.delay_time_for_process = {
-            'sec': 0, 'nsec': 0
-        }
-        self.delay_time_for_waiting_connection = {
-            'sec': 0, 'nsec': Process.NSECs_IN_1_SEC // 10
-        }
-        self.delay_time_for_select = 0.1
+        self.next_time_for_maintenance = 0
+
+        # Waits on the sockets of enabled connections
+        self.events = EventLoop()
+
+        # splice() is Linux only, it's turned off if the kernel refuses it
+        self.splice_supported = hasattr(os, 'splice')
 
+        # A checkpoint is made after save_state_interval or save_state_bytes
         self.next_time_to_save_state = 0
+        self.next_bytes_to_save_state = 0
         self.ready = False
 
         # Store the connection objects, each works on a portion of the data to be downloaded
         self.conns = []
+        # (connection, thread) pairs connecting while the probe is in flight
+        self.warm_conns = []
+        # Pending, in-flight and done ranges of the output file
+        self.segments = None
+
+        # Token bucket for --max-speed, connections may have their own as well
+        self.rate_limiter = None
+        if self.config.max_speed > 0:
+            self.rate_limiter = self.new_rate_limiter(self.config.max_speed)
+
+        # Adds and retires connections when -n auto is given
+        self.tuner = None
+        self.connections_to_retire = 0
+        if self.config.auto_connections:
+            self.tuner = ConnectionTuner(
+                self.config.num_of_connections,
+                self.config.max_auto_connections,
+                self.config.auto_connections_margin
+            )
+
+        # Host lookups, Tls sessions and idle keep-alive sockets shared by all
+        # connections, and by all the downloads of a batch
+        self.owns_session = session is None
+        self.session = Session(self.config) if session is None else session
+        self.resolver = self.session.resolver
+        self.tls = self.session.tls
+        # Idle keep-alive sockets, taken by connections before they connect
+        self.pool = self.session.pool
+        self.owns_pool = self.pool is None and self.config.keep_alive
+        if self.owns_pool:
+            self.pool = ConnectionPool()
+        # A batch's connection slots, the one of the first connection is
+        # taken by the batch, this Process holds extra_slots more
+        self.budget = self.session.budget
+        self.budget_host = None
+        self.extra_slots = 0
+        # Connections retired by release_idle_connection(), their slot is back
+        self.released_conns = set()
+        self.socket_options = SocketOptions(
+            self.config.tcp_rcvbuf,
+            self.config.tcp_rcvbuf_auto,
+            self.config.tcp_nodelay,
+            self.config.tcp_quickack,
+            self.config.tcp_fastopen
+        )
 
         # A list of messages record what happened in Process()
         self.messages = []
 
+        # Local interfaces the connections are spread over, if any were given
+        self.interfaces = InterfaceSet(self.config.interfaces)
+        for name in self.interfaces.missing:
+            self.add_message(f'Interface {name} has no address, not using it')
+        # The URLs of the file the connections download from, set up once the
+        # probe is in, see check_mirrors()
+        self.mirrors = None
+        # The file of a Metalink document being downloaded, if it is one, and
+        # the document the URL served instead of a file, see read_metalink()
+        self.metalink_file = None
+        self.metalink = None
+        # Turned off when the server doesn't send several ranges in one response
+        self.multi_range = self.config.multi_range
+
     def __del__(self):
         if self.messages:
             sys.stdout.write(f'Dump all stored messages for {__name__}\n')
@@ -71,60 +178,149 @@ class Process(object):
             sys.stdout.write(''.join([message, '\n']))
         self.messages = []
 
+    def new_connection(self):
+        ''' A connection bound to the interface the InterfaceSet picks, if any. '''
+        local_if = self.interfaces.pick(self.conns + [conn for conn, _ in self.warm_conns])
+        conn = self.create_connection(local_if)
+        conn.local_addresses = self.interfaces.get_addresses(local_if)
+        conn.resolver = self.resolver
+        conn.tls = self.tls
+        conn.socket_options = self.socket_options
+        return conn
+
+    def create_connection(self, local_if=None):
+        if Connection.get_scheme_from_url(self.url) in (Connection.HTTP, Connection.HTTPS):
+            return Http(
+                self.config.ai_family,
+                self.config.io_timeout,
+                self.config.max_redirect,
+                self.config.headers,
+                self.config.http_proxy,
+                self.config.no_proxies,
+                local_if,
+                self.config.keep_alive
+            )
+        return Ftp(
+            self.config.ai_family,
+            self.config.io_timeout,
+            self.config.max_redirect,
+            local_if
+        )
+
     def prepare_connections(self, num_of_connections):
         for _ in range(num_of_connections):
-            if Connection.get_scheme_from_url(self.url) in (Connection.HTTP, Connection.HTTPS):
-                new_conn = Http(
-                    self.config.ai_family,
-                    self.config.io_timeout,
-                    self.config.max_redirect,
-                    self.config.headers,
-                    self.config.http_proxy,
-                    self.config.no_proxies,
-                    self.config.interfaces[0]
-                )
-            else:
-                new_conn = Ftp(
-                    self.config.ai_family,
-                    self.config.io_timeout,
-                    self.config.max_redirect,
-                    self.config.interfaces[0]
-                )
-            self.conns.append(new_conn)
+            self.conns.append(self.new_connection())
 
     def prepare_1st_connection(self):
         self.conns = []
         self.prepare_connections(1)
 
     def prepare_other_connections(self):
+        '''
+        Warm connections from start_warm_up() are used first. In a batch,
+        there are only as many connections as the budget has slots for.
+        '''
         assert len(self.conns) == 1
-        self.prepare_connections(self.config.num_of_connections - 1)
+        if self.budget is not None:
+            wanted = self.config.num_of_connections - 1
+            if wanted > self.extra_slots:
+                self.reserve_connections(wanted - self.extra_slots)
+            else:
+                self.release_connections(self.extra_slots - wanted)
+            self.config.num_of_connections = 1 + self.extra_slots
+        warm_conns = self.take_warm_connections(self.config.num_of_connections - 1)
+        self.conns.extend(warm_conns)
+        self.prepare_connections(self.config.num_of_connections - 1 - len(warm_conns))
+
+    def start_warm_up(self):
+        '''
+        Resolve and connect the other connections to the host while the probe is
+        in flight, so DNS and the handshakes are out of the way once the ranges
+        are known. Only Http connections are warmed up, and with mirrors only
+        the primary's share of them.
+        '''
+        if Connection.get_scheme_from_url(self.url) not in (Connection.HTTP, Connection.HTTPS):
+            return
+        num_of_connections = -(-self.config.num_of_connections // len(self.mirrors.mirrors))
+        for _ in range(self.reserve_connections(num_of_connections - 1)):
+            conn = self.new_connection()
+            conn.set_url(self.url)
+            thread = threading.Thread(target=self.warm_up_connection, args=(conn,), daemon=True)
+            self.warm_conns.append((conn, thread))
+            thread.start()
+        if self.config.verbose and self.warm_conns:
+            self.add_message(f'Warming up {len(self.warm_conns)} connections')
+
+    def warm_up_connection(self, conn):
+        with conn.lock:
+            conn.connection_init()
+
+    def take_warm_connections(self, num_of_connections):
+        '''
+        Return up to num_of_connections warm connections, once their connect is
+        over. They are all dropped if the probe was redirected elsewhere or the
+        server can't do ranges, and so are the ones left over.
+        '''
+        probe = self.conns[0]
+        usable = probe.resuming_supported and probe.file_size != Connection.MAX_FILESIZE
+        taken = []
+        for conn, thread in self.warm_conns:
+            thread.join()
+            same_origin = (conn.scheme, conn.host, conn.port) == (probe.scheme, probe.host, probe.port)
+            if usable and same_origin and len(taken) < num_of_connections:
+                taken.append(conn)
+            else:
+                conn.disconnect()
+        self.warm_conns = []
+        return taken
 
     def is_resuming_supported(self):
         return self.conns[0].resuming_supported
 
-    def tuning_params(self):
+    def reserve_connections(self, num_of_connections):
+        ''' Take slots for more connections from the budget, return how many there are. '''
+        if self.budget is None:
+            return num_of_connections
+        granted = self.budget.acquire(self.budget_host, num_of_connections)
+        self.extra_slots += granted
+        return granted
+
+    def release_connections(self, num_of_connections):
+        if self.budget is None:
+            return
+        num_of_connections = min(num_of_connections, self.extra_slots)
+        self.extra_slots -= num_of_connections
+        self.budget.release(self.budget_host, num_of_connections)
+
+    def release_idle_connection(self, i):
         '''
-        If config.max_speed is defined, then adjust config.buffer_size and delay_time_for_process
+        In a batch, an idle connection which found no work to take or steal
+        means the file is in its end-game, so the connection is retired and
+        its slot goes to the next file. One connection is kept, e.g. for
+        blocks which fail the checksum.
         '''
-        if self.config.max_speed > 0:
-            # To make max_speed / buffer_size < 0.5
-            if self.config.max_speed * 16 // self.config.buffer_size < 8:
-                if self.config.verbose:
-                    self.add_message(
-                        'Buffer resized for this speed. '
-                        f'{self.config.buffer_size} to {self.config.max_speed}'
-                    )
-                self.config.buffer_size = self.config.max_speed
-            delay = Process.NSECs_IN_1_SEC * \
-                self.config.buffer_size * \
-                self.config.num_of_connections // \
-                self.config.max_speed
-            self.delay_time_for_process['sec'] = delay // Process.NSECs_IN_1_SEC
-            self.delay_time_for_process['nsec'] = delay % Process.NSECs_IN_1_SEC
+        conn = self.conns[i]
+        if self.budget is None or self.extra_slots == 0 or conn.enabled or conn.in_progress:
+            return
+        if conn.current_byte < conn.last_byte:
+            return
+        if not any(
+            other.current_byte < other.last_byte
+            for other in self.conns
+            if other is not conn and not other.retired
+        ):
+            return
+        conn.retired = True
+        self.released_conns.add(conn)
+        self.release_connections(1)
+        if self.config.verbose:
+            self.add_message(f'Connection {i} has no more work, its slot goes to the next file')
 
     def set_output_filename(self):
-        ''' Set output filename using the filename in the URL '''
+        ''' Set output filename using the filename in the URL, or the Metalink one '''
+        if self.metalink_file is not None:
+            self.output_filename = self.metalink_file.name
+            return
         self.output_filename = unquote(self.conns[0].filename)
         if self.output_filename == '':
             # This happens when we download index page.
@@ -143,26 +339,42 @@ class Process(object):
         return True
 
     # map axel_new()
-    def new_preparation(self, url):
+    def new_preparation(self, url, metalink_file=None):
         '''
         Do preparation for the downloading, including:
         Get resource information by sending a GET request to the target URL
         and analysing the response.
+        With a Metalink file of known size there is nothing to ask, see
+        prepare_from_metalink().
         Reviewed on 5/22/2020, the HTTP redirects to FTP need to be added here.
         '''
         self.url = url
-        self.tuning_params()
+        self.budget_host = Connection.analyse_url(url)[4]
+        self.metalink_file = metalink_file
+        if metalink_file is None:
+            self.mirrors = MirrorSet(url, self.config.mirrors)
+        else:
+            self.mirrors = MirrorSet(url, metalink_file.urls[1:])
         self.prepare_1st_connection()
         self.conns[0].set_url(url)
 
         self.set_output_filename()
         if not self.clobber_existing_file():
             return False
+        if metalink_file is not None and metalink_file.size is not None:
+            return self.prepare_from_metalink()
 
         while True:
-            if False in (self.conns[0].connection_init(), self.conns[0].get_resource_info()):
+            connected = self.conns[0].connection_init()
+            if connected and not self.warm_conns:
+                # Once the probe is connected, the host lookup is cached and a
+                # Tls session is there for the warm connections to resume.
+                self.start_warm_up()
+            if not connected or not self.conns[0].get_resource_info():
                 # Is this necessary?
                 self.ready = False
+                self.take_warm_connections(0)
+                self.release_connections(self.extra_slots)
                 return False
 
             if not self.conns[0].redirect_to_ftp:
@@ -174,8 +386,11 @@ class Process(object):
             # Handle HTTP redirects to FTP here...
             pass
 
+        if self.conns[0].is_metalink() and self.metalink_file is None:
+            return self.read_metalink()
+
         # Always use the filename we got from HTTP response, if there is one.
-        if self.conns[0].output_filename:
+        if self.conns[0].output_filename and self.metalink_file is None:
             self.output_filename = self.conns[0].output_filename
 
         if PYXEL_DEBUG:
@@ -183,6 +398,7 @@ class Process(object):
         # Reset url after getting the HTTP response, as it might be redirected.
         self.conns[0].url = self.conns[0].generate_url()
         self.url = self.conns[0].url
+        self.mirrors.primary.url = self.url
         if PYXEL_DEBUG:
             print(f'After calling {__name__}, the url is {self.url}')
 
@@ -193,8 +409,194 @@ class Process(object):
                 self.add_message(f'File size: {self.file_size} bytes.')
             else:
                 self.add_message('File size: unavailable.')
+        self.etag = self.conns[0].etag
+        self.last_modified = self.conns[0].last_modified
+        self.if_range = self.get_if_range(self.etag, self.last_modified)
+        self.mirrors.primary.if_range = self.if_range
+        self.check_mirrors()
+        self.setup_checksum()
         return True
 
+    def prepare_from_metalink(self):
+        '''
+        The Metalink file gives the size, the mirrors and the hashes, so the
+        probe is left out and all the connections start at once. The mirrors
+        aren't checked either, the piece hashes catch a mirror with other data.
+        There are no validators, the hashes stand in for them.
+        '''
+        self.file_size = self.metalink_file.size
+        self.conns[0].file_size = self.file_size
+        self.conns[0].resuming_supported = True
+        if self.config.verbose:
+            self.add_message(
+                f'Metalink: {self.file_size} bytes from {len(self.mirrors.mirrors)} mirrors, '
+                f'{len(self.metalink_file.pieces or [])} piece hashes.'
+            )
+        self.setup_checksum()
+        return True
+
+    def read_metalink(self):
+        '''
+        The URL served a Metalink document, it's read off the probe response
+        and the Tasker downloads the files it lists.
+        '''
+        conn = self.conns[0]
+        self.take_warm_connections(0)
+        self.release_connections(self.extra_slots)
+        size = conn.file_size if conn.file_size != Connection.MAX_FILESIZE else Metalink.MAX_SIZE
+        if size > Metalink.MAX_SIZE:
+            self.add_message(f'The Metalink document at {self.url} is too big.')
+            conn.disconnect()
+            return False
+        data = bytearray()
+        while len(data) < size:
+            data_buffer = conn.recv_data(min(self.config.buffer_size, size - len(data)))
+            if not data_buffer:
+                break
+            data += data_buffer
+        conn.disconnect()
+        try:
+            self.metalink = Metalink.parse(bytes(data))
+        except Exception as e:
+            self.add_message(e.args[-1])
+            return False
+        if self.config.verbose:
+            self.add_message(f'{self.url} is a Metalink document for {len(self.metalink.files)} files.')
+        return True
+
+    @staticmethod
+    def get_if_range(etag, last_modified):
+        '''
+        If-Range needs a strong validator: a strong ETag, else Last-Modified.
+        A weak ETag only promises equivalent content, not the same bytes.
+        '''
+        if etag is not None and not etag.startswith('W/'):
+            return etag
+        return last_modified
+
+    def check_mirrors(self):
+        '''
+        Probe the other mirrors all at once, a mirror is only used if it has
+        the file the primary has, see MirrorSet.compare(). Each one keeps its
+        own If-Range validator. Only Http mirrors of a Http file are used.
+        '''
+        mirrors = self.mirrors.get_others()
+        if not mirrors:
+            return
+        is_http = Connection.get_scheme_from_url(self.url) in (Connection.HTTP, Connection.HTTPS)
+        if not is_http or not self.is_resuming_supported() or not self.is_file_size_known():
+            self.add_message('The file can\'t be fetched by ranges, not using the mirrors.')
+            for mirror in mirrors:
+                mirror.dropped = True
+            return
+        probes = []
+        for mirror in mirrors:
+            if Connection.get_scheme_from_url(mirror.url) not in (Connection.HTTP, Connection.HTTPS):
+                self.add_message(f'Mirror {mirror.url} isn\'t a Http URL, not using it')
+                mirror.dropped = True
+                continue
+            conn = self.new_connection()
+            conn.set_url(mirror.url)
+            results = {}
+            thread = threading.Thread(target=self.probe_mirror, args=(conn, results), daemon=True)
+            probes.append((mirror, conn, thread, results))
+            thread.start()
+        for mirror, conn, thread, results in probes:
+            thread.join()
+            if not results.get('ok') or conn.redirect_to_ftp:
+                reason = 'it didn\'t answer'
+            else:
+                reason = MirrorSet.compare(self.conns[0], conn)
+            if reason is not None:
+                self.add_message(f'Mirror {mirror.url} is left out, {reason}')
+                mirror.dropped = True
+                continue
+            mirror.url = conn.generate_url()
+            mirror.if_range = self.get_if_range(conn.etag, conn.last_modified)
+            if self.config.verbose:
+                self.add_message(f'Using mirror {mirror.url}')
+
+    def probe_mirror(self, conn, results):
+        with conn.lock:
+            results['ok'] = conn.connection_init() and conn.get_resource_info()
+            # The body isn't wanted, the connections ask for their ranges later.
+            conn.disconnect()
+
+    def init_connection(self, conn):
+        ''' Get a connection ready to download ranges of the file. '''
+        conn.set_url(self.url)
+        conn.resuming_supported = True
+        conn.if_range = self.if_range
+        conn.mirror = self.mirrors.primary
+
+    def assign_mirror(self, conn):
+        '''
+        Point a connection about to connect at the mirror picked for it. A
+        connected one stays with its mirror, unless that was dropped.
+        '''
+        if len(self.mirrors.mirrors) < 2:
+            return
+        if conn.is_connected():
+            if conn.mirror is None or not conn.mirror.dropped:
+                return
+            conn.disconnect()
+        mirror = self.mirrors.pick(self.conns, conn)
+        if mirror is conn.mirror:
+            return
+        conn.mirror = mirror
+        conn.set_url(mirror.url)
+        conn.if_range = mirror.if_range
+
+    def score_mirror(self, conn, ok):
+        '''
+        Count how a connection's setup or transfer went for its mirror. A
+        mirror whose file changed is dropped, while the file changing on the
+        primary means starting over, see check_if_remote_changed().
+        '''
+        mirror = conn.mirror
+        if mirror is None:
+            return
+        if conn.remote_changed and not mirror.primary:
+            if self.mirrors.drop(mirror):
+                conn.remote_changed = False
+                self.add_message(f'Mirror {mirror.url} has another version of the file, not using it any more')
+        elif self.mirrors.record(mirror, ok):
+            self.add_message(
+                f'Mirror {mirror.url} failed {MirrorSet.MAX_FAILURES} times in a row, not using it any more'
+            )
+
+    def get_connection_speed(self, conn):
+        ''' The expected speed of conn, from its mirror's throughput, else its interface's. '''
+        speed = self.mirrors.get_connection_speed(conn)
+        if speed is None:
+            return self.interfaces.get_connection_speed(conn)
+        return speed
+
+    def setup_checksum(self):
+        '''
+        --checksum wins over the Metalink hash, which wins over a digest sent
+        by the server. The Metalink pieces are checked as they come in.
+        '''
+        metalink_file = self.metalink_file
+        expected = self.config.checksum or (metalink_file.hash if metalink_file else None) or self.conns[0].digest
+        pieces = metalink_file is not None and metalink_file.pieces and self.is_file_size_known()
+        if expected is None and not pieces:
+            return
+        algorithm, digest = expected or (metalink_file.piece_algorithm, None)
+        if pieces:
+            self.checksum = Checksum(
+                algorithm,
+                digest,
+                self.file_size,
+                metalink_file.piece_length,
+                metalink_file.pieces,
+                metalink_file.piece_algorithm
+            )
+        else:
+            self.checksum = Checksum(algorithm, digest, self.file_size, self.config.checksum_block_size)
+        if self.config.verbose:
+            self.add_message(f'Verifying the {algorithm} checksum while downloading.')
+
     # map axel_open()
     def open_local_files(self):
         '''
@@ -211,77 +613,235 @@ class Process(object):
         if not self.conns[0].resuming_supported:
             self.set_single_connection()
 
+        # A shared mapping and the checksum need the file opened for reading as well.
+        access_mode = os.O_RDWR if self.config.mmap_output or self.checksum else os.O_WRONLY
         if self.restore_state():
-            self.output_fd = self.open_file(self.output_filename, os.O_WRONLY)
+            self.output_fd = self.open_file(self.output_filename, access_mode)
             if self.output_fd is None:
                 return False
         else:
-            self.output_fd = self.open_file(self.output_filename, os.O_CREAT | os.O_WRONLY)
+            self.output_fd = self.open_file(self.output_filename, os.O_CREAT | access_mode)
             if self.output_fd is None:
                 return False
             self.divide()
-            if self.config.num_of_connections > 1:
-                self.check_seek_past_eof()
+            self.segments = SegmentMap.from_connections(self.file_size, self.conns)
+        if self.config.preallocate and not self.preallocate_output_file():
+            return False
+        if self.config.mmap_output and not self.map_output_file():
+            return False
+        if self.config.write_behind and self.output_map is None:
+            self.writer = Writer(
+                self.output_fd,
+                self.config.buffer_size,
+                self.config.write_flush_size,
+                self.config.write_memory_limit,
+                self.writer_wakeup
+            )
         return True
 
-    def check_seek_past_eof(self):
-        ''' 
-        Check whether the fs can handle seeks to past EOF areas.
-        For most or all fs, this might be not needed.
+    def writer_wakeup(self):
+        ''' Called by the writer thread after each write, see Writer. '''
+        self.events.wakeup()
+
+    def is_file_size_known(self):
+        return 0 < self.file_size < Connection.MAX_FILESIZE
+
+    def preallocate_output_file(self):
+        '''
+        Reserve file_size bytes for the output file before downloading, so the
+        segments written out of order are laid out contiguously and a full disk
+        shows up now instead of halfway through.
+        '''
+        if not self.is_file_size_known():
+            return True
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(self.output_fd, 0, self.file_size)
+            else:
+                os.ftruncate(self.output_fd, self.file_size)
+        except OSError as e:
+            if e.errno in (errno.ENOSPC, errno.EDQUOT):
+                self.add_message(f'Not enough disk space for {self.file_size} bytes.')
+                return False
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                self.add_message(f'Error preallocating local file. {e.args[-1]}')
+                return False
+            # The file system can't reserve space, at least set the size.
+            os.ftruncate(self.output_fd, self.file_size)
+        if os.fstat(self.output_fd).st_size > self.file_size:
+            # Left over from an older, bigger file of the same name.
+            os.ftruncate(self.output_fd, self.file_size)
+        return True
+
+    def map_output_file(self):
+        '''
+        Map the output file into memory for --mmap, the connections then receive
+        into the mapping and data is never written with a system call.
+        Without a known size the file is written normally.
         '''
-        pass
+        if not self.is_file_size_known():
+            self.add_message('File size unknown, not mapping the output file.')
+            return True
+        try:
+            if os.fstat(self.output_fd).st_size < self.file_size:
+                os.ftruncate(self.output_fd, self.file_size)
+            self.output_map = mmap.mmap(self.output_fd, self.file_size)
+        except (OSError, ValueError) as e:
+            self.add_message(f'Error mapping local file. {e.args[-1]}')
+            return False
+        self.output_view = memoryview(self.output_map)
+        return True
+
+    def unmap_output_file(self):
+        if self.output_map is not None:
+            self.output_view.release()
+            self.output_map.close()
+            self.output_view = None
+            self.output_map = None
 
     def start_downloading(self):
         for conn in self.conns:
-            conn.set_url(self.url)
-            conn.resuming_supported = True
+            self.init_connection(conn)
 
         if self.config.verbose:
             print('Starting download...')
 
+        # The real downloading starts from here.
+        self.start_time = time.time()
+        self.ready = False
+
         for i in range(self.config.num_of_connections):
-            if self.conns[i].current_byte > self.conns[i].last_byte:
-                conn.lock.acquire()
+            if self.can_use_probe_response(i):
+                if self.config.verbose:
+                    self.add_message(f'Connection {i} goes on with the probe response')
+                conn = self.conns[i]
+                conn.enabled = True
+                conn.last_transfer = time.time()
+                self.events.notify(i)
+            elif self.conns[i].current_byte > self.conns[i].last_byte:
+                self.conns[i].lock.acquire()
                 self.reactivate_connection(i)
-                conn.lock.release()
+                self.conns[i].lock.release()
             elif self.conns[i].current_byte < self.conns[i].last_byte:
-                if self.config.verbose:
-                    self.add_message(
-                        f'Connection {i} downloading from '
-                        f'{self.conns[i].host}:{self.conns[i].port} '
-                        f'using interface {self.conns[i].local_ifs}'
-                    )
-                self.conns[i].in_progress = True
-                self.conns[i].setup_thread = threading.Thread(
-                    target=self.setup_connection_thread,
-                    args=(self.conns[i],)
-                )
-                self.conns[i].setup_thread.start()
+                self.start_setup_thread(i)
 
-        # The real downloading starts from here.
-        self.start_time = time.time()
-        self.ready = False
+    def can_use_probe_response(self, i):
+        '''
+        The probe asked for the file from byte 0 and its socket is still open,
+        so connection 0 can read that body as its range instead of connecting
+        and asking again. Otherwise the socket is closed.
+        '''
+        conn = self.conns[i]
+        if i != 0 or not conn.is_connected():
+            return False
+        if conn.current_byte == 0 and conn.last_byte > 0:
+            return True
+        conn.disconnect()
+        return False
 
-    @staticmethod
-    def setup_connection_thread(conn):
+    def start_setup_thread(self, i):
+        conn = self.conns[i]
+        # The next part of a multipart response needs no new request.
+        if not conn.is_multipart():
+            self.assign_mirror(conn)
+            self.queue_extra_ranges(i)
+            if self.config.verbose:
+                self.add_message(
+                    f'Connection {i} downloading from '
+                    f'{conn.host}:{conn.port} '
+                    f'using interface {conn.local_ifs}'
+                )
+        conn.in_progress = True
+        conn.last_transfer = time.time()
+        conn.setup_thread = threading.Thread(
+            target=self.setup_connection_thread,
+            args=(i,)
+        )
+        conn.setup_thread.start()
+
+    def setup_connection_thread(self, i):
         '''
         Thread used to set up a connection
+        Once it's ready for data, it's handed over to the event loop.
         Reviewed on 5/22/2020
         '''
+        conn = self.conns[i]
         conn.lock.acquire()
-        if not conn.is_connected():
-            conn.connection_init()
-        if conn.request_setup():
-            conn.last_transfer = time.time()
-            if conn.execute_req_resp():
-                conn.last_transfer = time.time()
-                conn.enabled = True
+        try:
+            if conn.is_multipart():
+                # The range is the next part of the response.
+                conn.set_blocking(True)
+                conn.enabled = conn.recv_part_header()
+                if not conn.enabled:
+                    conn.disconnect()
             else:
-                conn.disconnect()
-        else:
+                self.request_range(conn)
+        finally:
+            # Also reached when the thread is cancelled by connections_check().
+            conn.setup_failed = not conn.enabled
+            self.score_mirror(conn, conn.enabled)
+            conn.in_progress = False
+            conn.lock.release()
+        if conn.enabled:
+            self.events.notify(i)
+
+    def request_range(self, conn):
+        ''' Ask for the connection's range, in the setup thread. '''
+        if not conn.is_connected() and self.pool is not None:
+            self.pool.take(conn)
+        # A socket the event loop had is non-blocking.
+        conn.set_blocking(True)
+        # A warm or pooled socket may have been closed by the server meanwhile, the
+        # request is tried once more on a new connection then.
+        for reuse in ([True, False] if conn.is_connected() else [False]):
+            if not reuse and not conn.connection_init():
+                break
+            if conn.request_setup():
+                conn.last_transfer = time.time()
+                if conn.execute_req_resp():
+                    conn.last_transfer = time.time()
+                    conn.enabled = True
+                    break
             conn.disconnect()
-        conn.in_progress = False
-        conn.lock.release()
+            if conn.remote_changed:
+                break
+
+    def queue_extra_ranges(self, i):
+        '''
+        A connection about to ask for a small range asks for some small
+        pending ranges after it in the same request as well. They come back
+        as the parts of a multipart/byteranges response, one after another,
+        see release_connection(), which fills many small holes, e.g. of a
+        resumed download, in one round trip.
+        '''
+        conn = self.conns[i]
+        self.check_extra_ranges(i)
+        conn.extra_ranges = []
+        if not self.multi_range or conn.scheme not in (Connection.HTTP, Connection.HTTPS):
+            return
+        if not 0 < conn.last_byte - conn.current_byte <= self.MAX_MULTI_RANGE_SIZE:
+            return
+        conn.extra_ranges = self.segments.queue(
+            i,
+            conn.last_byte,
+            self.MAX_RANGES_PER_REQUEST - 1,
+            self.MAX_MULTI_RANGE_SIZE
+        )
+        if conn.extra_ranges and self.config.verbose:
+            self.add_message(f'Connection {i} asking for {len(conn.extra_ranges)} more ranges in one request')
+
+    def check_extra_ranges(self, i):
+        '''
+        Unless the response brings them, the ranges queued for connection i
+        are pending again. A server which answered them with one range or the
+        whole file gets one range per request from now on.
+        '''
+        conn = self.conns[i]
+        if conn.extra_ranges_refused and self.multi_range:
+            self.multi_range = False
+            self.add_message('The server doesn\'t send several ranges in one response, asking for one at a time')
+        if self.segments is not None and not conn.is_multipart():
+            self.segments.release_queued(i)
 
     def __cancel_thread(self, thread_id):
         if not isinstance(thread_id, ctypes.c_long):
@@ -300,32 +860,36 @@ class Process(object):
             sys.stderr.write('Exception raise within thread failed\n')
 
     def reactivate_connection(self, i):
-        ''' 
-        reactivate the connection to find some more work to do 
-        this function only changes current_byte and last_byte if it can
-        Went through on 5/21/2020
         '''
-        max_remaining = 0
-        max_index = None
-
-        if self.conns[i].enabled or self.conns[i].current_byte < self.conns[i].last_byte:
+        Find some more work for an idle connection: a pending range first, else
+        steal the tail of the range with the most estimated remaining time.
+        In end-game mode the last ranges are raced on two connections.
+        This function only changes current_byte and last_byte if it can.
+        '''
+        conn = self.conns[i]
+        if conn.retired or conn.enabled or conn.current_byte < conn.last_byte:
             return
-
-        for conn_i, conn in enumerate(self.conns):
-            if conn_i == i:
-                continue
-            remaining = conn.last_byte - conn.current_byte
-            if remaining > max_remaining:
-                max_remaining = remaining
-                max_index = conn_i
-        
-        # Do not reactivate unless large enough
-        if max_index and max_remaining > self.MIN_CHUNK_WORTH:
+        if self.segments.assign(i, conn):
+            return
+        speeds = [self.get_connection_speed(other_conn) for other_conn in self.conns]
+        if self.segments.steal(i, self.conns, self.MIN_CHUNK_WORTH, speeds):
             if PYXEL_DEBUG:
                 print(f'Reactivate connection {i}')
-            self.conns[i].last_byte = self.conns[max_index].last_byte
-            self.conns[max_index].last_byte = self.conns[max_index].current_byte + max_remaining // 2
-            self.conns[i].current_byte = self.conns[max_index].last_byte
+            return
+        if self.config.end_game and self.segments.race(i, self.conns, speeds):
+            if self.config.verbose:
+                self.add_message(f'Connection {i} racing {conn.current_byte}-{conn.last_byte}')
+
+    def cancel_connection(self, i):
+        ''' Stop a connection that lost an end-game race and find it other work. '''
+        conn = self.conns[i]
+        conn.current_byte = conn.last_byte
+        # If the setup thread holds the lock, the connection is closed as soon as
+        # it brings in data, since there is nothing left in its range.
+        if conn.lock.acquire(blocking=False):
+            self.close_connection(i)
+            self.reactivate_connection(i)
+            conn.lock.release()
 
     def open_file(self, filename, mode):
         try:
@@ -335,23 +899,42 @@ class Process(object):
             return None
 
     def restore_state(self):
+        '''
+        Pick an unfinished download up from its state file. The missing blocks
+        are shared out among the connections asked for this time, which don't
+        have to be as many as before.
+        '''
         if not self.conns[0].resuming_supported:
             return False
-        state = self.load_state()
-        if state:
-            self.config.num_of_connections = int(state['num_of_connections'])
-            self.bytes_done = int(state['bytes_done'])
-            assert self.config.num_of_connections > 0
-            self.prepare_other_connections()
-            for i in range(self.config.num_of_connections):
-                print(state['connections'][i])
-                self.conns[i].current_byte = state['connections'][i]['current_byte']
-                self.conns[i].last_byte = state['connections'][i]['last_byte']
-            self.add_message(
-                f'State file found: {self.bytes_done} bytes downloaded, {self.file_size - self.bytes_done} to go.'
-            )
-            return True
-        return False
+        try:
+            state = StateFile.load(self.state_filename, self.file_size, self.config.state_block_size)
+        except (OSError, ValueError) as e:
+            self.add_message(f'Ignoring state file {self.state_filename}: {e.args[-1]}')
+            return False
+        if state is None:
+            return False
+        if state.file_size != self.file_size:
+            self.add_message('State file is for a file of another size, starting over.')
+            return False
+        if not state.has_validators:
+            self.add_message('State file has no ETag or Last-Modified, only the size is checked.')
+        elif (state.etag, state.last_modified) != (self.etag, self.last_modified):
+            self.add_message('The file has changed on the server since the state file was saved, starting over.')
+            return False
+
+        self.optimize_num_of_connections()
+        self.prepare_other_connections()
+        self.segments = SegmentMap.from_done_ranges(self.file_size, state.done_ranges())
+        for i, conn in enumerate(self.conns):
+            conn.current_byte = 0
+            conn.last_byte = 0
+            self.reactivate_connection(i)
+        self.bytes_done = self.file_size - self.segments.bytes_left()
+        self.start_byte = self.bytes_done
+        self.add_message(
+            f'State file found: {self.bytes_done} bytes downloaded, {self.file_size - self.bytes_done} to go.'
+        )
+        return True
 
     def set_single_connection(self):
         self.add_message(
@@ -405,217 +988,742 @@ class Process(object):
 
     def create_state_file_periodically(self):
         ''' Create state file periodically. '''
-        if time.time() > self.next_time_to_save_state:
+        if time.time() > self.next_time_to_save_state or self.bytes_done >= self.next_bytes_to_save_state:
             self.save_state()
             self.next_time_to_save_state = time.time() + self.config.save_state_interval
+            self.next_bytes_to_save_state = self.bytes_done + self.config.save_state_bytes
+            self.catch_up_checksum()
 
     def downloading_maintance(self):
+        if self.check_if_remote_changed():
+            return
         self.connections_check()
         self.calculate_average_speed_and_finish_time()
-        self.adjust_downloading_speed()
+        self.tune_connections()
+        self.tune_socket_buffers()
         self.check_if_bytes_done()
 
     def do_downloading(self):
+        self.collect_written()
         self.create_state_file_periodically()
+        self.register_connections()
+
+        now = time.time()
+        timeout = min(self.next_time_for_maintenance, now + self.MAX_POLL_TIMEOUT)
+        next_deadline = self.events.next_deadline()
+        if next_deadline is not None:
+            timeout = min(timeout, next_deadline)
+
+        throttle_delay = self.throttle_delay(self.rate_limiter)
+        if throttle_delay > 0:
+            # No tokens left, only wait for finished setups until the refill.
+            self.events.wait_wakeup(min(timeout - now, throttle_delay))
+            ready_connections = []
+        elif self.writer is not None and self.writer.is_full():
+            # The disk is behind, leave the data in the sockets until the
+            # writer frees some memory, it wakes the loop up then.
+            self.events.wait_wakeup(timeout - now)
+            ready_connections = []
+        else:
+            ready_connections = self.events.poll(timeout - now, now)
 
-        ready_connections = self.wait_for_data()
+        for i in ready_connections:
+            conn = self.conns[i]
+            if not conn.lock.acquire(blocking=False):
+                continue
+            if conn.enabled:
+                self.dispatch_connection(i)
+            conn.lock.release()
+            if self.ready:
+                return
 
-        if not ready_connections:
-            Process.process_sleep(self.delay_time_for_waiting_connection)
-            print('No ready connections.')
-            self.downloading_maintance()
+        self.check_timeouts()
+        self.check_if_bytes_done()
+        if self.ready:
             return
-
-        #inputs = list(map(lambda c : c.socket_fd(), ready_connections))
-        inputs = [c.get_socket_fd() for c in ready_connections]
-        readables, _, _ = select.select(inputs, [], [], self.delay_time_for_select)
-        print('do_downloading --> entering loop')
-        for i, conn in enumerate(self.conns):
-            if not conn.lock.acquire(blocking=False):
+        if time.time() >= self.next_time_for_maintenance:
+            self.downloading_maintance()
+            self.next_time_for_maintenance = time.time() + self.MAINTENANCE_INTERVAL
+
+    def register_connections(self):
+        ''' Register connections whose setup thread has finished. '''
+        for i in self.events.take_setup_done():
+            conn = self.conns[i]
+            self.check_extra_ranges(i)
+            if not conn.enabled or not conn.is_connected():
                 continue
-            
-            if not conn.enabled:
-                conn.lock.release()
+            self.events.register(
+                i,
+                conn.get_socket_fd(),
+                conn.last_transfer + self.config.connection_timeout
+            )
+            conn.set_blocking(False)
+            if conn.has_buffered_data():
+                self.events.mark_pending(i)
+
+    def close_connection(self, i):
+        conn = self.conns[i]
+        self.events.unregister(i)
+        conn.disconnect()
+        conn.enabled = False
+        if self.writer is not None:
+            self.writer.flush(i)
+        self.check_extra_ranges(i)
+
+    def collect_written(self):
+        '''
+        Count the bytes the writer has written, bytes_done never includes data
+        that only sits in memory.
+        '''
+        if self.writer is None:
+            return
+        self.bytes_done += self.writer.take_completed()
+        if self.writer.error is not None:
+            self.add_message(f'File write error! {self.writer.error.args[-1]}')
+            self.ready = False
+
+    def check_timeouts(self):
+        now = time.time()
+        for i in self.events.pop_expired(now):
+            conn = self.conns[i]
+            deadline = conn.last_transfer + self.config.connection_timeout
+            if now <= deadline:
+                # Data came in since the deadline was set.
+                self.events.add_deadline(i, deadline)
                 continue
-            
-            if conn.get_socket_fd() not in readables:
-                timeout = conn.last_transfer + self.config.connection_timeout
-                if time.time() > timeout:
-                    if self.config.verbose:
-                        self.add_message(f'Connection {i} timed out')
-                    conn.disconnect()
-                conn.lock.release()
+            if not conn.lock.acquire(blocking=False):
+                self.events.add_deadline(i, now + self.MAX_POLL_TIMEOUT)
                 continue
+            if self.config.verbose:
+                self.add_message(f'Connection {i} timed out')
+            self.score_mirror(conn, False)
+            self.close_connection(i)
+            conn.lock.release()
 
-            conn.last_transfer = time.time()
-            print('do_downloading --> get data')
-            data_buffer = conn.recv_data(self.config.buffer_size)
+    def dispatch_connection(self, i):
+        ''' Handle a connection which has data to read, its lock is held by the caller. '''
+        conn = self.conns[i]
+        self.get_rate_limiters(conn)
+        throttle_delay = self.throttle_delay(conn.rate_limiter)
+        if throttle_delay > 0:
+            # The connection used up its own tokens, stop watching it until the refill.
+            self.events.pause(i, time.time() + throttle_delay, conn.has_buffered_data())
+            return
+        max_bytes = self.allowed_bytes(conn)
+        if max_bytes == 0:
+            # Other connections took the global tokens during this pass.
+            if conn.has_buffered_data():
+                self.events.mark_pending(i)
+            return
 
-            if data_buffer is None:
-                if self.config.verbose:
-                    self.add_message(f'Error on connection {i}, connection closed')
-                conn.disconnect()
-                conn.lock.release()
-                continue
-            
-            if data_buffer == b'':
-                if conn.current_byte <= conn.last_byte and self.file_size != Connection.MAX_FILESIZE:
-                    self.add_message(f'Connection {i} unexpectedly closed')
-                else:
-                    self.add_message(f'Connection {i} finished')
-                if not conn.resuming_supported:
-                    self.ready = True
-                conn.disconnect()
-                self.reactivate_connection(i)
-                conn.lock.release()
-                continue
-            
-            remaining = conn.last_byte - conn.current_byte
-            data_buffer_size = len(data_buffer)
-            if remaining < data_buffer_size:
-                if self.config.verbose:
-                    self.add_message(f'Connection {i} finished')
-                conn.disconnect()
-                data_buffer_size = remaining
-            print('do_downloading --> before write')
-            os.lseek(self.output_fd, conn.current_byte, os.SEEK_SET)
-            try:
-                os.write(self.output_fd, data_buffer[:data_buffer_size])
-            except Exception as e:
-                self.add_message(f'File write error! {e.args[-1]}')
-                self.ready = False
-                conn.lock.release()
-                return
-            
-            conn.current_byte += data_buffer_size
-            self.bytes_done += data_buffer_size
+        conn.last_transfer = time.time()
+        remaining = conn.last_byte - conn.current_byte
+        data_buffer = None
+        spliced = False
+        try:
+            if self.is_splice_usable(conn):
+                spliced = True
+                data_buffer_size = self.splice_data(conn, remaining, max_bytes)
+            elif self.output_map is not None and remaining > 0:
+                data_buffer_size = self.recv_into_map(conn, min(remaining, max_bytes))
+            else:
+                max_bytes = min(self.config.buffer_size, max_bytes)
+                if conn.is_multipart():
+                    # The next part header follows the range.
+                    max_bytes = min(max_bytes, remaining)
+                data_buffer = conn.recv_data(max_bytes)
+                data_buffer_size = len(data_buffer)
+        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            # Nothing to read after all, e.g. a Tls record is incomplete, try it next time.
+            return
+        except Exception as e:
+            self.add_message(f'File write error! {e.args[-1]}')
+            self.ready = False
+            return
 
-            if data_buffer_size == remaining:
-                self.reactivate_connection(i)
-            
-            conn.lock.release()
-            continue
+        if data_buffer_size is None:
+            if self.config.verbose:
+                self.add_message(f'Error on connection {i}, connection closed')
+            self.score_mirror(conn, False)
+            self.close_connection(i)
+            return
+        self.consume_tokens(conn, data_buffer_size)
 
-        if self.ready:
+        if data_buffer_size == 0:
+            if conn.current_byte < conn.last_byte and self.file_size != Connection.MAX_FILESIZE:
+                self.add_message(f'Connection {i} unexpectedly closed')
+                self.score_mirror(conn, False)
+            else:
+                self.add_message(f'Connection {i} finished')
+            if not conn.resuming_supported:
+                self.ready = True
+            self.close_connection(i)
+            self.reactivate_connection(i)
             return
-        print('do_downloading --> downloading_maintance')
-        self.downloading_maintance()
-        print('do_downloading --> downloading_maintance end')
 
-    def wait_for_data(self):
-        ''' Wait data on (one of) the connections '''
-        ready_connections = []
-        for conn in self.conns:
-            # Skip connection if setup thread hasn't released the lock yet.
-            # enabled is shared variable.
-            if conn.lock.acquire(blocking=False):
-                if conn.enabled and conn.is_connected():
-                    ready_connections.append(conn)
-                conn.lock.release()
-        return ready_connections
+        # How far the response has been read, data past the range is dropped.
+        position = conn.current_byte + data_buffer_size
+        if remaining < data_buffer_size:
+            data_buffer_size = remaining
+
+        covered, losers = self.segments.advance(i, conn.current_byte, data_buffer_size)
+        if self.checksum is not None and not spliced:
+            self.update_checksum(i, conn.current_byte, data_buffer, data_buffer_size)
+        if data_buffer is None:
+            # Spliced or mapped, the data is in the file already.
+            self.bytes_done += covered
+        elif not self.write_data(i, conn, data_buffer[:data_buffer_size], covered):
+            return
+        self.refetch_failed_pieces(i)
+        conn.current_byte += data_buffer_size
+        conn.speed_bytes += data_buffer_size
+        for loser in losers:
+            if self.config.verbose:
+                self.add_message(f'Connection {i} won the race against connection {loser}')
+            self.cancel_connection(loser)
+
+        if data_buffer_size == remaining:
+            if self.config.verbose:
+                self.add_message(f'Connection {i} finished')
+            self.release_connection(i, position)
+        elif conn.has_buffered_data():
+            self.events.mark_pending(i)
+
+    def release_connection(self, i, position):
+        '''
+        Connection i is done with its range and read the response up to position.
+        If the response ends there and the server keeps the socket open, the
+        next range is asked for on it right away, or it waits in the pool when
+        there is no work left. Otherwise the connection is closed.
+        In a multipart response, the next part is the next queued range.
+        '''
+        conn = self.conns[i]
+        if conn.is_multipart() and position == conn.part_end and self.segments.next_queued(i, conn):
+            self.events.unregister(i)
+            conn.enabled = False
+            if self.writer is not None:
+                self.writer.flush(i)
+            self.start_setup_thread(i)
+            return
+        if self.pool is None or not conn.is_reusable(position):
+            self.close_connection(i)
+            self.reactivate_connection(i)
+            return
+        self.events.unregister(i)
+        conn.enabled = False
+        if self.writer is not None:
+            self.writer.flush(i)
+        self.reactivate_connection(i)
+        if conn.current_byte < conn.last_byte:
+            self.start_setup_thread(i)
+        else:
+            self.pool.put(conn)
+
+    def update_checksum(self, i, offset, data_buffer, nbytes):
+        ''' Hash received data, data_buffer is None when it was received into the mapping. '''
+        if data_buffer is not None:
+            self.checksum.update(i, offset, data_buffer[:nbytes])
+            return
+        with self.output_view[offset:offset + nbytes] as view:
+            self.checksum.update(i, offset, view)
+
+    def refetch_failed_pieces(self, i):
+        '''
+        Pieces connection i has just completed which don't match their hash,
+        e.g. Metalink pieces, are fetched again at once. The writer queues
+        the bad data first, so the new data is written after it.
+        '''
+        if self.checksum is None:
+            return
+        failed_ranges = self.checksum.take_failed_ranges()
+        if not failed_ranges:
+            return
+        if self.writer is not None:
+            self.writer.flush(i)
+        for start, end in failed_ranges:
+            self.segments.reopen(start, end)
+            self.checksum.forget(start, end)
+            self.bytes_done -= end - start
+            self.add_message(f'Piece {start}-{end} doesn\'t match its hash, fetching it again.')
+        if failed_ranges[0][0] < self.checksum.hashed_to or self.is_checksum_reading():
+            # The file digest went over the bad data, or the reader may.
+            self.checksum.restart()
+        # Bad data isn't a passing failure, the mirror has another file.
+        mirror = self.conns[i].mirror
+        if mirror is not None and self.mirrors.drop(mirror):
+            self.add_message(f'Mirror {mirror.url} sent data which doesn\'t match the hashes, not using it any more')
+
+    def read_output_file(self, offset, size):
+        if self.output_map is not None:
+            return self.output_map[offset:offset + size]
+        return os.pread(self.output_fd, size, offset)
+
+    def catch_up_checksum(self):
+        '''
+        Hash the contiguous prefix as far as it goes. The parts which came out
+        of order are read back from the file by the checksum reader, so the
+        download loop doesn't wait for the disk.
+        '''
+        if self.checksum is None or self.is_checksum_reading():
+            return
+        done_ranges = self.segments.done_ranges()
+        if not done_ranges or done_ranges[0][0] > 0 or done_ranges[0][1] <= self.checksum.hashed_to:
+            return
+        if self.writer is not None:
+            self.writer.flush_all(wait=True)
+            self.collect_written()
+        self.start_checksum_reader(done_ranges[0][1])
+
+    def start_checksum_reader(self, end, missing_blocks=False):
+        self.checksum_reader = threading.Thread(target=self.read_checksum, args=(end, missing_blocks), daemon=True)
+        self.checksum_reader.start()
+
+    def is_checksum_reading(self):
+        return self.checksum_reader is not None and self.checksum_reader.is_alive()
+
+    def join_checksum_reader(self):
+        if self.checksum_reader is not None:
+            self.checksum_reader.join()
+            self.checksum_reader = None
+
+    def read_checksum(self, end, missing_blocks):
+        ''' Runs in the checksum reader, unless the download loop is done anyway. '''
+        try:
+            self.checksum.catch_up(self.read_output_file, end)
+            if missing_blocks:
+                self.checksum.hash_missing_blocks(self.read_output_file)
+        except (OSError, ValueError) as e:
+            # Hashed as far as it went, a mismatch is reported.
+            self.add_message(f'Reading back the file for the checksum failed, {e}')
+        self.events.wakeup()
+
+    def verify_checksum(self, refetch=True, wait=False):
+        '''
+        Called when all bytes are in. Return True if the download is finished:
+        the checksum matches, or it doesn't and there is nothing to fetch again.
+        The rest of the file is hashed by the checksum reader first, False is
+        returned until it's done, unless wait.
+        Blocks which fail their piece hashes are fetched again, and the file is
+        hashed once more.
+        '''
+        if self.is_checksum_reading() and not wait:
+            return False
+        self.join_checksum_reader()
+        if not self.checksum_read_back:
+            if self.writer is not None:
+                self.writer.flush_all(wait=True)
+                self.collect_written()
+            if self.is_file_size_known():
+                end = self.file_size
+            else:
+                end = os.fstat(self.output_fd).st_size
+            if not wait:
+                self.checksum_read_back = True
+                self.start_checksum_reader(end, missing_blocks=True)
+                return False
+            self.read_checksum(end, missing_blocks=True)
+        self.checksum_read_back = False
+        if self.checksum.matches():
+            self.add_message(f'The {self.checksum.algorithm} checksum is correct.')
+            return True
+        bad_ranges = self.checksum.bad_ranges()
+        if not refetch or not bad_ranges or self.checksum_retries >= self.MAX_CHECKSUM_RETRIES:
+            if self.checksum.expected is None:
+                self.add_message(f'Checksum mismatch! {len(bad_ranges)} ranges don\'t match their piece hashes.')
+            else:
+                self.add_message(
+                    f'Checksum mismatch! {self.checksum.algorithm} is {self.checksum.hexdigest()}, '
+                    f'expected {self.checksum.expected.hex()}.'
+                )
+            return True
+        self.checksum_retries += 1
+        for start, end in bad_ranges:
+            self.segments.reopen(start, end)
+            self.checksum.forget(start, end)
+            self.bytes_done -= end - start
+        self.checksum.restart()
+        self.add_message(
+            f'Checksum mismatch, fetching {sum(end - start for start, end in bad_ranges)} bytes again.'
+        )
+        return False
+
+    def recv_into_map(self, conn, max_bytes):
+        ''' Receive at the connection's position in the mapped output file. '''
+        offset = conn.current_byte
+        with self.output_view[offset:offset + max_bytes] as view:
+            return conn.recv_data_into(view)
+
+    def write_data(self, i, conn, data_buffer, covered, pooled=True):
+        '''
+        Write data received by connection i at its current_byte, covered is the
+        part of it the segment map counts as new.
+        With the writer, the data is queued and counted in bytes_done once it's
+        written. pooled means data_buffer is a view of the connection's receive
+        buffer, which then goes to the writer along with it.
+        '''
+        if self.output_map is not None:
+            self.output_view[conn.current_byte:conn.current_byte + len(data_buffer)] = data_buffer
+            self.bytes_done += covered
+            return True
+        if self.writer is not None:
+            buffer = None
+            if pooled:
+                buffer = conn.swap_data_buffer(self.writer.get_buffer())
+            self.writer.add(i, conn.current_byte, data_buffer, covered, buffer)
+            return True
+        try:
+            os.pwrite(self.output_fd, data_buffer, conn.current_byte)
+        except OSError as e:
+            self.add_message(f'File write error! {e.args[-1]}')
+            self.ready = False
+            return False
+        self.bytes_done += covered
+        return True
+
+    def is_splice_usable(self, conn):
+        '''
+        splice(2) only works on a plain socket, Tls data has to be decrypted in userspace.
+        Leftover bytes from the header read are written in userspace first.
+        '''
+        return self.config.splice_transfer and self.splice_supported \
+            and not conn.is_secure_scheme() \
+            and not conn.has_buffered_data() \
+            and conn.last_byte > conn.current_byte
+
+    def splice_data(self, conn, remaining, max_bytes):
+        '''
+        Move data from socket to the output file through a pipe with splice(2),
+        the data never enters Python. Never reads past the connection's range.
+        Return the number of bytes written, 0 if the server closed the connection
+        and None on connection errors.
+        '''
+        pipe_r, pipe_w = conn.get_splice_pipe()
+        try:
+            nbytes = os.splice(
+                conn.get_socket_fd().fileno(),
+                pipe_w,
+                min(remaining, conn.splice_pipe_size, max_bytes),
+                flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+            )
+        except BlockingIOError:
+            # do_downloading() tries it again next time.
+            raise
+        except OSError as e:
+            if e.errno not in self.SPLICE_UNSUPPORTED:
+                sys.stderr.write(f'Exception in {__name__}: {e.args[-1]}\n')
+                return None
+            self.disable_splice(e)
+            # Nothing was read, the next try goes through userspace.
+            raise BlockingIOError(e.errno, e.strerror)
+
+        offset = conn.current_byte
+        left = nbytes
+        try:
+            while left > 0:
+                try:
+                    moved = os.splice(pipe_r, self.output_fd, left, offset_dst=offset, flags=os.SPLICE_F_MOVE)
+                except OSError as e:
+                    if e.errno not in self.SPLICE_UNSUPPORTED:
+                        raise
+                    # The file system can't take spliced data, the bytes are already
+                    # in the pipe, so write them out in userspace.
+                    self.disable_splice(e)
+                    moved = os.pwrite(self.output_fd, os.read(pipe_r, left), offset)
+                offset += moved
+                left -= moved
+        except OSError as e:
+            # E.g. the disk is full. The bytes left in the pipe would be taken
+            # for the next ones, so the pipe goes and the range is asked for again.
+            self.add_message(f'File write error! {e.args[-1]}')
+            conn.close_splice_pipe()
+            return None
+        return nbytes
+
+    def new_rate_limiter(self, rate):
+        burst = self.config.max_speed_burst or rate // 4
+        return TokenBucket(rate, max(self.config.buffer_size, burst))
+
+    def get_rate_limiters(self, conn):
+        ''' The global token bucket and the connection's own one, if asked for. '''
+        if self.config.max_speed_per_connection > 0 and conn.rate_limiter is None:
+            conn.rate_limiter = self.new_rate_limiter(self.config.max_speed_per_connection)
+        return [limiter for limiter in (self.rate_limiter, conn.rate_limiter) if limiter is not None]
+
+    def allowed_bytes(self, conn):
+        ''' Bytes the rate limiters let the connection read now. '''
+        max_bytes = Connection.MAX_FILESIZE
+        for limiter in self.get_rate_limiters(conn):
+            max_bytes = min(max_bytes, limiter.available())
+        return max_bytes
+
+    def consume_tokens(self, conn, nbytes):
+        for limiter in self.get_rate_limiters(conn):
+            limiter.consume(nbytes)
+
+    def throttle_delay(self, limiter):
+        ''' Seconds until the limiter allows a full buffer to be read. '''
+        if limiter is None:
+            return 0
+        return limiter.time_until(self.config.buffer_size)
+
+    def read_delay(self, conn):
+        ''' Seconds until both the global and the connection's limiter allow a read. '''
+        self.get_rate_limiters(conn)
+        return max(self.throttle_delay(self.rate_limiter), self.throttle_delay(conn.rate_limiter))
+
+    def disable_splice(self, error):
+        self.splice_supported = False
+        self.add_message(f'splice() not supported here, using normal writes. {error.args[-1]}')
 
     def connections_check(self):
         ''' Look for aborted connections and attempt to restart them. '''
         for i, conn in enumerate(self.conns):
-            if conn.last_transfer is None or not conn.lock.acquire(blocking=False):
+            if conn.retired:
                 continue
-            if not conn.enabled and conn.current_byte < conn.last_byte:
-                if not conn.in_progress:
-                    # Wait for termination of this thread
-                    conn.setup_thread.join()
-
-                    if self.config.verbose:
-                        self.add_message('Connection {0} downloading from {1}:{2} using interface {3}'
-                            .format(i, conn.host, conn.port, conn.local_ifs))
-                    conn.in_progress = True
-                    conn.setup_thread = threading.Thread(
-                        target=self.setup_connection_thread,
-                        args=(conn,)
-                    )
-                    conn.setup_thread.start()
-                elif time.time() > conn.last_transfer + self.config.reconnect_delay:
+            if conn.enabled and conn.mirror is not None and conn.mirror.dropped \
+                and conn.lock.acquire(blocking=False):
+                # It goes on with its range from another mirror.
+                self.close_connection(i)
+                conn.lock.release()
+            if not conn.enabled and not conn.in_progress:
+                # Idle connections look for work again, there may be some to steal now.
+                self.reactivate_connection(i)
+                self.release_idle_connection(i)
+                if conn.retired:
+                    continue
+            if conn.enabled or conn.current_byte >= conn.last_byte:
+                continue
+            if conn.in_progress:
+                # The setup thread holds the lock, cancel it if it's stuck.
+                # The thread only sees the exception when it's back from a blocking
+                # call, so don't wait for it here.
+                if time.time() > conn.last_transfer + self.config.reconnect_delay:
                     self.__cancel_thread(conn.setup_thread.ident)
-                    conn.in_progress = False
-                    conn.setup_thread.join()
+                    conn.last_transfer = time.time()
+                continue
+            if not conn.lock.acquire(blocking=False):
+                continue
+            if conn.setup_thread:
+                # Wait for termination of this thread
+                conn.setup_thread.join()
+            self.start_setup_thread(i)
             conn.lock.release()
 
     def calculate_average_speed_and_finish_time(self):
-        self.bytes_per_second = (self.bytes_done - self.start_byte) // (time.time() - self.start_time)
+        now = time.time()
+        for conn in self.conns:
+            conn.update_speed(now)
+        self.interfaces.update(self.conns)
+        self.mirrors.update(self.conns)
+        self.bytes_per_second = (self.bytes_done - self.start_byte) // (now - self.start_time)
         if self.bytes_per_second != 0:
             self.finish_time = int(
-                self.start_time + (self.file_size - self.start_time) / self.bytes_per_second
+                now + (self.file_size - self.bytes_done) / self.bytes_per_second
             )
         else:
             self.finish_time = None
 
-    def adjust_downloading_speed(self):
-        if self.config.max_speed <= 0:
-            return
-        max_speed_ratio = 1000 * self.bytes_per_second / self.config.max_speed
-        if max_speed_ratio > 1000 * self.DELAY_ADJUST_PERCENT:
-            self.delay_time_for_process['nsec'] += Process.NSECs_variation
-        elif max_speed_ratio < 1000 * (1 - self.DELAY_ADJUST_PERCENT):
-            if self.delay_time_for_process['nsec'] >= Process.NSECs_variation:
-                self.delay_time_for_process['nsec'] -= Process.NSECs_variation
-            elif self.delay_time_for_process['sec'] > 0:
-                self.delay_time_for_process['sec'] -= 1
-                self.delay_time_for_process['nsec'] += Process.NSECs_IN_1_SEC - Process.NSECs_variation
+    def tune_connections(self):
+        ''' Let the tuner add or retire connections, only with -n auto. '''
+        if self.tuner is None or not self.is_resuming_supported():
+            return
+        last_conn = self.conns[-1]
+        if len(self.conns) > self.tuner.initial_connections \
+            and last_conn.setup_failed and not last_conn.retired:
+            # The server refuses more connections.
+            if self.config.verbose:
+                self.add_message(f'Connection {len(self.conns) - 1} refused, no more connections added')
+            last_conn.retired = True
+            self.tuner.refused(len(self.conns))
+            self.connections_to_retire += 1
         else:
-            self.delay_time_for_process['sec'] = 0
-            self.delay_time_for_process['nsec'] = 0
-        self.process_sleep(self.delay_time_for_process)
+            decision = self.tuner.evaluate(time.time(), self.bytes_done, len(self.conns))
+            if decision == ConnectionTuner.ADD and not self.add_connection():
+                self.tuner.stop_growing()
+            elif decision == ConnectionTuner.RETIRE:
+                self.connections_to_retire += 1
+        if self.connections_to_retire > 0 and self.retire_connection():
+            self.connections_to_retire -= 1
+
+    def tune_socket_buffers(self):
+        '''
+        With --rcvbuf=auto, size the receive buffers and the reads from the
+        bandwidth-delay product of connection 0, the probe's connection. The
+        throughput may grow with the bigger buffers, so it's measured again
+        at each maintenance, the buffers only ever grow.
+        '''
+        options = self.socket_options
+        if not options.auto_rcvbuf:
+            return
+        conn = self.conns[0]
+        if conn.speed == 0:
+            return
+        sock = conn.get_socket_fd() if conn.is_connected() else None
+        rtt = (SocketOptions.get_rtt(sock) if sock is not None else None) or conn.tcp.rtt
+        if not rtt:
+            return
+        rcvbuf = options.get_auto_rcvbuf(rtt, conn.speed)
+        # Leave out small changes, each one costs a syscall per connection.
+        if rcvbuf <= options.rcvbuf * 5 // 4:
+            return
+        options.rcvbuf = rcvbuf
+        for other_conn in self.conns:
+            if other_conn.is_connected():
+                options.grow_receive_buffer(other_conn.get_socket_fd(), rcvbuf)
+        self.config.buffer_size = max(self.config.buffer_size, min(rcvbuf // 2, self.MAX_AUTO_READ_SIZE))
+        if self.writer is not None:
+            self.writer.buffer_size = self.config.buffer_size
+        if self.config.verbose:
+            self.add_message(
+                f'RTT {rtt * 1000:.1f} ms at {int(conn.speed)} B/s: '
+                f'receive buffers of {rcvbuf} bytes, reads of {self.config.buffer_size} bytes'
+            )
+
+    def add_connection(self):
+        ''' Add one connection and hand it work the same way as an idle one. '''
+        if self.reserve_connections(1) == 0:
+            return False
+        self.prepare_connections(1)
+        i = len(self.conns) - 1
+        conn = self.conns[i]
+        self.init_connection(conn)
+        conn.current_byte = 0
+        conn.last_byte = 0
+        self.reactivate_connection(i)
+        if conn.current_byte >= conn.last_byte:
+            # Nothing worth splitting any more.
+            del self.conns[i]
+            self.release_connections(1)
+            return False
+        self.config.num_of_connections += 1
+        if self.config.verbose:
+            self.add_message(f'Adding connection {i}')
+        self.start_setup_thread(i)
+        return True
+
+    def retire_connection(self):
+        '''
+        Stop the most recently added connection, what's left of its range
+        becomes pending and is picked up by the others.
+        '''
+        i = len(self.conns) - 1
+        conn = self.conns[i]
+        if i == 0 or conn.in_progress or not conn.lock.acquire(blocking=False):
+            return False
+        conn.retired = True
+        self.segments.release(i)
+        self.close_connection(i)
+        conn.lock.release()
+        del self.conns[i]
+        self.config.num_of_connections -= 1
+        if conn not in self.released_conns:
+            self.release_connections(1)
+        if self.config.verbose:
+            self.add_message(f'Retired connection {i}')
+        return True
+
+    def check_if_remote_changed(self):
+        '''
+        A connection's If-Range request got the whole file back, so it changed
+        on the server. The ranges downloaded so far are useless, the tasker
+        starts over, and the state file saved by terminate() doesn't match
+        the new validators any more. A connection still setting up may be on
+        a mirror, which is dropped instead, see score_mirror().
+        '''
+        if not any(conn.remote_changed and not conn.in_progress for conn in self.conns):
+            return False
+        self.add_message('The file has changed on the server, starting over.')
+        self.restart_needed = True
+        return True
 
     def check_if_bytes_done(self):
         if self.bytes_done >= self.file_size:
-            self.ready = True
+            self.ready = self.checksum is None or self.verify_checksum()
 
     def terminate(self):
         ''' 
         Terminate a downloading process
         Reviewed on 5/22/2020
         '''
-        for conn in self.conns:
-            if conn.setup_thread:
+        for i, conn in enumerate(self.conns):
+            if conn.setup_thread and conn.setup_thread.is_alive():
                 self.__cancel_thread(conn.setup_thread.ident)
                 conn.setup_thread.join()
-            conn.disconnect()
+            self.close_connection(i)
+            conn.close_splice_pipe()
+        if self.owns_pool:
+            self.pool.close()
+        if self.owns_session:
+            self.session.close()
+        self.release_connections(self.extra_slots)
+        if self.config.verbose and self.tls.handshakes:
+            self.add_message(
+                f'Tls handshakes: {self.tls.handshakes}, {self.tls.resumed_handshakes} of them resumed a session.'
+            )
+        if self.writer is not None:
+            self.writer.close()
+            self.collect_written()
+        if self.ready and self.checksum is not None and not self.checksum.checked:
+            # Finished without check_if_bytes_done(), e.g. the size was unknown,
+            # or while the reader was still at it.
+            self.verify_checksum(refetch=False, wait=True)
+        self.join_checksum_reader()
+        self.events.close()
 
         if self.ready and os.path.exists(self.state_filename):
             os.unlink(self.state_filename)
-        elif self.bytes_done > 0:
+        elif self.bytes_done > 0 or self.restart_needed:
             self.save_state()
 
+        self.unmap_output_file()
         os.close(self.output_fd)
 
+    def abandon(self):
+        '''
+        Give up after new_preparation(), without downloading: the warm
+        connections and the probe's socket are closed, and the slots they
+        held go back to the budget, see terminate() for a download.
+        '''
+        self.take_warm_connections(0)
+        for conn in self.conns:
+            conn.disconnect()
+        if self.owns_pool:
+            self.pool.close()
+        if self.owns_session:
+            self.session.close()
+        self.release_connections(self.extra_slots)
+        self.events.close()
+        self.unmap_output_file()
+        if self.output_fd is not None:
+            os.close(self.output_fd)
+            self.output_fd = None
+
     def save_state(self):
+        '''
+        Checkpoint the completed blocks. The data is flushed to disk before the
+        state file records it, and the state file is replaced atomically.
+        '''
         # No use for .st file if the server doesn't support resuming.
         if not self.conns[0].resuming_supported:
             return
-        assert len(self.conns) == self.config.num_of_connections
-        state = {
-            'num_of_connections': self.config.num_of_connections,
-            'bytes_done': self.bytes_done,
-            'connections': []
-        }
-        for conn in self.conns:
-            state['connections'].append(
-                {
-                    'current_byte': conn.current_byte,
-                    'last_byte': conn.last_byte
-                }
-            )
-        with open(self.state_filename, 'w') as file_obj:
-            json.dump(state, file_obj)
-
-    def load_state(self):
-        if os.path.exists(self.state_filename):
-            with open(self.state_filename, 'r') as file_obj:
-                return json.load(file_obj)
-        return None
-
-    @staticmethod
-    def process_sleep(delay):
-        delay_in_seconds = delay['sec'] + delay['nsec'] / Process.NSECs_IN_1_SEC
-        if delay_in_seconds <= Process.SMALLEST_DELAY_IN_SEC:
-            delay_in_seconds = Process.SMALLEST_DELAY_IN_SEC
-        time.sleep(delay_in_seconds)
\ No newline at end of file
+        if self.writer is not None:
+            # Only record what is in the file, so wait for the writer first.
+            self.writer.flush_all(wait=True)
+            self.collect_written()
+            if self.writer.error is not None:
+                return
+        state = StateFile.from_done_ranges(
+            self.file_size,
+            self.config.state_block_size,
+            self.segments.done_ranges(),
+            self.etag,
+            self.last_modified
+        )
+        try:
+            if self.output_map is not None:
+                self.output_map.flush()
+            else:
+                os.fdatasync(self.output_fd)
+            state.save(self.state_filename)
+        except OSError as e:
+            self.add_message(f'Error saving state file. {e.args[-1]}')
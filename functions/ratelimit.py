@@ -0,0 +1,36 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import time
+
+class TokenBucket(object):
+    '''
+    Token bucket for --max-speed, one token is one byte.
+    Tokens are refilled at rate bytes per second and up to burst bytes can be
+    saved up, so a read may go faster than rate for a moment.
+    '''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.last_time = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+
+    def available(self):
+        self.refill()
+        return int(self.tokens)
+
+    def consume(self, nbytes):
+        self.tokens -= nbytes
+
+    def time_until(self, nbytes):
+        ''' Seconds until nbytes tokens are there, at most burst can be waited for. '''
+        self.refill()
+        missing = min(nbytes, self.burst) - self.tokens
+        if missing <= 0:
+            return 0
+        return missing / self.rate
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import socket
+import threading
+
+class Resolver(object):
+    '''
+    getaddrinfo() results cached by (host, port, family), shared by all the
+    connections of a Process, so reconnects don't look the host up again.
+    getaddrinfo() doesn't tell the DNS TTL, so entries live for ttl seconds.
+    Concurrent lookups of the same key wait for a single getaddrinfo() call.
+    Failed lookups are cached for NEGATIVE_TTL seconds.
+    An address that fails to connect goes to the end of its list, so the next
+    connection tries the other ones first. The address which won the last
+    connect, and its family, are tried first, see Tcp.connect().
+    With cache_file, the positive entries are kept on disk between runs.
+    '''
+    NEGATIVE_TTL = 5
+    FILE_VERSION = 1
+
+    def __init__(self, ttl, cache_file=None):
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        # (host, port, family) -> [expiry time, getaddrinfo() results, error args]
+        self.entries = {}
+        # (host, port, family) -> lock held while it's looked up
+        self.lookup_locks = {}
+        # Host -> address family of the last successful connect
+        self.preferred_families = {}
+        if cache_file is not None:
+            self.load()
+
+    def resolve(self, host, port, family):
+        ''' Same results as getaddrinfo() for a TCP stream, raise socket.gaierror on failure. '''
+        key = (host, port, family)
+        entry = self.get_entry(key)
+        if entry is None:
+            with self.lock:
+                lookup_lock = self.lookup_locks.setdefault(key, threading.Lock())
+            with lookup_lock:
+                # Another thread may have looked it up meanwhile.
+                entry = self.get_entry(key)
+                if entry is None:
+                    entry = self.lookup(key)
+        _, addresses, error = entry
+        if error is not None:
+            raise socket.gaierror(*error)
+        return list(addresses)
+
+    def get_entry(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                return entry
+        return None
+
+    def lookup(self, key):
+        host, port, family = key
+        try:
+            addresses = socket.getaddrinfo(
+                host,
+                port,
+                family,
+                socket.SOCK_STREAM,
+                socket.IPPROTO_TCP,
+                socket.AI_ADDRCONFIG
+            )
+            entry = [time.time() + self.ttl, addresses, None]
+        except socket.gaierror as e:
+            entry = [time.time() + self.NEGATIVE_TTL, [], e.args]
+        with self.lock:
+            self.entries[key] = entry
+        return entry
+
+    def report_failure(self, host, port, family, sockaddr):
+        ''' Connecting to sockaddr failed, move it to the end of the list. '''
+        with self.lock:
+            entry = self.entries.get((host, port, family))
+            if entry is None:
+                return
+            failed = [address for address in entry[1] if address[4] == sockaddr]
+            others = [address for address in entry[1] if address[4] != sockaddr]
+            entry[1] = others + failed
+
+    def report_success(self, host, port, family, gai_result):
+        '''
+        Connecting to the address of gai_result won, the next connections to
+        host try it first, and its family before the other one.
+        '''
+        with self.lock:
+            self.preferred_families[host] = gai_result[0]
+            entry = self.entries.get((host, port, family))
+            if entry is None:
+                return
+            winners = [address for address in entry[1] if address[4] == gai_result[4]]
+            others = [address for address in entry[1] if address[4] != gai_result[4]]
+            entry[1] = winners + others
+
+    def get_preferred_family(self, host):
+        with self.lock:
+            return self.preferred_families.get(host)
+
+    def load(self):
+        ''' Take the unexpired entries of the cache file, a broken file is ignored. '''
+        try:
+            with open(self.cache_file, 'r') as file_obj:
+                data = json.load(file_obj)
+            if data['version'] != self.FILE_VERSION:
+                return
+            now = time.time()
+            for item in data['entries']:
+                if item['expires'] <= now:
+                    continue
+                addresses = [
+                    (family, sock_type, proto, canonname, tuple(sockaddr))
+                    for family, sock_type, proto, canonname, sockaddr in item['addresses']
+                ]
+                self.entries[(item['host'], item['port'], item['family'])] = [item['expires'], addresses, None]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def save(self):
+        ''' Write the unexpired entries to the cache file, errors are ignored. '''
+        if self.cache_file is None:
+            return
+        now = time.time()
+        with self.lock:
+            items = [
+                {
+                    'host': host,
+                    'port': port,
+                    'family': int(family),
+                    'expires': expires,
+                    'addresses': [
+                        [int(address[0]), int(address[1]), address[2], address[3], list(address[4])]
+                        for address in addresses
+                    ],
+                }
+                for (host, port, family), (expires, addresses, error) in self.entries.items()
+                if error is None and expires > now
+            ]
+        temp_filename = ''.join([self.cache_file, '.tmp'])
+        try:
+            with open(temp_filename, 'w') as file_obj:
+                json.dump({'version': self.FILE_VERSION, 'entries': items}, file_obj)
+            os.replace(temp_filename, self.cache_file)
+        except OSError:
+            pass
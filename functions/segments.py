@@ -0,0 +1,299 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import bisect
+
+class Segment(object):
+    '''
+    A byte range [start, end) of the output file.
+    Bytes in [start, done_to) are received already, the writer may still
+    hold some of them.
+    A QUEUED segment is asked for by a connection along with its range, it
+    comes later in the same response.
+    '''
+    PENDING = 0
+    ACTIVE = 1
+    DONE = 2
+    QUEUED = 3
+
+    def __init__(self, start, end, state):
+        self.start = start
+        self.end = end
+        self.state = state
+        self.done_to = end if state == Segment.DONE else start
+        # Indexes of the connections downloading this range, two when it's raced
+        self.owners = []
+
+    def remaining(self):
+        return self.end - self.done_to
+
+class SegmentMap(object):
+    '''
+    Ordered, non-overlapping segments covering the whole file, each one pending,
+    in-flight (ACTIVE) or done.
+    An ACTIVE segment mirrors its owner's current_byte/last_byte, the map keeps
+    those two in sync when it moves work between connections.
+    '''
+    def __init__(self, file_size):
+        self.file_size = file_size
+        self.segments = []
+        # Segment starts, kept in step with self.segments for bisect
+        self.starts = []
+        # Connection index -> the ACTIVE segment it works on
+        self.owned = {}
+        # Connection index -> its QUEUED segments, in the order asked for
+        self.queued = {}
+
+    @classmethod
+    def from_connections(cls, file_size, conns):
+        '''
+        Build the map from the connections' ranges, e.g. after divide() or restoring
+        a state file. Whatever no connection still has to download is done.
+        '''
+        segment_map = cls(file_size)
+        position = 0
+        ranges = sorted(
+            (conn.current_byte, conn.last_byte, i)
+            for i, conn in enumerate(conns)
+            if conn.current_byte < conn.last_byte
+        )
+        for current_byte, last_byte, i in ranges:
+            if current_byte > position:
+                segment_map.insert(Segment(position, current_byte, Segment.DONE))
+            segment = Segment(current_byte, last_byte, Segment.ACTIVE)
+            segment.owners.append(i)
+            segment_map.owned[i] = segment
+            segment_map.insert(segment)
+            position = last_byte
+        if position < file_size:
+            segment_map.insert(Segment(position, file_size, Segment.DONE))
+        return segment_map
+
+    @classmethod
+    def from_done_ranges(cls, file_size, done_ranges):
+        '''
+        Build the map from a restored state file: the done ranges are done,
+        the holes between them are pending.
+        '''
+        segment_map = cls(file_size)
+        position = 0
+        for start, end in done_ranges:
+            if start > position:
+                segment_map.insert(Segment(position, start, Segment.PENDING))
+            segment_map.insert(Segment(start, end, Segment.DONE))
+            position = end
+        if position < file_size:
+            segment_map.insert(Segment(position, file_size, Segment.PENDING))
+        return segment_map
+
+    def insert(self, segment):
+        index = bisect.bisect_right(self.starts, segment.start)
+        self.starts.insert(index, segment.start)
+        self.segments.insert(index, segment)
+
+    def remove(self, segment):
+        index = self.segments.index(segment)
+        del self.starts[index]
+        del self.segments[index]
+
+    def bytes_left(self):
+        return sum(segment.remaining() for segment in self.segments if segment.state != Segment.DONE)
+
+    def set_range(self, conn, segment):
+        conn.current_byte = segment.done_to
+        conn.last_byte = segment.end
+
+    def assign(self, i, conn):
+        ''' Give connection i the first pending segment, if there is one. '''
+        for segment in self.segments:
+            if segment.state == Segment.PENDING:
+                segment.state = Segment.ACTIVE
+                segment.owners = [i]
+                self.owned[i] = segment
+                self.set_range(conn, segment)
+                return True
+        return False
+
+    def release(self, i):
+        '''
+        Connection i gives its range up. What it has written stays done, the
+        rest becomes pending unless another connection is racing it.
+        '''
+        self.release_queued(i)
+        segment = self.owned.pop(i, None)
+        if segment is None:
+            return
+        segment.owners.remove(i)
+        if segment.owners:
+            return
+        if segment.done_to > segment.start:
+            self.remove(segment)
+            self.insert(Segment(segment.start, segment.done_to, Segment.DONE))
+            segment = Segment(segment.done_to, segment.end, Segment.PENDING)
+            self.insert(segment)
+        segment.state = Segment.PENDING
+
+    def queue(self, i, after, max_count, max_size):
+        '''
+        Queue up to max_count pending segments of at most max_size bytes from
+        offset after on, for connection i. Neighbours are left out, a server
+        may merge them into one range. Return their ranges.
+        '''
+        queued = self.queued.setdefault(i, [])
+        end = after
+        for segment in self.segments[bisect.bisect_left(self.starts, after):]:
+            if len(queued) >= max_count:
+                break
+            if segment.state != Segment.PENDING or segment.remaining() > max_size or segment.start <= end:
+                continue
+            segment.state = Segment.QUEUED
+            queued.append(segment)
+            end = segment.end
+        return [(segment.start, segment.end) for segment in queued]
+
+    def next_queued(self, i, conn):
+        ''' Make the next queued segment of connection i its range, if there is one. '''
+        queued = self.queued.get(i)
+        if not queued:
+            return False
+        segment = queued.pop(0)
+        segment.state = Segment.ACTIVE
+        segment.owners = [i]
+        self.owned[i] = segment
+        self.set_range(conn, segment)
+        return True
+
+    def release_queued(self, i):
+        ''' The segments connection i won't get after all are pending again. '''
+        for segment in self.queued.pop(i, []):
+            segment.state = Segment.PENDING
+
+    def advance(self, i, offset, nbytes):
+        '''
+        Connection i has written nbytes at offset.
+        Return the number of bytes not written before, and the other connections
+        still racing the segment if it's now complete.
+        '''
+        segment = self.owned.get(i)
+        if segment is None:
+            return nbytes, []
+        end = offset + nbytes
+        covered = max(0, end - max(offset, segment.done_to))
+        segment.done_to = max(segment.done_to, end)
+        losers = []
+        if segment.done_to >= segment.end:
+            segment.state = Segment.DONE
+            for owner in segment.owners:
+                del self.owned[owner]
+                if owner != i:
+                    losers.append(owner)
+            segment.owners = []
+        return covered, losers
+
+    @staticmethod
+    def estimated_time(segment, speeds):
+        ''' Time the segment\'s owner needs to finish it, unknown speed counts as forever. '''
+        speed = speeds[segment.owners[0]]
+        if speed > 0:
+            return segment.remaining() / speed
+        return float('inf')
+
+    @staticmethod
+    def get_speeds(conns, speeds):
+        ''' speeds are the expected speeds of the connections, their own ones if None. '''
+        if speeds is None:
+            return [conn.speed for conn in conns]
+        return speeds
+
+    def slowest_segment(self, conns, min_remaining, speeds=None):
+        '''
+        The segment with one owner and the most estimated remaining time,
+        with more than min_remaining bytes left.
+        '''
+        speeds = self.get_speeds(conns, speeds)
+        slowest = None
+        slowest_key = None
+        for segment in self.segments:
+            if segment.state != Segment.ACTIVE or len(segment.owners) != 1:
+                continue
+            if segment.remaining() <= min_remaining:
+                continue
+            key = (self.estimated_time(segment, speeds), segment.remaining())
+            if slowest_key is None or key > slowest_key:
+                slowest = segment
+                slowest_key = key
+        return slowest
+
+    def steal(self, i, conns, min_chunk, speeds=None):
+        '''
+        Split the segment with the most estimated remaining time, so both
+        connections finish at about the same time, and give the tail to connection i.
+        '''
+        speeds = self.get_speeds(conns, speeds)
+        victim = self.slowest_segment(conns, min_chunk, speeds)
+        if victim is None:
+            return False
+        victim_speed = speeds[victim.owners[0]]
+        thief_speed = speeds[i]
+        remaining = victim.remaining()
+        if victim_speed > 0 and thief_speed > 0:
+            keep = int(remaining * victim_speed / (victim_speed + thief_speed))
+        else:
+            keep = remaining // 2
+        keep = max(1, min(keep, remaining - 1))
+        cut = victim.done_to + keep
+
+        segment = Segment(cut, victim.end, Segment.ACTIVE)
+        segment.owners = [i]
+        self.owned[i] = segment
+        victim.end = cut
+        conns[victim.owners[0]].last_byte = cut
+        self.insert(segment)
+        self.set_range(conns[i], segment)
+        return True
+
+    def race(self, i, conns, speeds=None):
+        '''
+        End-game: download the rest of the slowest segment on connection i as well,
+        the first one to finish it wins.
+        '''
+        segment = self.slowest_segment(conns, 0, speeds)
+        if segment is None:
+            return False
+        segment.owners.append(i)
+        self.owned[i] = segment
+        self.set_range(conns[i], segment)
+        return True
+
+    def reopen(self, start, end):
+        '''
+        Make the received bytes in [start, end) pending again, e.g. blocks that
+        failed verification. They may be in a range still being downloaded,
+        its owners go on with the rest of it.
+        '''
+        for segment in list(self.segments):
+            done_to = segment.end if segment.state == Segment.DONE else segment.done_to
+            if done_to <= start or segment.start >= end or done_to <= segment.start:
+                continue
+            self.remove(segment)
+            if segment.start < start:
+                self.insert(Segment(segment.start, start, Segment.DONE))
+            self.insert(Segment(max(start, segment.start), min(end, done_to), Segment.PENDING))
+            if segment.state != Segment.DONE:
+                segment.start = min(end, done_to)
+                self.insert(segment)
+            elif segment.end > end:
+                self.insert(Segment(end, segment.end, Segment.DONE))
+
+    def done_ranges(self):
+        ''' The received parts of the file as sorted, merged (start, end) ranges. '''
+        ranges = []
+        for segment in self.segments:
+            end = segment.end if segment.state == Segment.DONE else segment.done_to
+            if end <= segment.start:
+                continue
+            if ranges and ranges[-1][1] == segment.start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((segment.start, end))
+        return ranges
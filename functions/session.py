@@ -0,0 +1,27 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from .pool import ConnectionPool
+from .resolver import Resolver
+from .tls import TlsContext
+
+class Session(object):
+    '''
+    What the connections of a Process share, and so do the Processes of a
+    batch: the host lookups, the Tls sessions, the ConnectionBudget of the
+    batch, if any, and the idle keep-alive sockets with the thread engine.
+    An asyncio stream belongs to the event loop of its Process, so each
+    AsyncProcess keeps a pool of its own.
+    '''
+    def __init__(self, config, budget=None):
+        self.resolver = Resolver(config.dns_ttl, config.dns_cache_file)
+        self.tls = TlsContext(config.insecure, config.tls_ciphers, config.tls_alpn)
+        self.budget = budget
+        self.pool = None
+        if config.keep_alive and config.engine == 'thread':
+            self.pool = ConnectionPool()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+        self.resolver.save()
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import sys
+import socket
+import struct
+
+class SocketOptions(object):
+    '''
+    Options set on the data sockets, shared by the connections of a Process.
+    rcvbuf and the Tcp Fast Open flag have to be set before the socket connects,
+    the receive window scale is fixed by then. With fastopen, a repeat
+    connection to a server which gave a cookie before sends its first bytes
+    along with the SYN, connect() returns at once then.
+    The quick ack mode doesn't stick, so the thread engine sets it again
+    before each read, see Tcp.recv_into().
+    With auto_rcvbuf, Process sizes rcvbuf from the bandwidth-delay product
+    it measures, see get_auto_rcvbuf().
+    '''
+    # Not in the socket module before Python 3.12, the value is the Linux one
+    TCP_FASTOPEN_CONNECT = getattr(socket, 'TCP_FASTOPEN_CONNECT', 30)
+    # tcpi_rtt of the Linux struct tcp_info, in microseconds
+    TCP_INFO_RTT = struct.Struct('=68xI')
+    # Bounds of the receive buffer picked by auto_rcvbuf
+    MIN_AUTO_RCVBUF = 64 * 1024
+    MAX_AUTO_RCVBUF = 32 * 1024 * 1024
+    # Linux doubles SO_RCVBUF for its bookkeeping and reports the doubled size
+    KERNEL_DOUBLES_RCVBUF = sys.platform.startswith('linux')
+
+    def __init__(self, rcvbuf=0, auto_rcvbuf=False, nodelay=False, quickack=False, fastopen=False):
+        # SO_RCVBUF in bytes, 0 leaves it to the kernel
+        self.rcvbuf = rcvbuf
+        self.auto_rcvbuf = auto_rcvbuf
+        self.nodelay = nodelay
+        self.quickack = quickack and hasattr(socket, 'TCP_QUICKACK')
+        self.fastopen = fastopen and sys.platform.startswith('linux')
+        # The kernel silently caps SO_RCVBUF, a capped buffer would be smaller
+        # than the one it tunes by itself
+        self.rcvbuf_limit = min(self.get_rcvbuf_limit(), self.MAX_AUTO_RCVBUF)
+
+    def apply(self, sock, fastopen=True):
+        '''
+        Set the options on a socket about to connect, Tcp Fast Open only with
+        fastopen, see ConnectRace.
+        '''
+        if self.rcvbuf > 0:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if self.nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.fastopen and fastopen:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, self.TCP_FASTOPEN_CONNECT, 1)
+            except OSError:
+                # Older than Linux 4.11
+                self.fastopen = False
+
+    def apply_connected(self, sock):
+        if self.quickack:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+    def get_auto_rcvbuf(self, rtt, speed):
+        '''
+        Twice the bandwidth-delay product of a connection doing speed bytes a
+        second over a path of rtt seconds, so the window isn't what limits it.
+        '''
+        return min(max(int(2 * rtt * speed), self.MIN_AUTO_RCVBUF), self.rcvbuf_limit)
+
+    def grow_receive_buffer(self, sock, size):
+        '''
+        Raise SO_RCVBUF of a connected socket to size, a bigger buffer, e.g.
+        one the kernel has tuned itself, is kept. Return True if it was raised.
+        '''
+        reported_size = 2 * size if self.KERNEL_DOUBLES_RCVBUF else size
+        try:
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= reported_size:
+                return False
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+        except OSError:
+            return False
+        return True
+
+    @classmethod
+    def get_rtt(cls, sock):
+        ''' The smoothed round trip time the kernel measured on sock, in seconds, or None. '''
+        if not hasattr(socket, 'TCP_INFO'):
+            return None
+        try:
+            info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, cls.TCP_INFO_RTT.size)
+        except OSError:
+            return None
+        if len(info) < cls.TCP_INFO_RTT.size:
+            return None
+        rtt = cls.TCP_INFO_RTT.unpack(info)[0]
+        return rtt / 1000000 if rtt > 0 else None
+
+    @classmethod
+    def get_rcvbuf_limit(cls):
+        ''' Largest SO_RCVBUF a process may set, net.core.rmem_max on Linux. '''
+        try:
+            with open('/proc/sys/net/core/rmem_max', 'r') as file_obj:
+                return int(file_obj.read())
+        except (OSError, ValueError):
+            return cls.MAX_AUTO_RCVBUF
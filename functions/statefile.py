@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import zlib
+import struct
+
+class StateFile(object):
+    '''
+    The .st file kept next to an unfinished download, in a versioned binary format:
+        magic, version, block size, file size, the completed-block bitmap,
+        the ETag and Last-Modified of the file (since version 2) and a CRC32.
+    The bitmap is run-length encoded: runs alternate between missing and
+    completed blocks, starting with missing ones, and each run length is a
+    LEB128 varint, so a huge file with a few holes still takes a few bytes.
+    A block counts as completed only when all of its bytes are in the file.
+    '''
+    MAGIC = b'PYXS'
+    VERSION = 2
+    HEADER = struct.Struct('<4sHIQ')
+    CRC = struct.Struct('<I')
+
+    def __init__(self, file_size, block_size, runs, etag=None, last_modified=None):
+        self.file_size = file_size
+        self.block_size = block_size
+        self.runs = runs
+        # Validators of the file the blocks belong to, None if the server sent none
+        self.etag = etag
+        self.last_modified = last_modified
+        # Version 1 and the legacy JSON format didn't record the validators
+        self.has_validators = True
+
+    def num_of_blocks(self):
+        return (self.file_size + self.block_size - 1) // self.block_size
+
+    @classmethod
+    def from_done_ranges(cls, file_size, block_size, done_ranges, etag=None, last_modified=None):
+        ''' done_ranges are sorted, non-overlapping (start, end) byte ranges. '''
+        runs = []
+        block = 0
+        for start, end in done_ranges:
+            first = (start + block_size - 1) // block_size
+            # The last block may be short.
+            last = (file_size + block_size - 1) // block_size if end >= file_size else end // block_size
+            if last <= first:
+                continue
+            runs.append(first - block)
+            runs.append(last - first)
+            block = last
+        return cls(file_size, block_size, runs, etag, last_modified)
+
+    def done_ranges(self):
+        ''' The completed blocks as (start, end) byte ranges. '''
+        ranges = []
+        block = 0
+        for missing, done in zip(self.runs[0::2], self.runs[1::2]):
+            block += missing
+            ranges.append((block * self.block_size, min((block + done) * self.block_size, self.file_size)))
+            block += done
+        return ranges
+
+    def pack(self):
+        data = bytearray(self.HEADER.pack(self.MAGIC, self.VERSION, self.block_size, self.file_size))
+        data += self.pack_varint(len(self.runs))
+        for run in self.runs:
+            data += self.pack_varint(run)
+        for validator in (self.etag, self.last_modified):
+            data += self.pack_string(validator)
+        data += self.CRC.pack(zlib.crc32(data))
+        return bytes(data)
+
+    @classmethod
+    def unpack(cls, data):
+        if len(data) < cls.HEADER.size + cls.CRC.size:
+            raise ValueError('state file is truncated')
+        body = data[:-cls.CRC.size]
+        if cls.CRC.unpack(data[-cls.CRC.size:])[0] != zlib.crc32(body):
+            raise ValueError('state file is corrupted')
+        magic, version, block_size, file_size = cls.HEADER.unpack_from(body)
+        if magic != cls.MAGIC:
+            raise ValueError('not a state file')
+        if version not in (1, cls.VERSION):
+            raise ValueError(f'unsupported state file version {version}')
+        num_of_runs, offset = cls.unpack_varint(body, cls.HEADER.size)
+        runs = []
+        for _ in range(num_of_runs):
+            run, offset = cls.unpack_varint(body, offset)
+            runs.append(run)
+        state = cls(file_size, block_size, runs)
+        if version >= 2:
+            state.etag, offset = cls.unpack_string(body, offset)
+            state.last_modified, offset = cls.unpack_string(body, offset)
+        else:
+            state.has_validators = False
+        if sum(runs) > state.num_of_blocks():
+            raise ValueError('state file bitmap is too long')
+        return state
+
+    @classmethod
+    def from_legacy_json(cls, data, file_size, block_size):
+        '''
+        The JSON state of older versions, which didn't record the file size:
+        whatever no connection still had to download is done.
+        '''
+        state = json.loads(data)
+        ranges = sorted(
+            (conn['current_byte'], conn['last_byte'])
+            for conn in state['connections']
+            if conn['current_byte'] < conn['last_byte']
+        )
+        done_ranges = []
+        position = 0
+        for current_byte, last_byte in ranges:
+            if current_byte > position:
+                done_ranges.append((position, current_byte))
+            position = max(position, last_byte)
+        if position < file_size:
+            done_ranges.append((position, file_size))
+        state = cls.from_done_ranges(file_size, block_size, done_ranges)
+        state.has_validators = False
+        return state
+
+    @staticmethod
+    def pack_varint(value):
+        data = bytearray()
+        while True:
+            byte = value & 0x7f
+            value >>= 7
+            if value:
+                data.append(byte | 0x80)
+            else:
+                data.append(byte)
+                return data
+
+    @staticmethod
+    def unpack_varint(data, offset):
+        value = 0
+        shift = 0
+        while True:
+            if offset >= len(data):
+                raise ValueError('state file is truncated')
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return value, offset
+            shift += 7
+
+    @classmethod
+    def pack_string(cls, value):
+        ''' A varint length and UTF-8 bytes, None is stored as length 0. '''
+        data = (value or '').encode('utf-8')
+        return cls.pack_varint(len(data)) + data
+
+    @classmethod
+    def unpack_string(cls, data, offset):
+        length, offset = cls.unpack_varint(data, offset)
+        if offset + length > len(data):
+            raise ValueError('state file is truncated')
+        value = bytes(data[offset:offset + length]).decode('utf-8')
+        return value or None, offset + length
+
+    def save(self, filename):
+        '''
+        Replace the state file atomically: write a temporary file, fsync it and
+        rename it over the old one, so a crash leaves either the old or the new state.
+        '''
+        temp_filename = ''.join([filename, '.tmp'])
+        fd = os.open(temp_filename, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o666)
+        try:
+            data = self.pack()
+            while data:
+                data = data[os.write(fd, data):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(temp_filename, filename)
+        # Make the rename itself durable.
+        dir_fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    @classmethod
+    def load(cls, filename, file_size, block_size):
+        '''
+        Return None if there is no state file, raise ValueError if it's unusable.
+        file_size and block_size are only used for the legacy JSON format.
+        '''
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as file_obj:
+            data = file_obj.read()
+        if data.startswith(b'{'):
+            try:
+                return cls.from_legacy_json(data, file_size, block_size)
+            except (ValueError, KeyError, TypeError):
+                raise ValueError('state file is corrupted')
+        return cls.unpack(data)
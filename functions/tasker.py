@@ -3,31 +3,62 @@
 
 import os
 import sys
+import copy
 import signal
 
 from .process import Process
+from .async_process import AsyncProcess
+from .connection import Connection
 from functions.config import is_filename_valid
 
 class Tasker(object):
-    def __init__(self, config, url):
+    # Times a download starts over because the file changed on the server
+    MAX_RESTARTS = 3
+
+    def __init__(self, config, url, session=None, handle_signals=True, metalink_file=None, claim_output=None):
         self.config = config
         self.url = url
-        self.process = Process(config)
+        # Shared with the other downloads of a batch, which handles the signals
+        self.session = session
+        self.handle_signals = handle_signals
+        # In a batch, reserves an output file so no other download of it
+        # writes there, see Batch.claim_output()
+        self.claim_output = claim_output
+        # The file of a Metalink document this Tasker downloads, if any
+        self.metalink_file = metalink_file
+        self.process = self.create_process()
+        self.restarts = 0
 
         # Flag to determine if the program shall run. It might be set as False by signals
         self.run = True
 
+    def create_process(self):
+        ''' Pick the download engine, the asyncio one only handles Http. '''
+        if self.config.engine == 'asyncio':
+            if Connection.get_scheme_from_url(self.url) in (Connection.HTTP, Connection.HTTPS):
+                return AsyncProcess(self.config, self.session)
+            sys.stderr.write('The asyncio engine only supports Http, using threads.\n')
+        return Process(self.config, self.session)
+
     def start_task(self):
         ''' The program\'s main logic '''
         sys.stdout.write(f'Initializing download: {self.url}\n')
 
-        if not self.process.new_preparation(self.url):
+        if not self.process.new_preparation(self.url, self.metalink_file):
+            self.process.process_print_messages()
             return False
 
+        if self.process.metalink is not None:
+            self.process.process_print_messages()
+            return self.download_metalink(self.process.metalink)
+
         if not self.check_output_filename():
+            self.process.abandon()
             return False
 
         if not self.process.open_local_files():
+            self.process.abandon()
+            self.process.process_print_messages()
             return False
 
         self.process.process_print_messages()
@@ -36,29 +67,57 @@ class Tasker(object):
 
         self.process.process_print_messages()
 
-        self.setup_signal_hook()
+        if self.handle_signals:
+            self.setup_signal_hook()
 
         # While Loop here.
         print('ready', self.process.ready)
         print('run', self.run)
-        while not self.process.ready and self.run:
+        while not self.process.ready and self.run and not self.process.restart_needed:
             print('Total bytes, ', self.process.file_size, ' - Bytes done, ', self.process.bytes_done)
             try:
                 self.process.do_downloading()
             except Exception as e:
                 print(f'----> Exception {e.args[-1]}')
         self.process.terminate()
+        self.process.process_print_messages()
 
+        if self.process.restart_needed and self.run and self.restarts < self.MAX_RESTARTS:
+            self.restarts += 1
+            self.process = self.create_process()
+            return self.start_task()
         return True
         # TBD.
 
+    def download_metalink(self, metalink):
+        '''
+        Download the files of a Metalink document one after the other, each
+        with a Process of its own. Return True if all of them were downloaded.
+        '''
+        all_done = True
+        config = self.config
+        for metalink_file in metalink.files:
+            # Each Process changes its config, e.g. the number of connections.
+            self.config = copy.copy(config)
+            self.url = metalink_file.urls[0]
+            self.metalink_file = metalink_file
+            self.restarts = 0
+            self.process = self.create_process()
+            if not self.start_task() or not self.process.ready:
+                all_done = False
+            if not self.run:
+                break
+        return all_done
+
     def check_output_filename(self):
         ''' To finalize the output file name to be used '''
-        if self.config.output_filename_from_cmd and not self.use_output_filename_from_cmd():
-            return False
+        if self.config.output_filename_from_cmd:
+            if not self.use_output_filename_from_cmd():
+                return False
         else:
             self.check_local_files()
-        if not is_filename_valid(self.process.output_filename):
+        # -o may give a directory, only the name is checked.
+        if not is_filename_valid(os.path.basename(self.process.output_filename)):
             sys.stderr.write(f'The final output filename, {self.process.output_filename}, is\'t valid.\n')
             sys.stderr.write(
                 'This is most likely due to wildcards in the URL, '
@@ -84,6 +143,11 @@ class Tasker(object):
                 '/',
                 self.process.output_filename
             ])
+            if self.claim_output is not None:
+                # A batch picks a free name in the directory, as without -o.
+                self.process.output_filename = output_filename
+                self.check_local_files()
+                return True
         state_filename = ''.join([
             output_filename,
             '.st'
@@ -105,6 +169,8 @@ class Tasker(object):
         '''
         If no output filename specified in command, then check local
         files with output_filename generated in Process.
+        In a batch, a name another download of it has taken is skipped, and so
+        is a finished file, which may be from an earlier run of the batch.
         '''
         i = 0
         output_filename = self.process.output_filename
@@ -118,10 +184,14 @@ class Tasker(object):
             st_exists = os.path.exists(state_filename)
             if f_exists and st_exists and self.process.is_resuming_supported():
                 # If file exists, we'll continue only if we can write it, otherwise jump it
-                break
+                usable = True
             elif not st_exists:
                 # If we invent a new file name, we'll continue only if
                 # there is no state file, otherwise jump it
+                usable = self.claim_output is None or not f_exists
+            else:
+                usable = False
+            if usable and (self.claim_output is None or self.claim_output(output_filename)):
                 break
             # We'll continue if file can be written or file and state file pair is brand new
             if len(output_filename) == length:
@@ -4,80 +4,200 @@
 # HowTo
 # https://docs.python.org/3.8/howto/sockets.html#socket-howto
 
+import os
 import ssl
+import time
+import errno
 import socket
 import struct
-import psutil
 import select
 
+from .tls import TlsContext
+
 class Tcp(object):
+    # Size of each block read from the socket while looking for a delimiter
+    RECV_BLOCK_SIZE = 16384
+    # Give up on a delimiter search after buffering this many bytes
+    MAX_DELIMITED_SIZE = 65536
+    # Seconds before the next address is tried while the others still
+    # connect, RFC 8305 recommends 250 ms
+    CONNECTION_ATTEMPT_DELAY = 0.25
+    # Seconds a blocking read or write waits, e.g. while a connection sets up
+    IO_TIMEOUT = 5
+
     def __init__(self):
         self.socket_fd = None
+        # Bytes already read from the socket but not consumed yet, e.g. the
+        # beginning of a Http body that arrived together with the headers.
+        self.recv_buffer = bytearray()
+        # TlsContext and host of a Tls connection, its session is saved on close
+        self.tls = None
+        self.tls_host = None
+        # Seconds the winning connect took, a round trip time estimate
+        self.rtt = None
+        # Set TCP_QUICKACK again before each read, see SocketOptions
+        self.quickack = False
 
     def is_connected(self):
         return self.socket_fd != None
 
-    def connect(self, host, port, is_secure, ai_family, io_timeout, local_if=None):
-        try:
-            gai_results = socket.getaddrinfo(
-                host,
-                port,
-                ai_family,
-                socket.SOCK_STREAM,
-                socket.IPPROTO_TCP,
-                socket.AI_ADDRCONFIG
-            )
-        except socket.gaierror as e:
-            Tcp.print_error(host, port, e.message)
+    def connect(self, host, port, is_secure, ai_family, io_timeout, local_addresses=None, resolver=None, tls=None,
+                socket_options=None):
+        '''
+        Connect to host the Happy Eyeballs way (RFC 8305): the addresses alternate
+        between families, a new attempt starts every CONNECTION_ATTEMPT_DELAY
+        seconds or as soon as one fails, the first to complete wins and the
+        others are closed. The whole connect takes at most io_timeout seconds.
+        resolver is a Resolver shared by the connections, or None to call
+        getaddrinfo() each time. It also remembers the family which won for host.
+        With is_secure, the Tls handshake follows, tls is the TlsContext shared
+        by the connections, a new one is used if it's None.
+        socket_options is a SocketOptions set on each socket before it connects.
+        local_addresses maps address families to the local address to bind to,
+        e.g. the ones of an interface, see InterfaceSet.
+        The race itself is kept by ConnectRace.
+        '''
+        self.close()
+        race = ConnectRace(host, port, ai_family, io_timeout, local_addresses, resolver, socket_options)
+        if not race.resolve():
             return False
-        for gai_result in gai_results:
-            print('gai_result--->', gai_result)
-            t_ai_family, ai_sockettype, ai_protocol, _, (ai_host, ai_port) = gai_result
-            try:
-                self.close()
-                self.socket_fd = socket.socket(
-                    t_ai_family,
-                    ai_sockettype,
-                    ai_protocol
-                )
-                #if is_secure:
-                #    context = ssl.SSLContext()
-                #    self.socket_fd = context.wrap_socket(
-                #        self.socket_fd, server_hostname=ai_host
-                #    )
-                # Does this mean the port number is dynamic allocated?
-                # Do we need to do this: if local_if is not None and t_ai_family == socket.AF_INET:
-                if local_if:
-                    local_addr = self.get_if_ip(local_if, t_ai_family)
-                    if local_addr:
-                        self.socket_fd.bind((local_addr, 0))
-                self.socket_fd.setblocking(False)
-                self.socket_fd.settimeout(5)
-                self.socket_fd.setsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN, 1)
-                self.socket_fd.connect((ai_host, ai_port))
-            except socket.error as e:
-                Tcp.print_error(host, port, e.args[-1])
-                self.socket_fd = None
-            if self.socket_fd is None:
-                continue
-            _, writeable, _ = select.select([], [self.socket_fd], [], io_timeout)
-            if self.socket_fd in writeable:
-                break
+        timeout = race.next_timeout()
+        while timeout is not None:
+            _, writeable, _ = select.select([], list(race.attempts), [], timeout)
+            for sock in writeable:
+                race.attempt_done(sock)
+            timeout = race.next_timeout()
+        self.socket_fd = race.take_winner()
         if self.socket_fd is None:
             return False
-        # Same function as to use settimeout() ?
-        # self.socket_fd.settimeout(io_timeout)
-        #val = struct.pack('QQ', 0.1, 0)
-        #self.socket_fd.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, val)
-        #self.socket_fd.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, val)
+        self.rtt = race.rtt
+        if socket_options is not None:
+            self.quickack = socket_options.quickack
+        if is_secure and not self.start_tls(host, port, tls or TlsContext(), race.deadline - time.time()):
+            self.close()
+            return False
+        self.socket_fd.settimeout(self.IO_TIMEOUT)
         return True
 
+    def start_tls(self, host, port, tls, timeout):
+        try:
+            self.socket_fd.settimeout(max(timeout, 0))
+            self.socket_fd = tls.wrap(self.socket_fd, host)
+        except (ssl.SSLError, ssl.CertificateError, OSError) as e:
+            Tcp.print_error(host, port, e.args[-1])
+            return False
+        self.tls = tls
+        self.tls_host = host
+        return True
+
+    def set_blocking(self, blocking):
+        '''
+        The event loop only reads a socket select() finds readable, but a Tls
+        read may still wait for the rest of a record, so the loop's sockets
+        don't block. The setup threads write and read them with a timeout.
+        '''
+        if self.socket_fd is not None:
+            self.socket_fd.settimeout(self.IO_TIMEOUT if blocking else 0)
+
+    def is_tls(self):
+        return isinstance(self.socket_fd, ssl.SSLSocket)
+
+    @staticmethod
+    def start_attempt(host, port, gai_result, local_addresses=None, socket_options=None, fastopen=False):
+        '''
+        Start a non-blocking connect, return the socket or None if it failed right away.
+        fastopen lets socket_options use Tcp Fast Open, see SocketOptions.apply().
+        '''
+        t_ai_family, ai_sockettype, ai_protocol, _, sockaddr = gai_result
+        try:
+            sock = socket.socket(t_ai_family, ai_sockettype, ai_protocol)
+        except OSError as e:
+            Tcp.print_error(host, port, e.args[-1])
+            return None
+        try:
+            if local_addresses and t_ai_family in local_addresses:
+                sock.bind((local_addresses[t_ai_family], 0))
+            if socket_options is not None:
+                socket_options.apply(sock, fastopen)
+            sock.setblocking(False)
+            error = sock.connect_ex(sockaddr)
+        except OSError as e:
+            Tcp.print_error(host, port, e.args[-1])
+            sock.close()
+            return None
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            Tcp.print_error(host, port, os.strerror(error))
+            sock.close()
+            return None
+        return sock
+
+    @staticmethod
+    def sort_addresses(gai_results, preferred_family=None):
+        '''
+        Interleave the address families, starting with preferred_family if
+        given, else with the family getaddrinfo() put first.
+        '''
+        by_family = {}
+        for gai_result in gai_results:
+            by_family.setdefault(gai_result[0], []).append(gai_result)
+        families = list(by_family)
+        if preferred_family in by_family:
+            families.remove(preferred_family)
+            families.insert(0, preferred_family)
+        sorted_results = []
+        queues = [by_family[family] for family in families]
+        while any(queues):
+            for queue in queues:
+                if queue:
+                    sorted_results.append(queue.pop(0))
+        return sorted_results
+
     def close(self):
         if self.socket_fd is not None:
+            if self.is_tls():
+                # The session ticket may have come in with the data.
+                self.tls.save_session(self.tls_host, self.socket_fd)
             self.socket_fd.close()
             self.socket_fd = None
+        self.recv_buffer = bytearray()
+
+    def has_buffered_data(self):
+        ''' Tls may hold decrypted data which select() doesn't see either. '''
+        if len(self.recv_buffer) > 0:
+            return True
+        return self.is_tls() and self.socket_fd.pending() > 0
+
+    def recv_until(self, delimiter):
+        '''
+        Read big blocks from the socket until delimiter shows up.
+        Return everything up to and including the delimiter, the rest stays in
+        recv_buffer and is handed out first by recv().
+        Return None if the connection is closed before the delimiter is found.
+        '''
+        start = 0
+        while True:
+            index = self.recv_buffer.find(delimiter, start)
+            if index >= 0:
+                end = index + len(delimiter)
+                data = bytes(self.recv_buffer[:end])
+                del self.recv_buffer[:end]
+                return data
+            if len(self.recv_buffer) > self.MAX_DELIMITED_SIZE:
+                raise RuntimeError(f'No delimiter found in the first {len(self.recv_buffer)} bytes.')
+            # The delimiter might be split between two blocks.
+            start = max(0, len(self.recv_buffer) - len(delimiter) + 1)
+            chunk = self.socket_fd.recv(self.RECV_BLOCK_SIZE)
+            if chunk == b'':
+                # the server has closed the connection
+                return None
+            self.recv_buffer += chunk
 
     def recv(self, msg_size):
+        if self.recv_buffer:
+            # Deliver the leftover bytes first, so nothing is lost or read twice.
+            data = bytes(self.recv_buffer[:msg_size])
+            del self.recv_buffer[:msg_size]
+            return data
         chunks = []
         bytes_recvd = 0
         while bytes_recvd < msg_size:
@@ -89,6 +209,20 @@ class Tcp(object):
             bytes_recvd += len(chunk)
         return b''.join(chunks)
 
+    def recv_into(self, buffer, msg_size):
+        '''
+        Receive at most msg_size bytes into a preallocated buffer and return the
+        number of bytes written, 0 means the server has closed the connection.
+        '''
+        if self.recv_buffer:
+            nbytes = min(msg_size, len(self.recv_buffer))
+            buffer[:nbytes] = self.recv_buffer[:nbytes]
+            del self.recv_buffer[:nbytes]
+            return nbytes
+        if self.quickack:
+            self.socket_fd.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        return self.socket_fd.recv_into(buffer, msg_size)
+
     def send(self, data):
         assert isinstance(data, bytes), f'incorrect data type as _{type(data)}_'
         totalsent = 0
@@ -111,11 +245,117 @@ class Tcp(object):
             return False
         return True
 
-    @staticmethod
-    def get_if_ip(local_if, ai_family):
-        if_addrs = psutil.net_if_addrs()
-        if local_if in if_addrs:
-            for item in if_addrs[local_if]:
-                if isinstance(item, psutil._common.snic) and item.family == ai_family:
-                    return item.address
+class ConnectRace(object):
+    '''
+    The Happy Eyeballs bookkeeping of Tcp.connect(), shared with the asyncio
+    engine, which only waits for the sockets differently: next_timeout()
+    starts the next attempt and tells how long to wait for the attempts to
+    become writeable, attempt_done() is called for each one that does, until
+    next_timeout() returns None. take_winner() ends the race.
+    With Tcp Fast Open the SYN waits for the first write, the socket is
+    writeable at once whether the address answers or not, so it's only used
+    when there is a single address to try, and rtt isn't measured then.
+    '''
+    def __init__(self, host, port, ai_family, timeout, local_addresses=None, resolver=None, socket_options=None):
+        self.host = host
+        self.port = port
+        self.ai_family = ai_family
+        self.local_addresses = local_addresses
+        self.resolver = resolver
+        self.socket_options = socket_options
+        self.deadline = time.time() + timeout
+        self.gai_results = []
+        # Socket -> (getaddrinfo() result, start time), for the attempts in progress
+        self.attempts = {}
+        # (socket, getaddrinfo() result) of the first attempt to complete
+        self.winner = None
+        self.rtt = None
+        self.fastopen = False
+
+    def resolve(self):
+        ''' Look the addresses up, blocking. Return False if there are none. '''
+        try:
+            if self.resolver is not None:
+                gai_results = self.resolver.resolve(self.host, self.port, self.ai_family)
+            else:
+                gai_results = socket.getaddrinfo(
+                    self.host,
+                    self.port,
+                    self.ai_family,
+                    socket.SOCK_STREAM,
+                    socket.IPPROTO_TCP,
+                    socket.AI_ADDRCONFIG
+                )
+        except socket.gaierror as e:
+            Tcp.print_error(self.host, self.port, e.args[-1])
+            return False
+        preferred_family = self.resolver.get_preferred_family(self.host) if self.resolver is not None else None
+        self.gai_results = Tcp.sort_addresses(gai_results, preferred_family)
+        self.fastopen = self.socket_options is not None and self.socket_options.fastopen and len(self.gai_results) == 1
+        return True
+
+    def next_timeout(self):
+        '''
+        Start the next attempt if it's time for one. Return the seconds to wait
+        for the attempts in progress, or None if the race is over.
+        '''
+        while self.winner is None:
+            timeout = self.deadline - time.time()
+            if timeout <= 0:
+                return None
+            if self.gai_results:
+                gai_result = self.gai_results.pop(0)
+                sock = Tcp.start_attempt(
+                    self.host, self.port, gai_result, self.local_addresses, self.socket_options, self.fastopen
+                )
+                if sock is None:
+                    self.report_failure(gai_result)
+                    continue
+                self.attempts[sock] = gai_result, time.time()
+                return min(timeout, Tcp.CONNECTION_ATTEMPT_DELAY)
+            if not self.attempts:
+                return None
+            return timeout
         return None
+
+    def attempt_done(self, sock):
+        ''' The connect of sock has completed, or failed. '''
+        gai_result, start_time = self.attempts.pop(sock)
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error == 0 and self.winner is None:
+            self.winner = sock, gai_result
+            if not self.fastopen:
+                self.rtt = time.time() - start_time
+            return
+        if error != 0:
+            Tcp.print_error(self.host, self.port, os.strerror(error))
+            self.report_failure(gai_result)
+        sock.close()
+
+    def report_failure(self, gai_result):
+        if self.resolver is not None:
+            self.resolver.report_failure(self.host, self.port, self.ai_family, gai_result[4])
+
+    def close(self):
+        ''' Give the race up, e.g. when the connection is cancelled. '''
+        for sock in self.attempts:
+            sock.close()
+        self.attempts = {}
+        if self.winner is not None:
+            self.winner[0].close()
+            self.winner = None
+
+    def take_winner(self):
+        ''' Close the attempts still in progress, return the connected socket or None. '''
+        for sock in self.attempts:
+            sock.close()
+        self.attempts = {}
+        if self.winner is None:
+            return None
+        sock, gai_result = self.winner
+        self.winner = None
+        if self.resolver is not None:
+            self.resolver.report_success(self.host, self.port, self.ai_family, gai_result)
+        if self.socket_options is not None:
+            self.socket_options.apply_connected(sock)
+        return sock
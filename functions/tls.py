@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import ssl
+import threading
+
+class TlsContext(ssl.SSLContext):
+    '''
+    The SSLContext shared by all connections of a Process, along with the last
+    TLS session of each host, so only the first handshake is a full one and the
+    others resume it.
+    The asyncio engine can't pass a session when it connects, wrap_bio() adds
+    it then.
+    '''
+    def __new__(cls, insecure=False, ciphers=None, alpn_protocols=None):
+        return super(TlsContext, cls).__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self, insecure=False, ciphers=None, alpn_protocols=None):
+        self.load_default_certs()
+        if insecure:
+            self.check_hostname = False
+            self.verify_mode = ssl.CERT_NONE
+        if ciphers:
+            self.set_ciphers(ciphers)
+        if alpn_protocols:
+            self.set_alpn_protocols(alpn_protocols)
+        self.session_lock = threading.Lock()
+        # Host -> the last resumable SSLSession
+        self.sessions = {}
+        self.handshakes = 0
+        self.resumed_handshakes = 0
+
+    def get_session(self, host):
+        with self.session_lock:
+            return self.sessions.get(host)
+
+    def save_session(self, host, ssl_object):
+        '''
+        A TLS 1.3 session only becomes resumable once its ticket has been read,
+        which happens along with the first data, so this is called again later.
+        '''
+        session = ssl_object.session
+        if session is None or (ssl_object.version() == 'TLSv1.3' and not session.has_ticket):
+            return
+        with self.session_lock:
+            self.sessions[host] = session
+
+    def handshake_done(self, host, ssl_object):
+        with self.session_lock:
+            self.handshakes += 1
+            if ssl_object.session_reused:
+                self.resumed_handshakes += 1
+        self.save_session(host, ssl_object)
+
+    def wrap(self, sock, host):
+        ''' Do the handshake on a connected socket, resuming the session of host if there is one. '''
+        ssl_sock = self.wrap_socket(sock, server_hostname=host, session=self.get_session(host))
+        self.handshake_done(host, ssl_sock)
+        return ssl_sock
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and server_hostname is not None:
+            session = self.get_session(server_hostname)
+        return super(TlsContext, self).wrap_bio(incoming, outgoing, server_side, server_hostname, session)
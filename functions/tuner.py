@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+class ConnectionTuner(object):
+    '''
+    Decide the number of connections at runtime when -n auto is given.
+    Start with a few connections and add one at a time while the aggregate
+    throughput keeps rising by at least margin. When the last added connection
+    doesn't help, retire it and hold the count for a while.
+    Then probe again, in turns: add a connection and keep it if throughput
+    rises by margin, or retire one and add it back if throughput falls by
+    margin. Within margin the count stays as it is, so it doesn't swing on
+    noise. A server refusing a connection caps the count for good.
+    '''
+    ADD = 1
+    KEEP = 0
+    RETIRE = -1
+
+    # Seconds between two throughput measurements
+    EVALUATION_INTERVAL = 2
+    # Measurements the count is held before the next probe
+    HOLD_WINDOWS = 5
+
+    def __init__(self, initial_connections, max_connections, margin):
+        self.initial_connections = initial_connections
+        self.max_connections = max_connections
+        self.margin = margin
+        # Throughput before the last change, bytes per second
+        self.baseline = None
+        # ADD or RETIRE while the effect of the last change is still to be
+        # judged, KEEP while the count is settled
+        self.probe = self.KEEP
+        # Direction of the next probe once the hold is over
+        self.next_probe = self.ADD
+        # Growing at first, so no hold yet
+        self.hold = 0
+        # The first window after a change covers the setup or the retiring, skip it
+        self.settling = False
+        self.sample_time = None
+        self.sample_bytes = 0
+
+    def evaluate(self, now, bytes_done, num_of_connections):
+        ''' Return ADD, KEEP or RETIRE, called on every maintenance pass. '''
+        if self.sample_time is None:
+            self.sample_time = now
+            self.sample_bytes = bytes_done
+            return self.KEEP
+        if now - self.sample_time < self.EVALUATION_INTERVAL:
+            return self.KEEP
+        throughput = (bytes_done - self.sample_bytes) / (now - self.sample_time)
+        self.sample_time = now
+        self.sample_bytes = bytes_done
+
+        if self.settling:
+            self.settling = False
+            return self.KEEP
+        if self.probe == self.ADD:
+            if throughput < self.baseline * (1 + self.margin):
+                # Not worth it, take it back.
+                return self.settle(self.RETIRE, self.RETIRE)
+            self.baseline = throughput
+            return self.grow(num_of_connections)
+        if self.probe == self.RETIRE:
+            if throughput < self.baseline * (1 - self.margin):
+                # It was needed, add it back.
+                return self.settle(self.ADD, self.ADD)
+            self.baseline = throughput
+            return self.shrink(num_of_connections)
+        self.baseline = throughput
+        if self.hold > 0:
+            self.hold -= 1
+            return self.KEEP
+        if self.next_probe == self.ADD:
+            return self.grow(num_of_connections)
+        return self.shrink(num_of_connections)
+
+    def grow(self, num_of_connections):
+        if num_of_connections >= self.max_connections:
+            return self.settle(self.KEEP, self.RETIRE)
+        return self.change(self.ADD)
+
+    def shrink(self, num_of_connections):
+        if num_of_connections <= 1:
+            return self.settle(self.KEEP, self.ADD)
+        return self.change(self.RETIRE)
+
+    def change(self, decision):
+        self.probe = decision
+        self.settling = True
+        return decision
+
+    def settle(self, decision, next_probe):
+        ''' Hold the count after decision, then probe towards next_probe. '''
+        self.probe = self.KEEP
+        self.next_probe = next_probe
+        self.hold = self.HOLD_WINDOWS
+        self.settling = decision != self.KEEP
+        return decision
+
+    def stop_growing(self):
+        ''' There is no work for another connection right now, try again later. '''
+        self.settle(self.KEEP, self.RETIRE)
+
+    def refused(self, num_of_connections):
+        ''' The server refused the last added connection, it's retired. '''
+        self.max_connections = min(self.max_connections, num_of_connections - 1)
+        self.settle(self.KEEP, self.RETIRE)
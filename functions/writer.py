@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+from collections import deque
+
+class WriteJob(object):
+    ''' Contiguous data of one connection, written with a single pwritev() where possible. '''
+    def __init__(self, offset):
+        self.offset = offset
+        self.views = []
+        self.size = 0
+        # Bytes the segment map counted as new, added to bytes_done once written
+        self.covered = 0
+        # Receive buffers to give back to the pool afterwards
+        self.buffers = []
+        self.memory = 0
+
+class Writer(object):
+    '''
+    Write-behind stage between the download loop and the output file.
+    Data received by a connection is collected while it's contiguous, and a
+    dedicated thread writes it with os.pwritev(), so a slow disk doesn't stall
+    the sockets. The memory held is capped, is_full() tells the loop to stop
+    receiving until the thread catches up.
+    '''
+    # Most buffers one pwritev() call takes
+    IOV_MAX = os.sysconf('SC_IOV_MAX') if 'SC_IOV_MAX' in os.sysconf_names else 1024
+
+    def __init__(self, fd, buffer_size, flush_size, memory_limit, wakeup=None):
+        self.fd = fd
+        self.buffer_size = buffer_size
+        self.flush_size = flush_size
+        self.memory_limit = memory_limit
+        # Called by the writer thread after each write, the loop may be
+        # waiting for memory or for the last bytes
+        self.wakeup = wakeup
+        self.cond = threading.Condition()
+        # Connection index -> job still collecting data
+        self.collecting = {}
+        self.jobs = deque()
+        self.writing = False
+        self.memory = 0
+        self.completed_bytes = 0
+        self.free_buffers = []
+        self.error = None
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def get_buffer(self):
+        ''' A receive buffer of buffer_size bytes, recycled from written jobs. '''
+        with self.cond:
+            while self.free_buffers:
+                buffer = self.free_buffers.pop()
+                # buffer_size may have grown since, see Process.tune_socket_buffers().
+                if len(buffer) >= self.buffer_size:
+                    return buffer
+        return bytearray(self.buffer_size)
+
+    def is_full(self):
+        return self.memory >= self.memory_limit
+
+    def add(self, i, offset, data, covered, buffer=None):
+        '''
+        Queue data received by connection i for offset. buffer is the receive
+        buffer data points into, it's owned by the writer from now on.
+        '''
+        with self.cond:
+            job = self.collecting.get(i)
+            if job is not None and job.offset + job.size != offset:
+                self.queue_job(i)
+                job = None
+            if job is None:
+                job = WriteJob(offset)
+                self.collecting[i] = job
+            job.views.append(data)
+            job.size += len(data)
+            job.covered += covered
+            memory = len(data)
+            if buffer is not None:
+                job.buffers.append(buffer)
+                memory = len(buffer)
+            job.memory += memory
+            self.memory += memory
+            if job.size >= self.flush_size:
+                self.queue_job(i)
+            if self.is_full():
+                # Memory is only freed by writing, don't keep collecting.
+                for i in list(self.collecting):
+                    self.queue_job(i)
+
+    def queue_job(self, i):
+        ''' The lock is held by the caller. '''
+        job = self.collecting.pop(i, None)
+        if job is not None:
+            self.jobs.append(job)
+            self.cond.notify_all()
+
+    def flush(self, i):
+        ''' Write what connection i has collected without waiting for more. '''
+        with self.cond:
+            self.queue_job(i)
+
+    def flush_all(self, wait=True):
+        ''' Queue everything collected, and wait until it's written if asked to. '''
+        with self.cond:
+            for i in list(self.collecting):
+                self.queue_job(i)
+            if wait:
+                self.cond.wait_for(lambda: (not self.jobs and not self.writing) or self.error is not None)
+
+    def take_completed(self):
+        ''' Covered bytes written since the last call. '''
+        with self.cond:
+            completed = self.completed_bytes
+            self.completed_bytes = 0
+        return completed
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.jobs or not self.running)
+                if not self.jobs:
+                    return
+                job = self.jobs.popleft()
+                self.writing = True
+            error = None
+            try:
+                self.write_job(job)
+            except OSError as e:
+                error = e
+            with self.cond:
+                self.writing = False
+                if error is not None:
+                    self.error = error
+                else:
+                    self.completed_bytes += job.covered
+                self.memory -= job.memory
+                self.free_buffers.extend(job.buffers)
+                self.cond.notify_all()
+            if self.wakeup is not None:
+                self.wakeup()
+
+    def write_job(self, job):
+        offset = job.offset
+        views = job.views
+        while views:
+            written = os.pwritev(self.fd, views[:self.IOV_MAX], offset)
+            offset += written
+            # Drop what is written, a short write leaves part of a view.
+            while views and written >= len(views[0]):
+                written -= len(views[0])
+                views = views[1:]
+            if written:
+                views[0] = views[0][written:]
+
+    def close(self):
+        ''' Write everything out and stop the thread. '''
+        self.flush_all(wait=True)
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
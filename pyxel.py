@@ -7,6 +7,8 @@ import re
 from functions.config import Config
 from functions.config import is_filename_valid
 from functions.tasker import Tasker
+from functions.batch import Batch
+from functions.metalink import Metalink
 
 def print_version():
     print('Pyxel version 1.0')
@@ -17,7 +19,11 @@ def print_help():
     print('Usage: pyxel [options] url1 [url2] [url...]')
     print()
     print('--max-speed=x\t\t-s x\tSpecifiy maximum speed (bytes per second)')
-    print('--num-connections=x\t-n x\tSpecify maximum number of connections')
+    print('--max-speed-per-connection=x\tSpecifiy maximum speed of each connection')
+    print('--max-speed-burst=x\t\tBytes that may be read above the maximum speed at once')
+    print('--num-connections=x\t-n x\tSpecify maximum number of connections, or auto')
+    print('--auto-margin=x\t\t\tWith -n auto, add connections while throughput rises x percent')
+    print('--auto-max=x\t\t\tWith -n auto, use at most x connections (16)')
     print('--max-redirect=x\t\tSpecify maximum number of redirections')
     print('--output=f\t\t-o f\tSpecify local output file')
     print('--ipv4\t\t\t-4\tUse the IPv4 protocol')
@@ -31,18 +37,47 @@ def print_help():
     print('--verbose\t\t-V\tMore status information')
     print('--alternate\t\t-a\tAlternate progress indicator')
     print('--timeout=x\t\t-T x\tSet I/O and connection timeout')
+    print('--splice\t\t\tMove data from socket to file in kernel (plain HTTP, Linux)')
+    print('--checksum=x\t\t\tVerify the file while downloading, e.g. sha256:<hex>')
+    print('--no-preallocate\t\tDon\'t reserve disk space for the whole file first')
+    print('--mmap\t\t\t\tReceive into a memory mapping of the output file')
+    print('--no-write-behind\t\tWrite received data from the download loop itself')
+    print('--write-memory=x\t\tMaximum bytes held by the writer thread')
+    print('--dns-ttl=x\t\t\tSeconds to cache host lookups')
+    print('--dns-cache=f\t\t\tKeep host lookups in file f between runs')
+    print('--tls-ciphers=x\t\t\tOpenSSL cipher list for HTTPS')
+    print('--tls-alpn=x\t\t\tALPN protocols to offer: http/1.1, http/1.0')
+    print('--no-keep-alive\t\t\tUse a new connection for every range')
+    print('--no-multi-range\t\tAsk for one range per request only')
+    print('--interface=x\t\t\tUse local interface x, may be given more than once')
+    print('--mirror=x\t\t\tAnother URL of the same file, may be given more than once')
+    print('--rcvbuf=x\t\t\tSocket receive buffer in bytes, or auto from the bandwidth-delay product')
+    print('--tcp-nodelay\t\t\tSet TCP_NODELAY on the sockets')
+    print('--tcp-quickack\t\t\tAcknowledge received data at once (Linux)')
+    print('--tcp-fastopen\t\t\tUse TCP Fast Open for repeat connections (Linux)')
+    print('--input-file=f\t\t-i f\tDownload the URLs listed in file f, - is stdin')
+    print('--batch-state=f\t\t\tRecord the finished URLs of a batch in f, to resume it')
+    print('--metalink=f\t\t-M f\tDownload the files of Metalink document f')
+    print('--max-connections=x\t\tMaximum connections of all downloads in a batch')
+    print('--max-per-host=x\t\tMaximum connections to one host in a batch')
+    print('--engine=x\t\t\tDownload engine: thread (default) or asyncio')
+    print('--end-game\t\t\tRace the last ranges on two connections')
     print('--help\t\t\t-h\tShow this information')
     print('--version\t\t-v\tVerson information')
 
 def command_process(argv, config):
     try:
         opts, args = getopt.getopt(
-            argv, 'hvs:n:o:46H:U:NkcqVaT:',
+            argv, 'hvs:n:o:46H:U:NkcqVaT:i:M:',
             [
                 'help',
                 'version',
                 'max-speed=',
+                'max-speed-per-connection=',
+                'max-speed-burst=',
                 'num-connections=',
+                'auto-margin=',
+                'auto-max=',
                 'max-redirect=',
                 'output=',
                 'ipv4',
@@ -56,6 +91,31 @@ def command_process(argv, config):
                 'verbose',
                 'alternate',
                 'timeout=',
+                'splice',
+                'checksum=',
+                'no-preallocate',
+                'mmap',
+                'no-write-behind',
+                'write-memory=',
+                'dns-ttl=',
+                'dns-cache=',
+                'tls-ciphers=',
+                'tls-alpn=',
+                'no-keep-alive',
+                'no-multi-range',
+                'interface=',
+                'mirror=',
+                'rcvbuf=',
+                'tcp-nodelay',
+                'tcp-quickack',
+                'tcp-fastopen',
+                'input-file=',
+                'batch-state=',
+                'metalink=',
+                'max-connections=',
+                'max-per-host=',
+                'engine=',
+                'end-game',
             ])
     except getopt.GetoptError:
         print_help()
@@ -63,8 +123,16 @@ def command_process(argv, config):
     for opt, arg in opts:
         if opt in ('-s', '--max-speed'):
             config.max_speed = int(arg)
+        elif opt == '--max-speed-per-connection':
+            config.max_speed_per_connection = int(arg)
+        elif opt == '--max-speed-burst':
+            config.max_speed_burst = int(arg)
         elif opt in ('-n', '--num-connections'):
-            config.num_of_connections = int(arg)
+            config.set_num_of_connections(arg)
+        elif opt == '--auto-margin':
+            config.auto_connections_margin = float(arg) / 100
+        elif opt == '--auto-max':
+            config.max_auto_connections = int(arg)
         elif opt in ('-s', '--max-redirect'):
             config.max_redirect = int(arg)
         elif opt in ('-o', '--output'):
@@ -105,24 +173,99 @@ def command_process(argv, config):
             config.alternate_output = True
         elif opt in ('-T', '--timeout'):
             config.io_timeout = int(arg)
+        elif opt == '--splice':
+            config.splice_transfer = True
+        elif opt == '--checksum':
+            config.set_checksum(arg)
+        elif opt == '--no-preallocate':
+            config.preallocate = False
+        elif opt == '--mmap':
+            config.mmap_output = True
+        elif opt == '--no-write-behind':
+            config.write_behind = False
+        elif opt == '--write-memory':
+            config.write_memory_limit = int(arg)
+        elif opt == '--dns-ttl':
+            config.dns_ttl = int(arg)
+        elif opt == '--dns-cache':
+            config.dns_cache_file = arg
+        elif opt == '--tls-ciphers':
+            config.set_tls_ciphers(arg)
+        elif opt == '--tls-alpn':
+            config.set_tls_alpn(arg)
+        elif opt == '--no-keep-alive':
+            config.keep_alive = False
+        elif opt == '--no-multi-range':
+            config.multi_range = False
+        elif opt == '--interface':
+            config.parse_interfaces(arg)
+        elif opt == '--mirror':
+            config.add_mirror(arg)
+        elif opt == '--rcvbuf':
+            config.set_tcp_rcvbuf(arg)
+        elif opt == '--tcp-nodelay':
+            config.tcp_nodelay = True
+        elif opt == '--tcp-quickack':
+            config.tcp_quickack = True
+        elif opt == '--tcp-fastopen':
+            config.tcp_fastopen = True
+        elif opt in ('-i', '--input-file'):
+            config.input_file = arg
+        elif opt == '--batch-state':
+            config.batch_state_file = arg
+        elif opt in ('-M', '--metalink'):
+            config.metalink = arg
+        elif opt == '--max-connections':
+            config.max_connections = int(arg)
+        elif opt == '--max-per-host':
+            config.max_connections_per_host = int(arg)
+        elif opt == '--engine':
+            config.set_engine(arg)
+        elif opt == '--end-game':
+            config.end_game = True
         elif opt in ('-h', '--help'):
             print_help()
             return True, None
         elif opt in ('-v', '--version'):
             print_version()
             return True, None
-    if len(args) < 1:
+    if len(args) < 1 and config.input_file is None and config.metalink is None:
         print_help()
         return False, None
     else:
-        return True, args[0]
+        return True, args
 
 def main(argv):
     config = Config()
-    ok, url = command_process(argv, config)
-    if ok and url is not None:
-        tasker = Tasker(config, url)
-        tasker.start_task()
+    ok, urls = command_process(argv, config)
+    if ok and urls is not None:
+        if config.metalink is not None:
+            if urls or config.input_file is not None:
+                print('A Metalink document can\'t be mixed with other URLs.')
+                return
+            try:
+                metalink = Metalink.load(config.metalink)
+            except Exception as e:
+                print(f'Unable to read the Metalink document {config.metalink}: {e.args[-1]}')
+                return
+            tasker = Tasker(config, metalink.files[0].urls[0])
+            tasker.download_metalink(metalink)
+            return
+        if len(urls) == 1 and config.input_file is None:
+            tasker = Tasker(config, urls[0])
+            tasker.start_task()
+            return
+        if config.output_filename_from_cmd and not os.path.isdir(config.output_filename_from_cmd):
+            print('With more than one URL, the output has to be a directory.')
+            return
+        if config.mirrors:
+            print('--mirror is for a single URL, in a batch the mirrors follow the URL on its line.')
+            return
+        state_file = config.batch_state_file
+        if state_file is None and config.input_file not in (None, '-'):
+            state_file = ''.join([config.input_file, '.st'])
+        batch = Batch(config, urls, config.input_file, state_file)
+        batch.start()
     elif not ok:
         print('\nThere is no url provided.')
 
@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import threading
+import unittest
+from collections import deque
+
+from functions.config import Config
+from functions.batch import Batch, BatchQueue
+from functions.tasker import Tasker
+
+class BatchOutputTest(unittest.TestCase):
+    ''' Downloads of one batch never share an output file. '''
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        self.batch = Batch(Config())
+
+    def tearDown(self):
+        self.batch.session.close()
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def pick_output_filename(self, url):
+        tasker = Tasker(
+            self.batch.config, url, self.batch.session,
+            handle_signals=False, claim_output=self.batch.claim_output
+        )
+        tasker.process.output_filename = 'same.bin'
+        self.assertTrue(tasker.check_output_filename())
+        return tasker.process.output_filename
+
+    def test_same_basename_gets_another_name(self):
+        first = self.pick_output_filename('http://one.example/a/same.bin')
+        second = self.pick_output_filename('http://two.example/b/same.bin')
+        self.assertEqual(first, 'same.bin')
+        self.assertEqual(second, 'same.bin.0')
+
+    def test_finished_file_of_earlier_run_is_kept(self):
+        with open('same.bin', 'wb') as file_obj:
+            file_obj.write(b'done')
+        self.assertEqual(self.pick_output_filename('http://one.example/same.bin'), 'same.bin.0')
+
+    def test_output_directory(self):
+        os.mkdir('out')
+        self.batch.config.output_filename_from_cmd = 'out'
+        first = self.pick_output_filename('http://one.example/same.bin')
+        second = self.pick_output_filename('http://two.example/same.bin')
+        self.assertEqual(first, 'out/same.bin')
+        self.assertEqual(second, 'out/same.bin.0')
+
+class FinishedTasker(object):
+    ''' What collect_finished() looks at of a Tasker whose download is over. '''
+    def __init__(self, url, ready):
+        self.url = url
+        self.run = True
+        self.process = type('FinishedProcess', (object,), {'ready': ready})()
+
+class BatchStateTest(unittest.TestCase):
+    ''' Only downloaded entries are recorded as done in the batch state. '''
+    URLS = ['http://example.com/ok.bin', 'http://example.com/failed.bin', 'http://example.com/next.bin']
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.tmpdir.name, 'batch.st')
+        self.batch = Batch(Config(), list(self.URLS), state_file=self.state_file)
+
+    def tearDown(self):
+        self.batch.session.close()
+        self.tmpdir.cleanup()
+
+    def add_finished(self, index, ok):
+        ''' A download whose thread is over, ok tells how it went. '''
+        tasker = FinishedTasker(self.URLS[index], ok)
+        thread = threading.Thread(target=lambda: None)
+        thread.start()
+        thread.join()
+        self.batch.results[tasker] = ok
+        self.batch.running.append((index, None, tasker, thread))
+
+    def test_failed_entry_is_tried_again(self):
+        self.add_finished(0, True)
+        self.add_finished(1, False)
+        self.batch.collect_finished()
+        self.assertEqual((self.batch.finished, self.batch.failed), (1, 1))
+        queue = BatchQueue(list(self.URLS), state_file=self.state_file)
+        self.assertEqual([index for index, _ in queue.entries()], [1, 2])
+
+    def test_done_entries_after_a_failed_one(self):
+        self.add_finished(1, False)
+        self.add_finished(2, True)
+        self.batch.collect_finished()
+        queue = BatchQueue(list(self.URLS), state_file=self.state_file)
+        self.assertEqual([index for index, _ in queue.entries()], [0, 1])
+
+class BadEntryTest(unittest.TestCase):
+    ''' A malformed line fails on its own, the batch goes on. '''
+    def setUp(self):
+        self.batch = Batch(Config())
+        self.started = []
+        self.batch.start_download = lambda index, urls, host: self.started.append((index, host))
+
+    def tearDown(self):
+        self.batch.session.close()
+
+    def test_bad_line_is_skipped(self):
+        waiting = deque([(0, 'htp://example.com/typo.bin'), (1, 'http://example.com/next.bin')])
+        self.assertTrue(self.batch.start_next(waiting))
+        self.assertEqual(self.started, [(1, 'example.com')])
+        self.assertEqual(self.batch.failed, 1)
+        self.assertFalse(waiting)
+
+class BatchQueueTest(unittest.TestCase):
+    ''' The batch state records the downloaded entries across runs. '''
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.tmpdir.name, 'batch.st')
+        self.input_file = os.path.join(self.tmpdir.name, 'urls.txt')
+        with open(self.input_file, 'w') as file_obj:
+            file_obj.write('# mirrors follow the URL\nhttp://a/1 http://b/1\n\nhttp://a/2\nhttp://a/3\n')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def new_queue(self):
+        return BatchQueue(['http://a/0'], self.input_file, self.state_file)
+
+    def test_entries(self):
+        self.assertEqual(list(self.new_queue().entries()), [
+            (0, 'http://a/0'), (1, 'http://a/1 http://b/1'), (2, 'http://a/2'), (3, 'http://a/3')
+        ])
+
+    def test_done_entries_are_skipped_next_run(self):
+        queue = self.new_queue()
+        queue.mark_done(2)
+        queue.mark_done(0)
+        self.assertEqual((queue.done_before, queue.done), (1, {2}))
+        queue.mark_done(1)
+        self.assertEqual((queue.done_before, queue.done), (3, set()))
+        self.assertEqual(list(self.new_queue().entries()), [(3, 'http://a/3')])
+
+    def test_broken_state_file_means_nothing_done(self):
+        with open(self.state_file, 'w') as file_obj:
+            file_obj.write('{"version": 1, "done_')
+        self.assertEqual(len(list(self.new_queue().entries())), 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import unittest
+
+from functions.checksum import Checksum
+
+BLOCK_SIZE = 16
+DATA = bytes(range(256)) * 2
+
+def digest(data):
+    return hashlib.sha256(data).digest()
+
+def pieces(data):
+    return [digest(data[i:i + BLOCK_SIZE]) for i in range(0, len(data), BLOCK_SIZE)]
+
+class CatchUpTest(unittest.TestCase):
+    ''' The prefix is hashed from received data and from data read back. '''
+    def read(self, offset, size):
+        return DATA[offset:offset + size]
+
+    def test_out_of_order_data_is_read_back(self):
+        checksum = Checksum('sha256', digest(DATA), len(DATA), BLOCK_SIZE)
+        checksum.update(0, 0, DATA[:100])
+        checksum.update(1, 300, DATA[300:])
+        checksum.catch_up(self.read, len(DATA))
+        self.assertEqual(checksum.hashed_to, len(DATA))
+        self.assertTrue(checksum.matches())
+
+    def test_received_data_moves_the_prefix_on(self):
+        checksum = Checksum('sha256', digest(DATA), len(DATA), BLOCK_SIZE)
+        def read(offset, size):
+            # A connection receives the next bytes meanwhile.
+            checksum.update(0, offset, DATA[offset:offset + 40])
+            return self.read(offset, size)
+        checksum.catch_up(read, len(DATA))
+        self.assertTrue(checksum.matches())
+
+    def test_restart_stops_catch_up(self):
+        checksum = Checksum('sha256', digest(DATA), len(DATA), BLOCK_SIZE)
+        def read(offset, size):
+            checksum.restart()
+            return self.read(offset, size)
+        checksum.catch_up(read, len(DATA))
+        self.assertEqual(checksum.hashed_to, 0)
+
+class BadRangesTest(unittest.TestCase):
+    ''' Only blocks with a piece hash are blamed. '''
+    def test_no_blame_without_pieces(self):
+        checksum = Checksum('sha256', digest(DATA), len(DATA), BLOCK_SIZE)
+        bad = bytearray(DATA)
+        bad[20] ^= 1
+        checksum.update(0, 0, bytes(bad))
+        self.assertFalse(checksum.matches())
+        self.assertEqual(checksum.bad_ranges(), [])
+
+    def test_bad_blocks_are_merged(self):
+        checksum = Checksum('sha256', None, len(DATA), BLOCK_SIZE, pieces(DATA))
+        bad = bytearray(DATA)
+        bad[20] ^= 1
+        bad[40] ^= 1
+        bad[100] ^= 1
+        checksum.update(0, 0, bytes(bad))
+        self.assertEqual(checksum.bad_ranges(), [(16, 48), (96, 112)])
+        self.assertEqual(checksum.take_failed_ranges(), [(16, 32), (32, 48), (96, 112)])
+        self.assertFalse(checksum.matches())
+
+    def test_missing_blocks_are_read_back(self):
+        checksum = Checksum('sha256', None, len(DATA), BLOCK_SIZE, pieces(DATA))
+        # Two connections split block 1, neither can hash it.
+        checksum.update(0, 0, DATA[:24])
+        checksum.update(1, 24, DATA[24:])
+        checksum.hash_missing_blocks(lambda offset, size: DATA[offset:offset + size])
+        self.assertEqual(checksum.bad_ranges(), [])
+        self.assertTrue(checksum.matches())
+
+if __name__ == '__main__':
+    unittest.main()
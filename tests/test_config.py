@@ -0,0 +1,22 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from functions.config import Config
+
+class TlsAlpnTest(unittest.TestCase):
+    ''' Only the protocols Http speaks may be offered. '''
+    def test_http1_protocols(self):
+        config = Config()
+        config.set_tls_alpn('http/1.1, http/1.0')
+        self.assertEqual(config.tls_alpn, ['http/1.1', 'http/1.0'])
+
+    def test_h2_is_rejected(self):
+        config = Config()
+        with self.assertRaises(Exception):
+            config.set_tls_alpn('h2,http/1.1')
+        self.assertIsNone(config.tls_alpn)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import socket
+import unittest
+
+from functions.http import Http, HttpHeaders
+from functions.segments import Segment, SegmentMap
+
+def new_http():
+    return Http(socket.AF_UNSPEC, 5, 5)
+
+class Conn(object):
+    current_byte = 0
+    last_byte = 0
+
+class FilenameTest(unittest.TestCase):
+    ''' The output file name from Content-Disposition. '''
+    def filename_from(self, content_disposition):
+        http = new_http()
+        http.response_headers['Content-Disposition'] = content_disposition
+        http.set_filename_from_response()
+        return http.output_filename
+
+    def test_quoted_filename(self):
+        self.assertEqual(self.filename_from('attachment; filename="file.jpg"'), 'file.jpg')
+
+    def test_reserved_characters_are_replaced(self):
+        self.assertEqual(self.filename_from('attachment; filename="a/b:c?.jpg"'), 'a_b_c_.jpg')
+
+    def test_no_filename(self):
+        self.assertIsNone(self.filename_from('inline'))
+
+class MultipartTest(unittest.TestCase):
+    ''' Several ranges asked for in one request come back as multipart/byteranges. '''
+    def multipart_http(self):
+        http = new_http()
+        http.status_code = 206
+        http.response_headers = HttpHeaders()
+        http.response_headers['Content-Type'] = 'multipart/byteranges; boundary="3d6b6a416f9b5"'
+        http.multipart_boundary = http.get_multipart_boundary()
+        http.parts = [(0, 100), (200, 300)]
+        return http
+
+    def test_boundary(self):
+        self.assertEqual(self.multipart_http().multipart_boundary, b'3d6b6a416f9b5')
+
+    def test_no_boundary_without_206(self):
+        http = self.multipart_http()
+        http.status_code = 200
+        self.assertIsNone(http.get_multipart_boundary())
+        http.status_code = 206
+        http.response_headers['Content-Type'] = 'application/octet-stream'
+        self.assertIsNone(http.get_multipart_boundary())
+
+    def test_parse_part_header(self):
+        first = b'--b\r\nContent-Type: text/plain\r\nContent-Range: bytes 0-99/1000\r\n\r\n'
+        self.assertEqual(Http.parse_part_header(first, b'b'), (0, 100))
+        # Later parts start with the CRLF ending the previous one.
+        later = b'\r\n--b\r\ncontent-range: bytes 200-299/1000\r\n\r\n'
+        self.assertEqual(Http.parse_part_header(later, b'b'), (200, 300))
+
+    def test_invalid_part_header(self):
+        self.assertIsNone(Http.parse_part_header(b'--other\r\nContent-Range: bytes 0-9/10\r\n\r\n', b'b'))
+        self.assertIsNone(Http.parse_part_header(b'--b\r\nContent-Range: bytes */10\r\n\r\n', b'b'))
+        self.assertIsNone(Http.parse_part_header(b'--b\r\nContent-Type: text/plain\r\n\r\n', b'b'))
+
+    def test_parts_in_order(self):
+        http = self.multipart_http()
+        header = b'--3d6b6a416f9b5\r\nContent-Range: bytes 0-99/1000\r\n\r\n'
+        self.assertTrue(http.check_part_header(header))
+        self.assertEqual(http.part_end, 100)
+        header = b'\r\n--3d6b6a416f9b5\r\nContent-Range: bytes 200-299/1000\r\n\r\n'
+        self.assertTrue(http.check_part_header(header))
+        self.assertEqual(http.part_end, 300)
+
+    def test_parts_out_of_order(self):
+        http = self.multipart_http()
+        header = b'--3d6b6a416f9b5\r\nContent-Range: bytes 200-299/1000\r\n\r\n'
+        self.assertFalse(http.check_part_header(header))
+        self.assertTrue(http.extra_ranges_refused)
+
+class QueueTest(unittest.TestCase):
+    ''' The ranges asked for along with a connection's own range. '''
+    def setUp(self):
+        # Pending: 0-100, 200-300 and 350-400.
+        self.segments = SegmentMap.from_done_ranges(1000, [(100, 200), (300, 350), (400, 1000)])
+
+    def test_queue_skips_big_ranges(self):
+        self.assertTrue(self.segments.assign(0, Conn()))
+        self.assertEqual(self.segments.queue(0, 100, 4, 60), [(350, 400)])
+
+    def test_queue_skips_neighbours(self):
+        # A server may merge 200-300 into the range ending at 200.
+        self.assertEqual(self.segments.queue(0, 200, 4, 1000), [(350, 400)])
+
+    def test_next_queued_and_release(self):
+        conn = Conn()
+        self.assertTrue(self.segments.assign(0, conn))
+        self.assertEqual(self.segments.queue(0, conn.last_byte, 4, 1000), [(200, 300), (350, 400)])
+        self.segments.advance(0, 0, 100)
+        self.assertTrue(self.segments.next_queued(0, conn))
+        self.assertEqual((conn.current_byte, conn.last_byte), (200, 300))
+        self.segments.release(0)
+        self.assertEqual([segment.state for segment in self.segments.segments if segment.start == 350],
+                         [Segment.PENDING])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from functions.segments import Segment, SegmentMap
+
+class Conn(object):
+    def __init__(self, current_byte=0, last_byte=0, speed=0):
+        self.current_byte = current_byte
+        self.last_byte = last_byte
+        self.speed = speed
+
+def states(segment_map):
+    return [(segment.start, segment.end, segment.state) for segment in segment_map.segments]
+
+class StealTest(unittest.TestCase):
+    ''' Idle connections take work from the range that would finish last. '''
+    def setUp(self):
+        self.conns = [Conn(0, 1000), Conn(1000, 2000), Conn(2000, 2000)]
+        self.segments = SegmentMap.from_connections(2000, self.conns)
+
+    def test_steal_splits_by_speed(self):
+        self.segments.advance(0, 0, 200)
+        self.conns[0].current_byte = 200
+        self.assertTrue(self.segments.steal(2, self.conns, 10, speeds=[100, 100, 300]))
+        # Connection 1 has more left, connection 2 is three times as fast.
+        self.assertEqual((self.conns[1].last_byte, self.conns[2].current_byte, self.conns[2].last_byte),
+                         (1250, 1250, 2000))
+        self.assertEqual(self.segments.owned[2].start, 1250)
+
+    def test_unknown_speeds_split_in_half(self):
+        self.assertTrue(self.segments.steal(2, self.conns, 10))
+        self.assertEqual((self.conns[0].last_byte, self.conns[2].current_byte), (500, 500))
+
+    def test_nothing_worth_stealing(self):
+        self.assertFalse(self.segments.steal(2, self.conns, 1000))
+
+    def test_release_makes_the_rest_pending(self):
+        self.segments.advance(1, 1000, 300)
+        self.segments.release(1)
+        self.assertEqual(states(self.segments)[1:], [(1000, 1300, Segment.DONE), (1300, 2000, Segment.PENDING)])
+        self.assertTrue(self.segments.assign(2, self.conns[2]))
+        self.assertEqual((self.conns[2].current_byte, self.conns[2].last_byte), (1300, 2000))
+
+    def test_race_reports_the_loser(self):
+        self.assertTrue(self.segments.race(2, self.conns, speeds=[0, 100, 100]))
+        self.assertEqual(self.segments.owned[2], self.segments.owned[0])
+        covered, losers = self.segments.advance(2, 0, 1000)
+        self.assertEqual((covered, losers), (1000, [0]))
+        covered, losers = self.segments.advance(0, 0, 500)
+        self.assertEqual((covered, losers), (500, []))
+        self.assertNotIn(0, self.segments.owned)
+
+class ReopenTest(unittest.TestCase):
+    ''' Received bytes which failed verification are downloaded again. '''
+    def test_reopen_done_range(self):
+        segments = SegmentMap.from_done_ranges(1000, [(0, 1000)])
+        segments.reopen(200, 300)
+        self.assertEqual(states(segments), [
+            (0, 200, Segment.DONE), (200, 300, Segment.PENDING), (300, 1000, Segment.DONE)
+        ])
+        self.assertEqual(segments.done_ranges(), [(0, 200), (300, 1000)])
+
+    def test_reopen_active_range(self):
+        conns = [Conn(0, 1000)]
+        segments = SegmentMap.from_connections(1000, conns)
+        segments.advance(0, 0, 600)
+        segments.reopen(100, 200)
+        self.assertEqual(segments.done_ranges(), [(0, 100), (200, 600)])
+        # The owner goes on where it was.
+        self.assertEqual(segments.owned[0].done_to, 600)
+        segments.advance(0, 600, 400)
+        self.assertEqual(segments.done_ranges(), [(0, 100), (200, 1000)])
+        self.assertEqual(segments.bytes_left(), 100)
+
+    def test_reopen_across_segments(self):
+        segments = SegmentMap.from_done_ranges(1000, [(0, 400), (600, 1000)])
+        segments.reopen(300, 700)
+        self.assertEqual(segments.done_ranges(), [(0, 300), (700, 1000)])
+        self.assertEqual(segments.bytes_left(), 400)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import zlib
+import tempfile
+import unittest
+
+from functions.statefile import StateFile
+
+BLOCK_SIZE = 1024
+
+class StateFileTest(unittest.TestCase):
+    ''' The .st format round-trips the completed blocks and the validators. '''
+    def test_round_trip(self):
+        file_size = 10 * BLOCK_SIZE + 100
+        done_ranges = [(0, 3 * BLOCK_SIZE), (5 * BLOCK_SIZE, file_size)]
+        state = StateFile.from_done_ranges(file_size, BLOCK_SIZE, done_ranges, '"etag"', 'Mon, 01 Jan 2024')
+        loaded = StateFile.unpack(state.pack())
+        self.assertEqual(loaded.done_ranges(), done_ranges)
+        self.assertEqual(loaded.etag, '"etag"')
+        self.assertEqual(loaded.last_modified, 'Mon, 01 Jan 2024')
+        self.assertTrue(loaded.has_validators)
+
+    def test_partial_blocks_are_not_done(self):
+        file_size = 4 * BLOCK_SIZE
+        state = StateFile.from_done_ranges(file_size, BLOCK_SIZE, [(100, 3 * BLOCK_SIZE - 1)])
+        self.assertEqual(state.done_ranges(), [(BLOCK_SIZE, 2 * BLOCK_SIZE)])
+
+    def test_huge_file_with_few_holes_is_small(self):
+        file_size = 1 << 40
+        done_ranges = [(0, 1 << 30), (1 << 31, file_size)]
+        data = StateFile.from_done_ranges(file_size, BLOCK_SIZE, done_ranges).pack()
+        self.assertLess(len(data), 64)
+        self.assertEqual(StateFile.unpack(data).done_ranges(), done_ranges)
+
+    def test_varint(self):
+        for value in (0, 1, 127, 128, 300, 1 << 35):
+            data = StateFile.pack_varint(value)
+            self.assertEqual(StateFile.unpack_varint(data, 0), (value, len(data)))
+
+    def test_corruption_is_detected(self):
+        data = bytearray(StateFile.from_done_ranges(8 * BLOCK_SIZE, BLOCK_SIZE, [(0, BLOCK_SIZE)]).pack())
+        data[10] ^= 1
+        with self.assertRaises(ValueError):
+            StateFile.unpack(bytes(data))
+        with self.assertRaises(ValueError):
+            StateFile.unpack(bytes(data[:8]))
+
+    def test_version_1_has_no_validators(self):
+        header = StateFile.HEADER.pack(StateFile.MAGIC, 1, BLOCK_SIZE, 4 * BLOCK_SIZE)
+        body = header + StateFile.pack_varint(2) + StateFile.pack_varint(1) + StateFile.pack_varint(2)
+        data = body + StateFile.CRC.pack(zlib.crc32(body))
+        state = StateFile.unpack(data)
+        self.assertFalse(state.has_validators)
+        self.assertEqual(state.done_ranges(), [(BLOCK_SIZE, 3 * BLOCK_SIZE)])
+
+    def test_legacy_json(self):
+        file_size = 8 * BLOCK_SIZE
+        legacy = json.dumps({'connections': [
+            {'current_byte': 2 * BLOCK_SIZE, 'last_byte': 4 * BLOCK_SIZE},
+            {'current_byte': 8 * BLOCK_SIZE, 'last_byte': 8 * BLOCK_SIZE},
+        ]})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'file.st')
+            with open(filename, 'w') as file_obj:
+                file_obj.write(legacy)
+            state = StateFile.load(filename, file_size, BLOCK_SIZE)
+        self.assertFalse(state.has_validators)
+        self.assertEqual(state.done_ranges(), [(0, 2 * BLOCK_SIZE), (4 * BLOCK_SIZE, file_size)])
+
+    def test_save_and_load(self):
+        state = StateFile.from_done_ranges(4 * BLOCK_SIZE, BLOCK_SIZE, [(0, BLOCK_SIZE)], None, None)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'file.st')
+            self.assertIsNone(StateFile.load(filename, 0, BLOCK_SIZE))
+            state.save(filename)
+            self.assertEqual(os.listdir(tmpdir), ['file.st'])
+            loaded = StateFile.load(filename, 0, BLOCK_SIZE)
+        self.assertEqual(loaded.done_ranges(), [(0, BLOCK_SIZE)])
+        self.assertIsNone(loaded.etag)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import socket
+import select
+import unittest
+
+from functions.tcp import ConnectRace
+from functions.sockopts import SocketOptions
+
+class AddressList(object):
+    ''' A Resolver handing out fixed addresses. '''
+    def __init__(self, sockaddrs):
+        self.sockaddrs = sockaddrs
+        self.failures = []
+
+    def resolve(self, host, port, family):
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', sockaddr) for sockaddr in self.sockaddrs]
+
+    def get_preferred_family(self, host):
+        return None
+
+    def report_failure(self, host, port, family, sockaddr):
+        self.failures.append(sockaddr)
+
+    def report_success(self, host, port, family, gai_result):
+        pass
+
+def run_race(race):
+    timeout = race.next_timeout()
+    while timeout is not None:
+        _, writeable, _ = select.select([], list(race.attempts), [], timeout)
+        for sock in writeable:
+            race.attempt_done(sock)
+        timeout = race.next_timeout()
+    return race.take_winner()
+
+class FastOpenRaceTest(unittest.TestCase):
+    ''' With Tcp Fast Open, a writeable socket doesn't mean the address answered. '''
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen()
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        self.closed_address = closed.getsockname()
+        closed.close()
+        self.socket_options = SocketOptions(fastopen=True)
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_several_addresses_race_without_fastopen(self):
+        resolver = AddressList([self.closed_address, self.listener.getsockname()])
+        race = ConnectRace('localhost', 0, socket.AF_INET, 5, resolver=resolver, socket_options=self.socket_options)
+        self.assertTrue(race.resolve())
+        self.assertFalse(race.fastopen)
+        sock = run_race(race)
+        self.assertIsNotNone(sock)
+        self.assertEqual(sock.getpeername(), self.listener.getsockname())
+        self.assertEqual(resolver.failures, [self.closed_address])
+        self.assertIsNotNone(race.rtt)
+        sock.close()
+
+    def test_single_address_uses_fastopen(self):
+        resolver = AddressList([self.listener.getsockname()])
+        race = ConnectRace('localhost', 0, socket.AF_INET, 5, resolver=resolver, socket_options=self.socket_options)
+        self.assertTrue(race.resolve())
+        self.assertEqual(race.fastopen, self.socket_options.fastopen)
+        sock = run_race(race)
+        self.assertIsNotNone(sock)
+        if race.fastopen:
+            # Writeable before the handshake, that's no round trip time.
+            self.assertIsNone(race.rtt)
+        sock.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from functions.tuner import ConnectionTuner
+
+class TunerTest(unittest.TestCase):
+    ''' The tuner follows a simulated link, each window is EVALUATION_INTERVAL seconds. '''
+    def setUp(self):
+        self.tuner = ConnectionTuner(2, 8, 0.1)
+        self.connections = 2
+        self.now = 0
+        self.bytes_done = 0
+        self.tuner.evaluate(self.now, self.bytes_done, self.connections)
+
+    def run_windows(self, count, throughput):
+        ''' throughput(connections) in bytes per second, return the counts after each window. '''
+        counts = []
+        for _ in range(count):
+            self.now += ConnectionTuner.EVALUATION_INTERVAL
+            self.bytes_done += throughput(self.connections) * ConnectionTuner.EVALUATION_INTERVAL
+            decision = self.tuner.evaluate(self.now, self.bytes_done, self.connections)
+            self.connections += decision
+            counts.append(self.connections)
+        return counts
+
+    def test_grows_until_it_stops_paying_off(self):
+        self.run_windows(20, lambda connections: min(connections, 4) * 100)
+        self.assertEqual(self.connections, 4)
+
+    def test_grows_again_when_the_link_gets_faster(self):
+        self.run_windows(20, lambda connections: min(connections, 3) * 100)
+        self.assertEqual(self.connections, 3)
+        self.run_windows(40, lambda connections: min(connections, 6) * 100)
+        self.assertEqual(self.connections, 6)
+
+    def test_shrinks_when_connections_stop_helping(self):
+        self.run_windows(20, lambda connections: min(connections, 5) * 100)
+        self.assertEqual(self.connections, 5)
+        self.run_windows(40, lambda connections: min(connections, 2) * 100)
+        self.assertEqual(self.connections, 2)
+
+    def test_noise_within_margin_keeps_the_count(self):
+        self.run_windows(20, lambda connections: min(connections, 4) * 100)
+        jitter = iter([1.05, 0.95] * 50)
+        counts = self.run_windows(60, lambda connections: min(connections, 4) * 100 * next(jitter))
+        # Only the periodic probes, which are taken back.
+        self.assertEqual(set(counts), {3, 4, 5})
+        self.assertGreater(counts.count(4), len(counts) // 2)
+        self.assertEqual(counts[-1], 4)
+
+    def test_max_connections(self):
+        self.run_windows(40, lambda connections: connections * 100)
+        self.assertEqual(self.connections, 8)
+
+    def test_refused_caps_the_count(self):
+        self.tuner.refused(3)
+        self.run_windows(40, lambda connections: connections * 100)
+        self.assertEqual(self.connections, 2)
+
+if __name__ == '__main__':
+    unittest.main()